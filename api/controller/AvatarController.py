@@ -0,0 +1,50 @@
+from fastapi import HTTPException, Response
+from fastapi.responses import FileResponse
+from fastapi.concurrency import run_in_threadpool
+from utils.avatar import AVATAR_DIR, avatar_cache, avatar_size, load_or_render, parse_avatar_name
+from utils.media_files import IMMUTABLE_CACHE_CONTROL, REVALIDATE_CACHE_CONTROL
+from typing import Optional
+import asyncio
+import re
+import os
+
+# Concurrent misses for the same avatar wait for a single render
+rendering: dict = {}
+
+_legacy_name_pattern = re.compile(r"^[\w-]+\.png$")
+
+async def fetch_avatar(name: str, size: Optional[int] = None, if_none_match: Optional[str] = None):
+    if parse_avatar_name(name) is None:
+        # Pictures created before avatars were rendered on demand
+        path = os.path.join(AVATAR_DIR, name)
+        if _legacy_name_pattern.match(name) and os.path.isfile(path):
+            return FileResponse(path, media_type="image/png", headers={"Cache-Control": REVALIDATE_CACHE_CONTROL})
+        raise HTTPException(status_code=404, detail="Avatar not found")
+
+    size = avatar_size(size)
+    # The name describes the picture and rendering is deterministic, so an avatar never changes
+    etag = f'"{os.path.splitext(name)[0]}_{size}"'
+    headers = {"Cache-Control": IMMUTABLE_CACHE_CONTROL, "ETag": etag}
+    if if_none_match and etag in (tag.strip() for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers=headers)
+
+    data = avatar_cache.get(name, size)
+
+    if data is None:
+        key = (name, size)
+        future = rendering.get(key)
+        if future is None:
+            future = asyncio.ensure_future(run_in_threadpool(load_or_render, name, size))
+            rendering[key] = future
+            future.add_done_callback(lambda _: rendering.pop(key, None))
+        try:
+            data = await asyncio.shield(future)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Error generating avatar: {str(e)}") from e
+        avatar_cache.put(name, size, data)
+
+    return Response(
+        content=data,
+        media_type="image/png",
+        headers=headers
+    )
@@ -1,33 +1,229 @@
-from fastapi import HTTPException
+from fastapi import HTTPException, Response
+from sqlmodel import select, update
+from sqlalchemy import text
 from sqlalchemy.exc import SQLAlchemyError
-from db.db import SessionDep
-from models.Chat import Model as Chat, ChatResponse, InsertChat
+from db.db import SessionDep, commit_seconds
+from models.Chat import Model as Chat, ChatResponse, ChatPage, ChatSearchPage, InsertChat, conversation_key, utc_naive
+from api.controller.InboxController import append_events
+from api.controller.SearchController import index_chats, match_query
+from api.controller.RosterController import log_changes
+from utils.image_derivatives import derivatives
+from utils.history_cache import history_cache
+from typing import Optional
+from datetime import datetime, timezone
 import json
+import time
+import logging
 
-def insert_chat(chat_data: InsertChat, session: SessionDep):
+logger = logging.getLogger(__name__)
+
+def chat_response(chat: Chat, variants: Optional[dict] = None) -> ChatResponse:
+    return ChatResponse(
+        id=chat.id,
+        sender_id=chat.sender_id,
+        receiver_id=chat.receiver_id,
+        message=chat.message,
+        image=chat.image,
+        variants=variants,
+        uuid=chat.uuid,
+        status=chat.status,
+        created_at=chat.created_at.replace(tzinfo=timezone.utc)
+    )
+
+async def chat_responses(chats) -> list:
+    """`chat_response` of each chat, with the variants of their images looked up at once."""
+    variants = await derivatives.lookup(chat.image for chat in chats)
+    return [chat_response(chat, variants.get(chat.image)) for chat in chats]
+
+async def insert_chats(chats_data: list, session: SessionDep) -> list:
+    """
+    Writes a batch of chats in a single transaction, together with the inbox
+    events that deliver them: the chat itself for the receiver and a
+    `msg_update` for the sender.
+
+    Returns one `(ChatResponse, deliveries)` pair per chat, in the same order,
+    where `deliveries` holds the `(user_id, seq, payload)` events to push.
+    """
     try:
-        chat = Chat.model_validate(chat_data)
-    
-        session.add(chat)
-        session.commit()
-        session.refresh(chat)
-
-        chat_response = ChatResponse(
-            id=chat.id,
-            sender_id=chat.sender_id,
-            receiver_id=chat.receiver_id,
-            message=chat.message,
-            image=chat.image,
-            uuid=chat.uuid,
-            created_at=chat.created_at
-        )
+        chats = []
+        for chat_data in chats_data:
+            chat_data = InsertChat.model_validate(chat_data)
+            user_low, user_high = conversation_key(chat_data.sender_id, chat_data.receiver_id)
+            chats.append(Chat(
+                **chat_data.model_dump(exclude={"created_at"}),
+                user_low=user_low,
+                user_high=user_high,
+                created_at=utc_naive(chat_data.created_at)
+            ))
+
+        session.add_all(chats)
+        await session.flush()
+        await index_chats(chats, session)
+
+        responses = await chat_responses(chats)
+        owners = []
+        events = []
+        for index, response in enumerate(responses):
+            if response.sender_id == response.receiver_id:
+                continue
+            events.append((response.receiver_id, {'type': 'chat', **response.model_dump(mode="json")}))
+            events.append((response.sender_id, {'type': 'msg_update', 'receiver_id': response.receiver_id, 'uuid': response.uuid}))
+            owners.extend((index, index))
+
+        stored = await append_events(events, session)
+        # Both rosters now show a different last message
+        log_changes({(chat.user_low, chat.user_high) for chat in chats if chat.user_low != chat.user_high}, session)
+        started = time.perf_counter()
+        await session.commit()
+        commit_seconds.observe(time.perf_counter() - started)
+
+        for chat, response in zip(chats, responses):
+            history_cache.append((chat.user_low, chat.user_high), response)
 
-        return chat_response.model_dump_json()
+        deliveries = [[] for _ in responses]
+        for index, delivery in zip(owners, stored):
+            deliveries[index].append(delivery)
+
+        return list(zip(responses, deliveries))
     
     except SQLAlchemyError as e:
-        session.rollback()
+        await session.rollback()
         raise HTTPException(status_code=500, detail="Error Inserting chat") from e
     
     except Exception as e:
-        session.rollback()
-        raise HTTPException(status_code=500, detail=str(e)) from e
\ No newline at end of file
+        await session.rollback()
+        raise HTTPException(status_code=500, detail=str(e)) from e
+
+async def insert_chat(chat_data: InsertChat, session: SessionDep):
+    chat_response_data, _ = (await insert_chats([chat_data], session))[0]
+    return chat_response_data.model_dump_json()
+
+# A status only ever moves forward, from the weaker ones to the stronger one
+RECEIPT_STATUSES = {"delivered": ("sent",), "read": ("sent", "delivered")}
+
+async def apply_receipts(receipts: dict, session: SessionDep) -> list:
+    """
+    Applies range receipts in one transaction: `receipts` maps
+    `(reader_id, sender_id)` to `{status: upto}`, meaning every chat from the
+    sender to the reader with an id up to `upto` now has that status.
+
+    Each range is a single UPDATE over the conversation index. The sender gets
+    one `receipt` event per conversation and status, and only when some chat
+    actually changed, up to the last chat that did. Returns the stored
+    `(user_id, seq, payload)` events.
+    """
+    try:
+        now = utc_naive(datetime.now(timezone.utc))
+        events = []
+        changed = []
+        for (reader_id, sender_id), statuses in receipts.items():
+            user_low, user_high = conversation_key(reader_id, sender_id)
+            read_upto = statuses.get("read", 0)
+            for status in ("read", "delivered"):
+                upto = statuses.get(status)
+                # Chats already covered by the read range need no delivered receipt
+                if upto is None or (status == "delivered" and upto <= read_upto):
+                    continue
+                updated = (await session.execute(
+                    update(Chat)
+                    .where(
+                        Chat.user_low == user_low,
+                        Chat.user_high == user_high,
+                        Chat.id <= upto,
+                        Chat.sender_id == sender_id,
+                        Chat.status.in_(RECEIPT_STATUSES[status])
+                    )
+                    .values(status=status, updated_at=now)
+                    .returning(Chat.id)
+                )).scalars().all()
+                if updated:
+                    # The client's upto can name chats it never received, or of another sender
+                    upto = max(updated)
+                    events.append((sender_id, {'type': 'receipt', 'receiver_id': reader_id, 'status': status, 'upto': upto}))
+                    changed.append(((user_low, user_high), sender_id, upto, status))
+
+        stored = await append_events(events, session)
+        log_changes({key for key, _, _, _ in changed if key[0] != key[1]}, session)
+        await session.commit()
+
+        for key, sender_id, upto, status in changed:
+            history_cache.update_status(key, sender_id, upto, status, RECEIPT_STATUSES[status])
+        return stored
+
+    except SQLAlchemyError as e:
+        await session.rollback()
+        raise HTTPException(status_code=500, detail="Database error while updating chat status") from e
+
+async def fetch_chat_history(current_user: int, peer_id: int, before: Optional[int], limit: int, session: SessionDep):
+    """
+    Returns one page of the conversation between `current_user` and `peer_id`,
+    newest page first. Pages are keyed on the chat id so that each request is a
+    bounded index range scan, no matter how deep into the history the client is.
+
+    The first page of an active conversation is served pre-serialized from the
+    history cache. On a miss enough chats are read to fill the cache as well.
+    """
+    key = conversation_key(current_user, peer_id)
+    try:
+        if before is None:
+            page = history_cache.page(key, limit)
+            if page is not None:
+                return Response(content=page, media_type="application/json")
+            history_cache.begin_fill(key)
+
+        query = select(Chat).where(Chat.user_low == key[0], Chat.user_high == key[1])
+
+        if before is not None:
+            query = query.where(Chat.id < before)
+
+        fetch = max(limit, history_cache.depth) if before is None else limit
+        chats = (await session.exec(query.order_by(Chat.id.desc()).limit(fetch))).all()
+
+        responses = await chat_responses(chats[::-1])
+        if before is None:
+            history_cache.fill(key, responses, complete=len(chats) < fetch)
+        responses = responses[-limit:]
+
+        return ChatPage(
+            chats=responses,
+            next_before=responses[0].id if len(responses) == limit else None
+        )
+
+    except SQLAlchemyError as e:
+        logger.exception("Database error while fetching chats")
+        raise HTTPException(status_code=500, detail="Database error while fetching chats") from e
+    except Exception as e:
+        logger.exception("Error while fetching chats")
+        raise HTTPException(status_code=500, detail="An error occurred while fetching chats") from e
+    finally:
+        history_cache.cancel_fill(key)
+
+async def search_chats(current_user: int, query: str, peer_id: Optional[int], offset: int, limit: int, session: SessionDep):
+    """
+    Returns one page of the chats of `current_user` matching `query`, best
+    matches first (bm25 over the message text), optionally restricted to the
+    conversation with `peer_id`.
+    """
+    expression = match_query(query, current_user, peer_id)
+    if expression is None:
+        return ChatSearchPage()
+
+    try:
+        statement = text(
+            "SELECT chats.* FROM chats_fts JOIN chats ON chats.id = chats_fts.rowid "
+            "WHERE chats_fts MATCH :expression "
+            "ORDER BY bm25(chats_fts, 1.0, 0.0), chats.id DESC LIMIT :limit OFFSET :offset"
+        )
+        chats = (await session.exec(
+            select(Chat).from_statement(statement),
+            params={"expression": expression, "limit": limit, "offset": offset}
+        )).scalars().all()
+
+        return ChatSearchPage(
+            chats=await chat_responses(chats),
+            next_offset=offset + len(chats) if len(chats) == limit else None
+        )
+
+    except SQLAlchemyError as e:
+        logger.exception("Database error while searching chats")
+        raise HTTPException(status_code=500, detail="Database error while searching chats") from e
@@ -0,0 +1,79 @@
+from sqlmodel import select, update, delete
+from sqlalchemy.exc import SQLAlchemyError
+from fastapi import HTTPException
+from db.db import SessionDep
+from models.Inbox import Model as Inbox
+from models.User import Model as User
+from datetime import datetime
+import json
+
+async def append_events(events: list, session: SessionDep) -> list:
+    """
+    Stores `(user_id, payload)` events in the recipients' inboxes as part of the
+    caller's transaction and returns them, in the same order, as
+    `(user_id, seq, payload)`.
+
+    Sequence numbers are allocated in the database, one UPDATE per recipient,
+    so they stay monotonic across processes. The caller commits.
+    """
+    counts = {}
+    for user_id, _ in events:
+        counts[user_id] = counts.get(user_id, 0) + 1
+
+    next_seq = {}
+    for user_id, count in counts.items():
+        last_seq = (await session.execute(
+            update(User)
+            .where(User.id == user_id)
+            .values(inbox_seq=User.inbox_seq + count)
+            .returning(User.inbox_seq)
+        )).scalar_one()
+        next_seq[user_id] = last_seq - count + 1
+
+    stored = []
+    for user_id, payload in events:
+        seq = next_seq[user_id]
+        next_seq[user_id] += 1
+        session.add(Inbox(user_id=user_id, seq=seq, payload=json.dumps(payload)))
+        stored.append((user_id, seq, payload))
+
+    return stored
+
+async def fetch_inbox(user_id: int, since: int, limit: int, session: SessionDep) -> list:
+    try:
+        rows = (await session.exec(
+            select(Inbox)
+            .where(Inbox.user_id == user_id, Inbox.seq > since)
+            .order_by(Inbox.seq)
+            .limit(limit)
+        )).all()
+
+        return [(row.seq, json.loads(row.payload)) for row in rows]
+
+    except SQLAlchemyError as e:
+        raise HTTPException(status_code=500, detail="Database error while fetching inbox") from e
+
+async def prune_inbox(acked: dict, acked_upto: dict, session: SessionDep):
+    """
+    Deletes delivered events: `acked` maps users to individual sequence numbers,
+    `acked_upto` maps users to a sequence number the client has fully caught up to.
+    """
+    try:
+        for user_id, seqs in acked.items():
+            await session.execute(delete(Inbox).where(Inbox.user_id == user_id, Inbox.seq.in_(seqs)))
+        for user_id, seq in acked_upto.items():
+            await session.execute(delete(Inbox).where(Inbox.user_id == user_id, Inbox.seq <= seq))
+        await session.commit()
+
+    except SQLAlchemyError as e:
+        await session.rollback()
+        raise HTTPException(status_code=500, detail="Database error while pruning inbox") from e
+
+async def expire_inbox(older_than: datetime, session: SessionDep):
+    try:
+        await session.execute(delete(Inbox).where(Inbox.created_at < older_than))
+        await session.commit()
+
+    except SQLAlchemyError as e:
+        await session.rollback()
+        raise HTTPException(status_code=500, detail="Database error while expiring inbox") from e
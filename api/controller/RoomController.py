@@ -0,0 +1,260 @@
+from fastapi import HTTPException
+from sqlmodel import select, update, delete, func
+from sqlalchemy.orm import aliased
+from sqlalchemy.exc import SQLAlchemyError
+from db.db import SessionDep
+from models.Room import Model as Room, CreateRoom, RoomResponse
+from models.RoomMember import Model as RoomMember
+from models.RoomMessage import Model as RoomMessage, InsertRoomMessage, RoomMessageResponse, RoomMessagePage
+from models.User import Model as User
+from models.Chat import utc_naive
+from utils.image_derivatives import derivatives
+from utils.room_member_cache import room_member_cache
+from dotenv import load_dotenv
+from typing import Optional
+from datetime import timezone
+import logging
+import os
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+ROOM_MAX_MEMBERS = int(os.getenv("ROOM_MAX_MEMBERS", "1000"))
+
+def room_message_response(message: RoomMessage) -> RoomMessageResponse:
+    return RoomMessageResponse(
+        id=message.id,
+        room_id=message.room_id,
+        sender_id=message.sender_id,
+        message=message.message,
+        image=message.image,
+        variants=derivatives.variants(message.image),
+        uuid=message.uuid,
+        created_at=message.created_at.replace(tzinfo=timezone.utc)
+    )
+
+async def fetch_membership(room_id: int, user_id: int, session: SessionDep) -> RoomMember:
+    membership = await session.get(RoomMember, (room_id, user_id))
+    if not membership:
+        raise HTTPException(status_code=404, detail="Room not found")
+    return membership
+
+async def fetch_member_ids(room_id: int, session: SessionDep) -> list:
+    return list((await session.exec(select(RoomMember.user_id).where(RoomMember.room_id == room_id))).all())
+
+async def fetch_cached_member_ids(room_id: int, session: SessionDep) -> tuple:
+    """The members of a room, from the member cache when it has them."""
+    member_ids = room_member_cache.get(room_id)
+    if member_ids is None:
+        room_member_cache.begin_fill(room_id)
+        try:
+            member_ids = tuple(await fetch_member_ids(room_id, session))
+            room_member_cache.fill(room_id, member_ids)
+        finally:
+            room_member_cache.cancel_fill(room_id)
+    return member_ids
+
+async def members_changed(room_id: int):
+    room_member_cache.invalidate((room_id,))
+    await room_member_cache.publish((room_id,))
+
+async def add_members(room: Room, user_ids: list, session: SessionDep) -> list:
+    """Adds the existing users among `user_ids` that are not members yet, as part of the caller's transaction."""
+    existing = set(await fetch_member_ids(room.id, session))
+    candidates = [user_id for user_id in dict.fromkeys(user_ids) if user_id not in existing]
+    if not candidates:
+        return []
+
+    found = set((await session.exec(select(User.id).where(User.id.in_(candidates)))).all())
+    added = [user_id for user_id in candidates if user_id in found]
+    if len(existing) + len(added) > ROOM_MAX_MEMBERS:
+        raise HTTPException(status_code=400, detail=f"A room has at most {ROOM_MAX_MEMBERS} members")
+
+    # New members start with the history marked as read
+    session.add_all(
+        RoomMember(room_id=room.id, user_id=user_id, last_read_id=room.last_message_id or 0) for user_id in added
+    )
+    room.member_count = len(existing) + len(added)
+    session.add(room)
+    return added
+
+async def create_room(room_data: CreateRoom, current_user: int, session: SessionDep):
+    try:
+        room = Room(name=room_data.name, created_by=current_user)
+        session.add(room)
+        await session.flush()
+
+        session.add(RoomMember(room_id=room.id, user_id=current_user, role="owner"))
+        room.member_count = 1
+        await session.flush()
+        await add_members(room, room_data.member_ids, session)
+        await session.commit()
+
+        return RoomResponse(
+            id=room.id,
+            name=room.name,
+            created_by=room.created_by,
+            member_count=room.member_count,
+            created_at=room.created_at.replace(tzinfo=timezone.utc)
+        )
+
+    except HTTPException:
+        await session.rollback()
+        raise
+    except SQLAlchemyError as e:
+        await session.rollback()
+        raise HTTPException(status_code=500, detail="Database error while creating room") from e
+
+async def fetch_rooms(current_user: int, session: SessionDep):
+    """
+    Lists the rooms of `current_user` with their last message and the number of
+    messages after the member's read cursor, counted on the (room_id, id) index.
+    """
+    try:
+        LastMessage = aliased(RoomMessage)
+        unread = (
+            select(func.count(RoomMessage.id))
+            .where(RoomMessage.room_id == RoomMember.room_id, RoomMessage.id > RoomMember.last_read_id)
+            .scalar_subquery()
+        )
+
+        rows = (await session.exec(
+            select(Room, LastMessage, unread)
+            .join(RoomMember, RoomMember.room_id == Room.id)
+            .outerjoin(LastMessage, LastMessage.id == Room.last_message_id)
+            .where(RoomMember.user_id == current_user)
+            .order_by(Room.last_message_id.desc(), Room.id.desc())
+        )).all()
+
+        return [
+            RoomResponse(
+                id=room.id,
+                name=room.name,
+                created_by=room.created_by,
+                member_count=room.member_count,
+                last_message=room_message_response(last_message) if last_message else None,
+                unread_count=unread_count or 0,
+                created_at=room.created_at.replace(tzinfo=timezone.utc)
+            ) for room, last_message, unread_count in rows
+        ]
+
+    except SQLAlchemyError as e:
+        logger.exception("Database error while fetching rooms")
+        raise HTTPException(status_code=500, detail="Database error while fetching rooms") from e
+
+async def fetch_room_messages(current_user: int, room_id: int, before: Optional[int], limit: int, session: SessionDep):
+    """Returns one page of a room, newest page first, keyed on the message id like the chat history."""
+    try:
+        await fetch_membership(room_id, current_user, session)
+
+        query = select(RoomMessage).where(RoomMessage.room_id == room_id)
+        if before is not None:
+            query = query.where(RoomMessage.id < before)
+
+        messages = (await session.exec(query.order_by(RoomMessage.id.desc()).limit(limit))).all()
+
+        return RoomMessagePage(
+            messages=[room_message_response(message) for message in reversed(messages)],
+            next_before=messages[-1].id if len(messages) == limit else None
+        )
+
+    except SQLAlchemyError as e:
+        logger.exception("Database error while fetching room messages")
+        raise HTTPException(status_code=500, detail="Database error while fetching room messages") from e
+
+async def add_room_members(current_user: int, room_id: int, user_ids: list, session: SessionDep):
+    try:
+        await fetch_membership(room_id, current_user, session)
+        room = await session.get(Room, room_id)
+        added = await add_members(room, user_ids, session)
+        await session.commit()
+        if added:
+            await members_changed(room_id)
+        return {'added': added, 'member_count': room.member_count}
+
+    except HTTPException:
+        await session.rollback()
+        raise
+    except SQLAlchemyError as e:
+        await session.rollback()
+        raise HTTPException(status_code=500, detail="Database error while adding room members") from e
+
+async def remove_room_member(current_user: int, room_id: int, user_id: int, session: SessionDep):
+    """A member can leave a room, only its owner can remove someone else. The owner cannot leave."""
+    try:
+        membership = await fetch_membership(room_id, current_user, session)
+        if user_id != current_user and membership.role != "owner":
+            raise HTTPException(status_code=403, detail="Only the owner can remove members")
+        if user_id == current_user and membership.role == "owner":
+            # The room would be left without anyone able to manage it
+            raise HTTPException(status_code=400, detail="The owner cannot leave the room")
+
+        result = await session.execute(
+            delete(RoomMember).where(RoomMember.room_id == room_id, RoomMember.user_id == user_id)
+        )
+        if result.rowcount:
+            await session.execute(
+                update(Room).where(Room.id == room_id).values(member_count=Room.member_count - result.rowcount)
+            )
+        await session.commit()
+        if result.rowcount:
+            await members_changed(room_id)
+        return {'Response': 'Success'}
+
+    except HTTPException:
+        raise
+    except SQLAlchemyError as e:
+        await session.rollback()
+        raise HTTPException(status_code=500, detail="Database error while removing room member") from e
+
+async def insert_room_message(message_data: InsertRoomMessage, session: SessionDep) -> tuple:
+    """
+    Stores a room post once, whatever the size of the room, and moves the
+    sender's read cursor past it. Returns the message and the ids of the
+    members to fan it out to.
+    """
+    try:
+        message_data = InsertRoomMessage.model_validate(message_data)
+        await fetch_membership(message_data.room_id, message_data.sender_id, session)
+
+        message = RoomMessage(
+            **message_data.model_dump(exclude={"created_at"}),
+            created_at=utc_naive(message_data.created_at)
+        )
+        session.add(message)
+        await session.flush()
+
+        await session.execute(
+            update(Room).where(Room.id == message.room_id).values(last_message_id=message.id)
+        )
+        await session.execute(
+            update(RoomMember)
+            .where(RoomMember.room_id == message.room_id, RoomMember.user_id == message.sender_id)
+            .values(last_read_id=message.id)
+        )
+        member_ids = await fetch_cached_member_ids(message.room_id, session)
+        await session.commit()
+
+        return room_message_response(message), member_ids
+
+    except HTTPException:
+        await session.rollback()
+        raise
+    except SQLAlchemyError as e:
+        await session.rollback()
+        raise HTTPException(status_code=500, detail="Error inserting room message") from e
+
+async def apply_room_reads(reads: dict, session: SessionDep):
+    """Moves read cursors forward, `reads` maps `(user_id, room_id)` to the last read message id."""
+    try:
+        for (user_id, room_id), upto in reads.items():
+            await session.execute(
+                update(RoomMember)
+                .where(RoomMember.room_id == room_id, RoomMember.user_id == user_id, RoomMember.last_read_id < upto)
+                .values(last_read_id=upto)
+            )
+        await session.commit()
+
+    except SQLAlchemyError as e:
+        await session.rollback()
+        raise HTTPException(status_code=500, detail="Database error while updating read cursors") from e
@@ -0,0 +1,79 @@
+from fastapi import HTTPException
+from sqlmodel import select, delete, func, union_all
+from sqlalchemy.exc import SQLAlchemyError
+from db.db import SessionDep
+from models.RosterChange import Model as RosterChange
+
+def log_changes(changes, session: SessionDep):
+    """
+    Records `(user_id, peer_id)` roster changes as part of the caller's
+    transaction, `peer_id` is None for a change of the user itself.
+    """
+    session.add_all(RosterChange(user_id=user_id, peer_id=peer_id) for user_id, peer_id in changes)
+
+async def roster_version(viewer_id: int, session: SessionDep) -> tuple:
+    """
+    Returns the id of the last change of any user and the id of the last
+    change the roster of `viewer_id` depends on, three index lookups.
+    """
+    try:
+        row = (await session.execute(select(
+            select(func.max(RosterChange.id)).where(RosterChange.peer_id.is_(None)).scalar_subquery(),
+            select(func.max(RosterChange.id)).where(RosterChange.user_id == viewer_id).scalar_subquery(),
+            select(func.max(RosterChange.id)).where(RosterChange.peer_id == viewer_id).scalar_subquery()
+        ))).one()
+        return row[0] or 0, max(version or 0 for version in row)
+
+    except SQLAlchemyError as e:
+        raise HTTPException(status_code=500, detail="Database error while reading roster version") from e
+
+async def fetch_roster_changes(viewer_id, since: int, session: SessionDep):
+    """
+    Returns the ids of the users that changed after version `since`, and the
+    ids of the peers whose conversation with `viewer_id` changed, read from
+    the (peer_id, id) and (user_id, id) indexes. Pass no viewer for the user
+    changes only. Returns None when the log no longer goes back that far and
+    everything has to be read again.
+    """
+    try:
+        oldest = (await session.execute(select(func.min(RosterChange.id)))).scalar()
+        if oldest is not None and since < oldest - 1:
+            return None
+
+        ranges = [
+            select(RosterChange.user_id, RosterChange.peer_id)
+            .where(RosterChange.peer_id.is_(None), RosterChange.id > since)
+        ]
+        if viewer_id is not None:
+            ranges.append(
+                select(RosterChange.user_id, RosterChange.peer_id)
+                .where(RosterChange.user_id == viewer_id, RosterChange.peer_id.is_not(None), RosterChange.id > since)
+            )
+            ranges.append(
+                select(RosterChange.user_id, RosterChange.peer_id)
+                .where(RosterChange.peer_id == viewer_id, RosterChange.id > since)
+            )
+
+        users, peers = set(), set()
+        statement = union_all(*ranges) if len(ranges) > 1 else ranges[0]
+        for user_id, peer_id in (await session.execute(statement)).all():
+            if peer_id is None:
+                users.add(user_id)
+            else:
+                peers.add(peer_id if user_id == viewer_id else user_id)
+        return users, peers
+
+    except SQLAlchemyError as e:
+        raise HTTPException(status_code=500, detail="Database error while reading roster changes") from e
+
+async def prune_roster_changes(keep: int, session: SessionDep):
+    """Keeps the last `keep` changes, clients that are further behind receive the whole roster."""
+    try:
+        latest = (await session.execute(select(func.max(RosterChange.id)))).scalar()
+        if latest is not None and latest > keep:
+            await session.execute(delete(RosterChange).where(RosterChange.id <= latest - keep))
+            await session.commit()
+
+    except SQLAlchemyError as e:
+        await session.rollback()
+        raise HTTPException(status_code=500, detail="Database error while pruning roster changes") from e
@@ -0,0 +1,58 @@
+from fastapi import HTTPException
+from sqlmodel import delete
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.exc import SQLAlchemyError
+from db.db import SessionDep
+from models.ConnectionRoute import Model as ConnectionRoute
+from datetime import datetime, timezone
+
+async def upsert_route(user_id: int, worker_id: str, session: SessionDep):
+    """Points `user_id` at `worker_id` and returns the worker it was routed to before."""
+    try:
+        previous = await session.get(ConnectionRoute, user_id)
+        previous_worker = previous.worker_id if previous else None
+
+        statement = insert(ConnectionRoute).values(
+            user_id=user_id,
+            worker_id=worker_id,
+            updated_at=datetime.now(timezone.utc).replace(tzinfo=None)
+        )
+        await session.execute(statement.on_conflict_do_update(
+            index_elements=[ConnectionRoute.user_id],
+            set_={"worker_id": statement.excluded.worker_id, "updated_at": statement.excluded.updated_at}
+        ))
+        await session.commit()
+
+        return previous_worker
+
+    except SQLAlchemyError as e:
+        await session.rollback()
+        raise HTTPException(status_code=500, detail="Database error while registering connection") from e
+
+async def delete_route(user_id: int, worker_id: str, session: SessionDep):
+    try:
+        await session.execute(
+            delete(ConnectionRoute).where(ConnectionRoute.user_id == user_id, ConnectionRoute.worker_id == worker_id)
+        )
+        await session.commit()
+
+    except SQLAlchemyError as e:
+        await session.rollback()
+        raise HTTPException(status_code=500, detail="Database error while removing connection") from e
+
+async def delete_worker_routes(worker_id: str, session: SessionDep):
+    try:
+        await session.execute(delete(ConnectionRoute).where(ConnectionRoute.worker_id == worker_id))
+        await session.commit()
+
+    except SQLAlchemyError as e:
+        await session.rollback()
+        raise HTTPException(status_code=500, detail="Database error while removing connections") from e
+
+async def fetch_route(user_id: int, session: SessionDep):
+    try:
+        route = await session.get(ConnectionRoute, user_id)
+        return route.worker_id if route else None
+
+    except SQLAlchemyError as e:
+        raise HTTPException(status_code=500, detail="Database error while fetching connection") from e
@@ -0,0 +1,70 @@
+from fastapi import HTTPException
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+from db.db import SessionDep
+from typing import Optional
+import re
+
+MAX_QUERY_TERMS = 16
+
+def members(user_low: int, user_high: int) -> str:
+    return f"u{user_low} u{user_high}"
+
+def match_query(query: str, user_id: int, peer_id: Optional[int] = None) -> Optional[str]:
+    """
+    Builds the FTS5 expression of a search. Every word of `query` is quoted so
+    that user input can never be read as FTS5 syntax, the last one matches as
+    a prefix to support search-as-you-type. Returns None when there is nothing
+    to search for.
+    """
+    terms = re.findall(r"\w+", query)[:MAX_QUERY_TERMS]
+    if not terms:
+        return None
+
+    phrases = [f'"{term}"' for term in terms]
+    if not query[-1].isspace():
+        phrases[-1] += "*"
+
+    participants = f"u{user_id}" if peer_id is None else f"u{user_id} AND u{peer_id}"
+    return f"members : ({participants}) AND message : ({' AND '.join(phrases)})"
+
+async def index_chats(chats: list, session: SessionDep):
+    """Adds freshly inserted chats to the search index, as part of the caller's transaction."""
+    rows = [
+        {"rowid": chat.id, "message": chat.message, "members": members(chat.user_low, chat.user_high)}
+        for chat in chats if chat.message
+    ]
+    if rows:
+        await session.execute(
+            text("INSERT INTO chats_fts (rowid, message, members) VALUES (:rowid, :message, :members)"),
+            rows
+        )
+
+async def backfill_search_index(chunk: int, session: SessionDep) -> bool:
+    """
+    Indexes the next `chunk` ids of the chats that predate the index and
+    commits the new position with them, so that an interrupted backfill
+    resumes where it stopped. Returns whether any chats are left.
+
+    Both statements write, so the chunk is claimed under the database write
+    lock and concurrent workers never index the same range twice.
+    """
+    try:
+        await session.execute(text(
+            "INSERT INTO chats_fts (rowid, message, members) "
+            "SELECT chats.id, chats.message, 'u' || chats.user_low || ' u' || chats.user_high FROM chats, chats_fts_backfill AS backfill "
+            "WHERE backfill.id = 1 AND chats.id > backfill.next_id "
+            "AND chats.id <= min(backfill.next_id + :chunk, backfill.last_id) "
+            "AND chats.message IS NOT NULL AND chats.message != ''"
+        ), {"chunk": chunk})
+        position = (await session.execute(text(
+            "UPDATE chats_fts_backfill SET next_id = min(next_id + :chunk, last_id) "
+            "WHERE id = 1 RETURNING next_id, last_id"
+        ), {"chunk": chunk})).first()
+        await session.commit()
+
+        return position is not None and position[0] < position[1]
+
+    except SQLAlchemyError as e:
+        await session.rollback()
+        raise HTTPException(status_code=500, detail="Database error while indexing chats") from e
@@ -0,0 +1,41 @@
+from fastapi import HTTPException
+from sqlmodel import select, delete
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.exc import SQLAlchemyError
+from db.db import SessionDep
+from models.RevokedToken import Model as RevokedToken
+from datetime import datetime, timezone
+
+async def revoke_token(token_id: str, expires_at: float, session: SessionDep):
+    try:
+        statement = insert(RevokedToken).values(
+            token_id=token_id,
+            expires_at=datetime.fromtimestamp(expires_at, timezone.utc).replace(tzinfo=None)
+        )
+        await session.execute(statement.on_conflict_do_nothing(index_elements=[RevokedToken.token_id]))
+        await session.commit()
+
+    except SQLAlchemyError as e:
+        await session.rollback()
+        raise HTTPException(status_code=500, detail="Database error while revoking token") from e
+
+async def fetch_revoked_tokens(session: SessionDep) -> dict:
+    """Returns token id -> expiry timestamp for every revoked token that has not expired yet."""
+    try:
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        rows = (await session.exec(select(RevokedToken).where(RevokedToken.expires_at > now))).all()
+        return {row.token_id: row.expires_at.replace(tzinfo=timezone.utc).timestamp() for row in rows}
+
+    except SQLAlchemyError as e:
+        raise HTTPException(status_code=500, detail="Database error while fetching revoked tokens") from e
+
+async def prune_revoked_tokens(session: SessionDep):
+    """Deletes the revoked tokens that have expired, they no longer authenticate anyway."""
+    try:
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        await session.execute(delete(RevokedToken).where(RevokedToken.expires_at <= now))
+        await session.commit()
+
+    except SQLAlchemyError as e:
+        await session.rollback()
+        raise HTTPException(status_code=500, detail="Database error while pruning revoked tokens") from e
@@ -0,0 +1,180 @@
+from fastapi import HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from models.Upload import CreateUpload, UploadStatus, UploadedFile
+from utils.file_store import safe_extension, store_file
+from utils.image_derivatives import derivatives
+from dotenv import load_dotenv
+import aiofiles
+import hashlib
+import json
+import time
+import uuid
+import os
+
+load_dotenv()
+
+UPLOAD_DIR = "uploads"
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_MB", "25")) * 1024 * 1024
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+# Uploads that received nothing for this long are removed by the upload sweeper
+UPLOAD_EXPIRY_SECONDS = float(os.getenv("UPLOAD_EXPIRY_SECONDS", str(24 * 3600)))
+
+# Running hash of uploads written front to back, so completing them does not
+# read the file again: upload_id -> (offset, sha256)
+hashers: dict = {}
+# Uploads with a chunk being written right now
+writing: set = set()
+# Uploads being moved into the file store
+completing: set = set()
+
+def _normalize(upload_id: str) -> str:
+    """The canonical form of an upload id, used for its files and as the key of `hashers`, `writing` and `completing`."""
+    try:
+        return uuid.UUID(upload_id).hex
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Upload not found")
+
+def _paths(upload_id: str):
+    return os.path.join(UPLOAD_DIR, f"{upload_id}.part"), os.path.join(UPLOAD_DIR, f"{upload_id}.json")
+
+def _load(upload_id: str, current_user: int):
+    data_path, meta_path = _paths(upload_id)
+    if not os.path.exists(meta_path):
+        raise HTTPException(status_code=404, detail="Upload not found")
+    with open(meta_path) as f:
+        meta = json.load(f)
+    if meta['owner'] != current_user:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    offset = os.path.getsize(data_path) if os.path.exists(data_path) else 0
+    return meta, data_path, meta_path, offset
+
+def cleanup_uploads() -> set:
+    """
+    Removes uploads that were started but never completed, once none of their
+    files changed for `UPLOAD_EXPIRY_SECONDS`. Returns the ids removed.
+    """
+    if not os.path.isdir(UPLOAD_DIR):
+        return set()
+    # The metadata is written once, the data file on every chunk
+    files: dict = {}
+    last_active: dict = {}
+    for name in os.listdir(UPLOAD_DIR):
+        try:
+            modified = os.path.getmtime(os.path.join(UPLOAD_DIR, name))
+        except FileNotFoundError:
+            continue
+        upload_id = name.split(".", 1)[0]
+        files.setdefault(upload_id, []).append(name)
+        last_active[upload_id] = max(modified, last_active.get(upload_id, 0))
+
+    expired = time.time() - UPLOAD_EXPIRY_SECONDS
+    removed = set()
+    for upload_id, modified in last_active.items():
+        if modified >= expired or upload_id in writing or upload_id in completing:
+            continue
+        for name in files[upload_id]:
+            try:
+                os.unlink(os.path.join(UPLOAD_DIR, name))
+            except FileNotFoundError:
+                pass
+        removed.add(upload_id)
+    return removed
+
+async def sweep_uploads():
+    """Expires idle uploads and the running hashes kept for them."""
+    removed = await run_in_threadpool(cleanup_uploads)
+    for upload_id in removed:
+        hashers.pop(upload_id, None)
+    for upload_id in list(hashers):
+        if upload_id not in writing and not os.path.exists(os.path.join(UPLOAD_DIR, f"{upload_id}.part")):
+            hashers.pop(upload_id, None)
+    return removed
+
+async def create_upload(upload_data: CreateUpload, current_user: int):
+    if upload_data.size <= 0 or upload_data.size > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=f"Uploads are limited to {MAX_UPLOAD_BYTES} bytes")
+
+    upload_id = uuid.uuid4().hex
+    data_path, meta_path = _paths(upload_id)
+    meta = {'owner': current_user, 'name': upload_data.name, 'size': upload_data.size}
+
+    async with aiofiles.open(meta_path, "w") as f:
+        await f.write(json.dumps(meta))
+    async with aiofiles.open(data_path, "wb"):
+        pass
+    hashers[upload_id] = (0, hashlib.sha256())
+
+    return UploadStatus(upload_id=upload_id, offset=0, size=upload_data.size, chunk_size=UPLOAD_CHUNK_BYTES)
+
+async def upload_status(upload_id: str, current_user: int):
+    upload_id = _normalize(upload_id)
+    meta, _, _, offset = await run_in_threadpool(_load, upload_id, current_user)
+    return UploadStatus(upload_id=upload_id, offset=offset, size=meta['size'], chunk_size=UPLOAD_CHUNK_BYTES)
+
+async def append_chunk(upload_id: str, offset: int, request: Request, current_user: int):
+    """
+    Streams the request body to the end of the upload. The body is written as
+    it arrives, so memory use stays at one network chunk whatever the file size.
+    """
+    upload_id = _normalize(upload_id)
+    meta, data_path, _, current_offset = await run_in_threadpool(_load, upload_id, current_user)
+
+    if offset != current_offset:
+        # The client resumes from the offset reported here
+        raise HTTPException(status_code=409, detail={"offset": current_offset})
+
+    if upload_id in writing or upload_id in completing:
+        raise HTTPException(status_code=409, detail={"offset": current_offset})
+    writing.add(upload_id)
+
+    hasher = hashers.get(upload_id)
+    if hasher and hasher[0] != current_offset:
+        hasher = None
+
+    written = current_offset
+    try:
+        async with aiofiles.open(data_path, "ab") as f:
+            async for chunk in request.stream():
+                if not chunk:
+                    continue
+                if written + len(chunk) > meta['size']:
+                    raise HTTPException(status_code=413, detail="Chunk runs past the declared size")
+                await f.write(chunk)
+                if hasher:
+                    hasher[1].update(chunk)
+                written += len(chunk)
+    finally:
+        writing.discard(upload_id)
+        if hasher:
+            hashers[upload_id] = (written, hasher[1])
+        else:
+            hashers.pop(upload_id, None)
+
+    return UploadStatus(upload_id=upload_id, offset=written, size=meta['size'], chunk_size=UPLOAD_CHUNK_BYTES)
+
+async def complete_upload(upload_id: str, current_user: int):
+    upload_id = _normalize(upload_id)
+    meta, data_path, meta_path, offset = await run_in_threadpool(_load, upload_id, current_user)
+
+    if offset != meta['size'] or upload_id in writing:
+        raise HTTPException(status_code=409, detail={"offset": offset})
+
+    # A second completion of the same upload waits for nothing and finds it gone
+    if upload_id in completing:
+        raise HTTPException(status_code=409, detail="Upload is being completed")
+    completing.add(upload_id)
+
+    try:
+        hasher = hashers.pop(upload_id, None)
+        digest = hasher[1].hexdigest() if hasher and hasher[0] == offset else None
+
+        # Hashing (when it was not done while streaming) and the move run off the event loop
+        name = await run_in_threadpool(store_file, data_path, safe_extension(meta['name']), digest)
+        os.unlink(meta_path)
+    finally:
+        completing.discard(upload_id)
+
+    # Thumbnails are usually ready by the time the chat referencing the file arrives
+    derivatives.schedule(name)
+
+    return UploadedFile(file=name, size=meta['size'])
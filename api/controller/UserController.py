@@ -1,123 +1,253 @@
-from fastapi import HTTPException, Depends
-from sqlmodel import select, and_, or_
+from fastapi import HTTPException, Response
+from sqlmodel import select, update, func, union, union_all
+from sqlalchemy.orm import aliased
 from sqlalchemy.exc import SQLAlchemyError
-from db.db import SessionDep
+from db.db import SessionDep, async_session
 from models.User import CreateUser, Auth, UserResponse, Model as User
-from models.Chat import Model as Chat, ChatResponse
-from utils.password_utils import hash_password, verify_password
+from models.Chat import Model as Chat
+from api.controller.ChatController import chat_responses
+from api.controller.RosterController import log_changes, roster_version, fetch_roster_changes
+from utils.password_utils import password_hasher, needs_rehash, PasswordPoolSaturated
 from utils.jwt_utils import create_access_token
-from utils.avatar import avatar
-from datetime import datetime
-import os
+from utils.avatar import avatar_name
+from utils.roster_cache import roster_cache
+from typing import Optional
+import asyncio
+import logging
 
-def create_user(user_data: CreateUser, session: SessionDep):
+logger = logging.getLogger(__name__)
+
+# Background rehashes, referenced until they finish
+rehash_tasks: set = set()
+
+def busy() -> HTTPException:
+    return HTTPException(status_code=503, detail="Server is busy, try again shortly", headers={"Retry-After": "1"})
+
+async def create_user(user_data: CreateUser, session: SessionDep):
     try:
         user_data.user_name = user_data.user_name.lower()
-        hashed_password = hash_password(user_data.hashed_password)
-        user_data.hashed_password = hashed_password
-        user = User.model_validate(user_data)
-        
-        existing_user = session.exec(select(User).where(User.user_name == user_data.user_name)).first()
+        existing_user = (await session.exec(select(User).where(User.user_name == user_data.user_name))).first()
 
         if existing_user:
             raise HTTPException(status_code=400, detail="Username is already taken")
-        
-        image_name = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}.png"
-        avatar_path = os.path.join("static/profile", image_name)
-        avatar(user_data.user_name[0].upper(), output_path=avatar_path)
 
-        user.profile_image = image_name
+        user_data.hashed_password = await password_hasher.hash(user_data.hashed_password)
+        user = User.model_validate(user_data)
+
+        # The avatar is rendered the first time it is requested, see AvatarController
+        user.profile_image = avatar_name(user_data.user_name)
 
         session.add(user)
-        session.commit()
-        session.refresh(user)
+        await session.flush()
+        log_changes([(user.id, None)], session)
+        await session.commit()
+        await session.refresh(user)
 
         user_dict = {"id": user.id, "user_name": user.user_name}
         token = create_access_token(user_dict)
 
         return {"access_token": token}
-    
+
+    except PasswordPoolSaturated as e:
+        raise busy() from e
+
+    except HTTPException:
+        raise
+
     except SQLAlchemyError as e:
-        session.rollback()
+        await session.rollback()
         raise HTTPException(status_code=500, detail="Error while creating user") from e
     
     except Exception as e:
-        session.rollback()
+        await session.rollback()
         raise HTTPException(status_code=500, detail=str(e)) from e
 
 
-def login_user(user_data: CreateUser, session: SessionDep):
+async def login_user(user_data: CreateUser, session: SessionDep):
     try:
         user_data.user_name = user_data.user_name.lower()
-        user = session.exec(select(User).where(User.user_name == user_data.user_name)).first()
+        user = (await session.exec(select(User).where(User.user_name == user_data.user_name))).first()
 
         if not user:
             raise HTTPException(status_code=400, detail="Incorrect username or password")
         
-        if not verify_password(user_data.hashed_password, user.hashed_password):
+        if not await password_hasher.verify(user_data.hashed_password, user.hashed_password):
             raise HTTPException(status_code=400, detail="Incorrect username or password")
-        
+
+        if needs_rehash(user.hashed_password) and not password_hasher.saturated():
+            # Moves the stored hash to the configured cost without delaying this login
+            task = asyncio.create_task(rehash_password(user.id, user_data.hashed_password, user.hashed_password))
+            rehash_tasks.add(task)
+            task.add_done_callback(rehash_tasks.discard)
+
         user_dict = {"id": user.id, "user_name": user.user_name}
         token = create_access_token(user_dict)
         return {"access_token": token}
-    
+
+    except PasswordPoolSaturated as e:
+        raise busy() from e
+    except HTTPException:
+        raise
     except SQLAlchemyError as e:
         raise HTTPException(status_code=500, detail="Database error during login") from e
     except Exception as e:
-        raise HTTPException(status_code=e.status_code, detail=str(e.detail)) from e
+        logger.exception("Error during login")
+        raise HTTPException(status_code=500, detail="An error occurred during login") from e
+
+async def rehash_password(user_id: int, password: str, old_hash: str):
+    try:
+        new_hash = await password_hasher.hash(password)
+        async with async_session() as session:
+            # Skipped when the password changed in the meantime
+            await session.execute(
+                update(User)
+                .where(User.id == user_id, User.hashed_password == old_hash)
+                .values(hashed_password=new_hash)
+            )
+            await session.commit()
+    except PasswordPoolSaturated:
+        pass
+    except Exception as e:
+        logger.warning("Failed to rehash password of user %s: %s", user_id, e)
 
-def fetch_users(current_user: int, session: SessionDep):
+async def fetch_users(current_user: int, session: SessionDep, status_of=None, user_ids: Optional[list] = None):
+    """
+    Returns the roster of `current_user`: every other user with the last
+    message of their conversation and the unread count, or only `user_ids`.
+    """
     try:
-        auth = session.get(User, current_user)
+        auth = await session.get(User, current_user)
 
         if not auth:
             raise HTTPException(status_code=400, detail="User not found")
 
-        fetched_users = session.exec(select(User).where(User.id != current_user)).all()
-
-        def build_response(user):
-            chats = session.exec(
-                select(Chat).where(
-                    or_(
-                        and_(Chat.sender_id == user.id, Chat.receiver_id == current_user),
-                        and_(Chat.receiver_id == user.id, Chat.sender_id == current_user)
-                    )
-                )
-            ).all()
-
-            chat_responses = [
-                ChatResponse(
-                    id=chat.id,
-                    sender_id=chat.sender_id,
-                    receiver_id=chat.receiver_id,
-                    message=chat.message,
-                    image=chat.image,
-                    uuid=chat.uuid,
-                    created_at=chat.created_at
-                ) for chat in chats
-            ] if chats else []
-
-            return UserResponse(
+        # Latest chat id per conversation, read from the two conversation indexes,
+        # and the unread count per sender, read from the receiver/status index.
+        last_ids = union_all(
+            select(Chat.user_high.label("peer_id"), func.max(Chat.id).label("last_id"))
+            .where(Chat.user_low == current_user)
+            .group_by(Chat.user_high),
+            select(Chat.user_low.label("peer_id"), func.max(Chat.id).label("last_id"))
+            .where(Chat.user_high == current_user)
+            .group_by(Chat.user_low)
+        ).subquery()
+        unread = (
+            select(Chat.sender_id.label("peer_id"), func.count().label("unread_count"))
+            .where(Chat.receiver_id == current_user, Chat.status != "read")
+            .group_by(Chat.sender_id)
+            .subquery()
+        )
+        LastChat = aliased(Chat)
+
+        rows = (await session.exec(
+            select(User, LastChat, unread.c.unread_count)
+            .outerjoin(last_ids, last_ids.c.peer_id == User.id)
+            .outerjoin(LastChat, LastChat.id == last_ids.c.last_id)
+            .outerjoin(unread, unread.c.peer_id == User.id)
+            .where(User.id != current_user, *([User.id.in_(user_ids)] if user_ids is not None else []))
+            .order_by(User.id)
+        )).all()
+        last_chats = [last_chat for _, last_chat, _ in rows if last_chat]
+        last_messages = {chat.id: chat for chat in await chat_responses(last_chats)}
+
+        return [
+            UserResponse(
                 id=user.id,
                 user_name=user.user_name,
                 profile_image=user.profile_image,
-                status=user.status,
+                status=status_of(user.id, user.status) if status_of else user.status,
                 created_at=user.created_at.isoformat(),
-                chats=chat_responses
-            )
-
-        return [build_response(user) for user in fetched_users] if fetched_users else []
+                last_message=last_messages[last_chat.id] if last_chat else None,
+                unread_count=unread_count or 0
+            ) for user, last_chat, unread_count in rows
+        ]
 
     except SQLAlchemyError as e:
-        print(str(e))
+        logger.exception("Database error while fetching users")
         raise HTTPException(status_code=500, detail="Database error while fetching users") from e
     except Exception as e:
-        print(str(e))
+        logger.exception("Error while fetching users")
         raise HTTPException(status_code=500, detail="An error occurred while fetching users") from e
     
-def auth(current_user:int, session: SessionDep):
+async def fetch_user_entries(session: SessionDep, status_of=None, user_ids: Optional[list] = None):
+    """Roster entries as seen by someone without a conversation with them, of every user or only `user_ids`."""
+    try:
+        query = select(User).order_by(User.id)
+        if user_ids is not None:
+            query = query.where(User.id.in_(user_ids))
+        users = (await session.exec(query)).all()
+
+        return [
+            UserResponse(
+                id=user.id,
+                user_name=user.user_name,
+                profile_image=user.profile_image,
+                status=status_of(user.id, user.status) if status_of else user.status,
+                created_at=user.created_at.isoformat()
+            ) for user in users
+        ]
+
+    except SQLAlchemyError as e:
+        logger.exception("Database error while fetching users")
+        raise HTTPException(status_code=500, detail="Database error while fetching users") from e
+
+async def refresh_roster(current_user: int, global_version: int, version: int, session: SessionDep, status_of=None):
+    """Brings the cached roster of `current_user` up to date, reading only the users that changed."""
+    started = roster_cache.version
+    if started < global_version:
+        changes = await fetch_roster_changes(None, started, session) if started >= 0 else None
+        if changes is None:
+            roster_cache.fill_entries(started, global_version, await fetch_user_entries(session, status_of))
+        else:
+            changed, _ = changes
+            users = await fetch_user_entries(session, status_of, list(changed)) if changed else []
+            roster_cache.patch_entries(started, global_version, users)
+
+    cached = roster_cache.viewer_version(current_user)
+    if cached is not None and cached >= version:
+        return
+    changes = await fetch_roster_changes(current_user, cached, session) if cached is not None else None
+    if changes is None:
+        roster_cache.fill_viewer(current_user, version, await fetch_users(current_user, session, status_of))
+    else:
+        ids = roster_cache.affected(current_user, *changes)
+        users = await fetch_users(current_user, session, status_of, list(ids)) if ids else []
+        roster_cache.patch_viewer(current_user, cached, version, users)
+
+async def fetch_roster(current_user: int, since: Optional[int], if_none_match: Optional[str], session: SessionDep, status_of=None):
+    """
+    Serves the roster of `current_user` from the roster cache. The version of
+    the roster is its ETag, so an unchanged roster costs three index lookups
+    and a 304. With `since`, only the users that changed after that version
+    are returned, as a `RosterDelta`.
+    """
+    global_version, version = await roster_version(current_user, session)
+    etag = f'"{current_user}.{version}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache", "X-Roster-Version": str(version)}
+
+    if if_none_match and etag in (tag.strip() for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers=headers)
+
+    try:
+        await refresh_roster(current_user, global_version, version, session, status_of)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("Error while fetching roster")
+        raise HTTPException(status_code=500, detail="An error occurred while fetching users") from e
+
+    if since is None:
+        body = roster_cache.body(current_user)
+    elif since >= version:
+        body = roster_cache.delta(current_user, version, set() if since == version else None)
+    else:
+        changes = await fetch_roster_changes(current_user, since, session)
+        body = roster_cache.delta(current_user, version, None if changes is None else (changes[0] | changes[1]))
+    return Response(content=body, media_type="application/json", headers=headers)
+
+async def auth(current_user:int, session: SessionDep):
     try:
-        user = session.get(User, current_user)
+        user = await session.get(User, current_user)
 
         if not user:
             raise HTTPException(status_code=400, detail="User not found")
@@ -133,25 +263,41 @@ def auth(current_user:int, session: SessionDep):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e)) from e
 
-def update_status(current_user: int, status: str, session: SessionDep):
+async def update_statuses(statuses: dict, session: SessionDep):
+    """
+    Persists the latest status of many users at once, one UPDATE per distinct
+    status instead of one transaction per user.
+    """
     try:
-        user = session.get(User, current_user)
+        by_status = {}
+        for user_id, status in statuses.items():
+            by_status.setdefault(status, []).append(user_id)
 
-        if not user:
-            raise HTTPException(status_code=400, detail="User not found")
+        for status, user_ids in by_status.items():
+            await session.execute(update(User).where(User.id.in_(user_ids)).values(status=status))
+        log_changes([(user_id, None) for user_id in statuses], session)
+        await session.commit()
 
-        user.status = status
-        user_data = user
-
-        user_data = user_data.model_dump(exclude_unset=True)
-        user.sqlmodel_update(user_data)
-        session.add(user)
-        session.commit()
-        session.refresh(user)
-        
         return {'Response': 'Success'}
 
     except SQLAlchemyError as e:
+        await session.rollback()
         raise HTTPException(status_code=500, detail="Database error while updating user status") from e
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e)) from e
\ No newline at end of file
+        await session.rollback()
+        raise HTTPException(status_code=500, detail=str(e)) from e
+
+async def fetch_contacts(current_user: int, session: SessionDep) -> set:
+    """Returns the ids of every user who shares a conversation with `current_user`."""
+    try:
+        rows = (await session.execute(
+            union(
+                select(Chat.user_high).where(Chat.user_low == current_user),
+                select(Chat.user_low).where(Chat.user_high == current_user)
+            )
+        )).all()
+
+        return {row[0] for row in rows if row[0] != current_user}
+
+    except SQLAlchemyError as e:
+        raise HTTPException(status_code=500, detail="Database error while fetching contacts") from e
@@ -0,0 +1,24 @@
+from fastapi import APIRouter, Query, Request
+from api.controller.AvatarController import fetch_avatar
+from typing import Optional
+
+avatar_routes = APIRouter()
+
+@avatar_routes.get(
+    "/static/profile/{name}",
+    summary="Get a profile picture",
+    description="Serves a profile picture, rendering generated avatars on first use at the requested size."
+)
+async def fetch_avatar_endpoint(request: Request, name: str, size: Optional[int] = Query(None, ge=1, le=1024)):
+    """
+    Endpoint to get a profile picture.
+
+    Args:
+        request (Request): The request, for its If-None-Match header.
+        name (str): The profile image name stored on the user.
+        size (Optional[int]): The wanted width and height in pixels, rounded up to a rendered size.
+
+    Returns:
+        The PNG image, or 304 when the client already has it.
+    """
+    return await fetch_avatar(name, size, request.headers.get("if-none-match"))
@@ -0,0 +1,67 @@
+from fastapi import APIRouter, Depends, Query
+from typing import Optional
+from models.Chat import ChatPage, ChatSearchPage
+from db.db import SessionDep
+from api.controller.ChatController import fetch_chat_history, search_chats
+from utils.jwt_utils import decode_access_token
+
+chat_routes = APIRouter()
+
+# Registered before /chats/{peer_id}, which would otherwise capture "search"
+@chat_routes.get(
+    "/chats/search",
+    response_model=ChatSearchPage,
+    summary="Search chats",
+    description="Searches the messages of the logged in user's conversations, best matches first."
+)
+async def search_chats_endpoint(
+    session: SessionDep,
+    q: str = Query(..., min_length=1, max_length=200, description="The words to search for, the last one may be a prefix"),
+    peer_id: Optional[int] = Query(None, description="Only search the conversation with this user"),
+    offset: int = Query(0, ge=0, le=1000),
+    limit: int = Query(20, ge=1, le=100),
+    token: dict = Depends(decode_access_token)
+):
+    """
+    Endpoint to search the chats of the logged in user.
+    
+    Args:
+        session (SessionDep): The database session dependency.
+        q (str): The search query.
+        peer_id (int): The other participant of the conversation to search in.
+        offset (int): The `next_offset` returned by the previous page.
+        limit (int): The maximum number of chats to return.
+        token (dict): The decoded access token.
+    
+    Returns:
+        JSON response with the matching chats and the offset of the next page.
+    """
+    return await search_chats(token['id'], q, peer_id, offset, limit, session)
+
+@chat_routes.get(
+    "/chats/{peer_id}",
+    response_model=ChatPage,
+    summary="Fetch chat history",
+    description="Retrieves one page of the conversation with another user, newest messages first."
+)
+async def fetch_chat_history_endpoint(
+    peer_id: int,
+    session: SessionDep,
+    before: Optional[int] = Query(None, description="Only return chats with an id lower than this cursor"),
+    limit: int = Query(50, ge=1, le=200),
+    token: dict = Depends(decode_access_token)
+):
+    """
+    Endpoint to page through the conversation with another user.
+    
+    Args:
+        peer_id (int): The other participant of the conversation.
+        session (SessionDep): The database session dependency.
+        before (int): The `next_before` cursor returned by the previous page.
+        limit (int): The maximum number of chats to return.
+        token (dict): The decoded access token.
+    
+    Returns:
+        JSON response with the chats in ascending order and the cursor for the next page.
+    """
+    return await fetch_chat_history(token['id'], peer_id, before, limit, session)
@@ -0,0 +1,53 @@
+from fastapi import APIRouter, Depends
+from fastapi.responses import PlainTextResponse
+from websocket.ChatWriter import chat_writer
+from utils.password_utils import password_hasher
+from utils.metrics import registry
+from utils.jwt_utils import verify_monitoring_token
+
+# Only served with the MONITORING_TOKEN bearer token, the stats reveal internals
+monitoring_routes = APIRouter(dependencies=[Depends(verify_monitoring_token)])
+
+@monitoring_routes.get(
+    "/stats/chat-writer",
+    summary="Chat writer statistics",
+    description="Reports the queue depth, batch sizes and commit latency of the chat write-behind stage."
+)
+async def chat_writer_stats_endpoint():
+    """
+    Endpoint to monitor the chat write-behind stage.
+    
+    Returns:
+        JSON response with the configuration and counters of the chat writer.
+    """
+    return chat_writer.stats()
+
+@monitoring_routes.get(
+    "/stats/password-hasher",
+    summary="Password hasher statistics",
+    description="Reports the size, load and rejections of the bcrypt process pool."
+)
+async def password_hasher_stats_endpoint():
+    """
+    Endpoint to monitor the bcrypt process pool.
+    
+    Returns:
+        JSON response with the configuration and counters of the password hasher.
+    """
+    return password_hasher.stats()
+
+
+@monitoring_routes.get(
+    "/metrics",
+    response_class=PlainTextResponse,
+    summary="Prometheus metrics",
+    description="Exposes the counters, gauges and histograms of this worker in the Prometheus text format."
+)
+async def metrics_endpoint():
+    """
+    Endpoint to scrape the runtime metrics of this worker.
+    
+    Returns:
+        Plain text response in the Prometheus exposition format.
+    """
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,116 @@
+from fastapi import APIRouter, Depends, Query
+from typing import Optional
+from models.Room import CreateRoom, RoomMembers, RoomResponse
+from models.RoomMessage import RoomMessagePage
+from db.db import SessionDep
+from api.controller.RoomController import create_room, fetch_rooms, fetch_room_messages, add_room_members, remove_room_member
+from utils.jwt_utils import decode_access_token
+
+room_routes = APIRouter()
+
+@room_routes.post(
+    "/rooms",
+    response_model=RoomResponse,
+    summary="Create a room",
+    description="Creates a group conversation owned by the logged in user, with the given members."
+)
+async def create_room_endpoint(room_data: CreateRoom, session: SessionDep, token: dict = Depends(decode_access_token)):
+    """
+    Endpoint to create a room.
+    
+    Args:
+        room_data (CreateRoom): The name of the room and the ids of its first members.
+        session (SessionDep): The database session dependency.
+        token (dict): The decoded access token.
+    
+    Returns:
+        JSON response with the created room.
+    """
+    return await create_room(room_data, token['id'], session)
+
+@room_routes.get(
+    "/rooms",
+    response_model=list[RoomResponse],
+    summary="Fetch rooms",
+    description="Retrieves the rooms of the logged in user with their last message and unread count."
+)
+async def fetch_rooms_endpoint(session: SessionDep, token: dict = Depends(decode_access_token)):
+    """
+    Endpoint to fetch the rooms of the logged in user.
+    
+    Args:
+        session (SessionDep): The database session dependency.
+        token (dict): The decoded access token.
+    
+    Returns:
+        JSON response with the list of rooms, most recently active first.
+    """
+    return await fetch_rooms(token['id'], session)
+
+@room_routes.get(
+    "/rooms/{room_id}/messages",
+    response_model=RoomMessagePage,
+    summary="Fetch room history",
+    description="Retrieves one page of the messages of a room, newest messages first."
+)
+async def fetch_room_messages_endpoint(
+    room_id: int,
+    session: SessionDep,
+    before: Optional[int] = Query(None, description="Only return messages with an id lower than this cursor"),
+    limit: int = Query(50, ge=1, le=200),
+    token: dict = Depends(decode_access_token)
+):
+    """
+    Endpoint to page through the messages of a room.
+    
+    Args:
+        room_id (int): The room to read.
+        session (SessionDep): The database session dependency.
+        before (int): The `next_before` cursor returned by the previous page.
+        limit (int): The maximum number of messages to return.
+        token (dict): The decoded access token.
+    
+    Returns:
+        JSON response with the messages in ascending order and the cursor for the next page.
+    """
+    return await fetch_room_messages(token['id'], room_id, before, limit, session)
+
+@room_routes.post(
+    "/rooms/{room_id}/members",
+    summary="Add room members",
+    description="Adds users to a room the logged in user belongs to."
+)
+async def add_room_members_endpoint(room_id: int, members: RoomMembers, session: SessionDep, token: dict = Depends(decode_access_token)):
+    """
+    Endpoint to add members to a room.
+    
+    Args:
+        room_id (int): The room to add to.
+        members (RoomMembers): The ids of the users to add.
+        session (SessionDep): The database session dependency.
+        token (dict): The decoded access token.
+    
+    Returns:
+        JSON response with the ids that were added and the new member count.
+    """
+    return await add_room_members(token['id'], room_id, members.user_ids, session)
+
+@room_routes.delete(
+    "/rooms/{room_id}/members/{user_id}",
+    summary="Remove a room member",
+    description="Leaves a room, or removes another member when the logged in user owns the room. The owner cannot leave."
+)
+async def remove_room_member_endpoint(room_id: int, user_id: int, session: SessionDep, token: dict = Depends(decode_access_token)):
+    """
+    Endpoint to remove a member from a room.
+    
+    Args:
+        room_id (int): The room to remove from.
+        user_id (int): The member to remove.
+        session (SessionDep): The database session dependency.
+        token (dict): The decoded access token.
+    
+    Returns:
+        JSON response confirming the removal.
+    """
+    return await remove_room_member(token['id'], room_id, user_id, session)
@@ -0,0 +1,84 @@
+from fastapi import APIRouter, Depends, Query, Request
+from models.Upload import CreateUpload, UploadStatus, UploadedFile
+from api.controller.UploadController import create_upload, upload_status, append_chunk, complete_upload
+from utils.jwt_utils import decode_access_token
+
+upload_routes = APIRouter()
+
+@upload_routes.post(
+    "/uploads",
+    response_model=UploadStatus,
+    summary="Start a file upload",
+    description="Opens a resumable upload for a file of the given name and size."
+)
+async def create_upload_endpoint(upload_data: CreateUpload, token: dict = Depends(decode_access_token)):
+    """
+    Endpoint to start a resumable upload.
+    
+    Args:
+        upload_data (CreateUpload): The file name and its size in bytes.
+        token (dict): The decoded access token.
+    
+    Returns:
+        JSON response with the upload id and the offset to write from.
+    """
+    return await create_upload(upload_data, token['id'])
+
+@upload_routes.get(
+    "/uploads/{upload_id}",
+    response_model=UploadStatus,
+    summary="Fetch an upload",
+    description="Reports how many bytes of an upload have been received, to resume it after an interruption."
+)
+async def upload_status_endpoint(upload_id: str, token: dict = Depends(decode_access_token)):
+    """
+    Endpoint to fetch the progress of an upload.
+    
+    Args:
+        upload_id (str): The upload id returned when the upload was started.
+        token (dict): The decoded access token.
+    
+    Returns:
+        JSON response with the offset to resume from.
+    """
+    return await upload_status(upload_id, token['id'])
+
+@upload_routes.put(
+    "/uploads/{upload_id}",
+    response_model=UploadStatus,
+    summary="Upload a chunk",
+    description="Appends the raw request body to the upload. The offset must match the bytes received so far."
+)
+async def append_chunk_endpoint(upload_id: str, request: Request, offset: int = Query(..., ge=0), token: dict = Depends(decode_access_token)):
+    """
+    Endpoint to append a chunk to an upload.
+    
+    Args:
+        upload_id (str): The upload id returned when the upload was started.
+        request (Request): The request, whose body is the chunk.
+        offset (int): The position of the chunk in the file.
+        token (dict): The decoded access token.
+    
+    Returns:
+        JSON response with the new offset.
+    """
+    return await append_chunk(upload_id, offset, request, token['id'])
+
+@upload_routes.post(
+    "/uploads/{upload_id}/complete",
+    response_model=UploadedFile,
+    summary="Complete an upload",
+    description="Stores the uploaded file under its content hash and returns the name to cite in a chat message."
+)
+async def complete_upload_endpoint(upload_id: str, token: dict = Depends(decode_access_token)):
+    """
+    Endpoint to complete an upload.
+    
+    Args:
+        upload_id (str): The upload id returned when the upload was started.
+        token (dict): The decoded access token.
+    
+    Returns:
+        JSON response with the stored file name.
+    """
+    return await complete_upload(upload_id, token['id'])
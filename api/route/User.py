@@ -1,8 +1,12 @@
-from fastapi import APIRouter, Depends
-from models.User import CreateUser, UserResponse, Auth
+from fastapi import APIRouter, Depends, Security, Request, Query
+from fastapi.security import HTTPAuthorizationCredentials
+from models.User import CreateUser, UserResponse, RosterDelta, Auth
 from db.db import SessionDep
-from api.controller.UserController import create_user, login_user, fetch_users, auth
-from utils.jwt_utils import decode_access_token
+from api.controller.UserController import create_user, login_user, fetch_roster, auth
+from utils.jwt_utils import decode_access_token, auth_scheme
+from websocket.Presence import presence
+from websocket.Denylist import denylist
+from typing import Optional, Union
 
 user_routes = APIRouter()
 
@@ -11,7 +15,7 @@ user_routes = APIRouter()
     summary="Register a new user", 
     description="Creates a new user account using the provided registration details."
 )
-def create_user_endpoint(user_data: CreateUser, session: SessionDep):
+async def create_user_endpoint(user_data: CreateUser, session: SessionDep):
     """
     Endpoint to register a new user.
     
@@ -22,14 +26,14 @@ def create_user_endpoint(user_data: CreateUser, session: SessionDep):
     Returns:
         JSON response with the created user details.
     """
-    return create_user(user_data, session)
+    return await create_user(user_data, session)
 
 @user_routes.post(
     "/users/login", 
     summary="Login user", 
     description="Authenticates a user with their credentials and provides an access token."
 )
-def login_user_endpoint(user_data: CreateUser, session: SessionDep):
+async def login_user_endpoint(user_data: CreateUser, session: SessionDep):
     """
     Endpoint to login a user.
     
@@ -40,7 +44,29 @@ def login_user_endpoint(user_data: CreateUser, session: SessionDep):
     Returns:
         JSON response with the access token.
     """
-    return login_user(user_data, session)
+    return await login_user(user_data, session)
+
+@user_routes.post(
+    "/users/logout",
+    summary="Logout user",
+    description="Revokes the access token used for this request."
+)
+async def logout_user_endpoint(
+    token: dict = Depends(decode_access_token),
+    credentials: HTTPAuthorizationCredentials = Security(auth_scheme)
+):
+    """
+    Endpoint to logout a user.
+    
+    Args:
+        token (dict): The decoded access token.
+        credentials (HTTPAuthorizationCredentials): The raw access token.
+    
+    Returns:
+        JSON response confirming the logout.
+    """
+    await denylist.revoke(credentials.credentials, token)
+    return {'Response': 'Success'}
 
 @user_routes.get(
     "/users/me", 
@@ -48,7 +74,7 @@ def login_user_endpoint(user_data: CreateUser, session: SessionDep):
     summary="Fetch the logged in user", 
     description="Retrieves the details of the currently logged in user."
 )
-def auth_endpoint(session: SessionDep, token: dict = Depends(decode_access_token)):
+async def auth_endpoint(session: SessionDep, token: dict = Depends(decode_access_token)):
     """
     Endpoint to fetch the currently logged in user.
     
@@ -59,22 +85,30 @@ def auth_endpoint(session: SessionDep, token: dict = Depends(decode_access_token
     Returns:
         JSON response with the authenticated user details.
     """
-    return auth(token['id'], session)
+    return await auth(token['id'], session)
 
 @user_routes.get(
     "/users", 
-    response_model=list[UserResponse], 
+    response_model=Union[list[UserResponse], RosterDelta], 
     summary="Fetch all users", 
-    description="Retrieves a list of all registered users."
+    description="Retrieves a list of all registered users, or with `since` only the users that changed after that roster version. Supports If-None-Match."
 )
-def fetch_all_users_endpoint(session: SessionDep, token: dict = Depends(decode_access_token)):
+async def fetch_all_users_endpoint(
+    request: Request,
+    session: SessionDep,
+    since: Optional[int] = Query(None, description="Roster version, from the X-Roster-Version header of an earlier response"),
+    token: dict = Depends(decode_access_token)
+):
     """
     Endpoint to fetch all registered users.
     
     Args:
+        request (Request): The request, for its If-None-Match header.
         session (SessionDep): The database session dependency.
+        since (Optional[int]): Roster version the client already has.
     
     Returns:
-        JSON response with the list of all users.
+        JSON response with the list of all users, or the changes since `since`.
     """
-    return fetch_users(token['id'], session)
+    # Statuses are written to the database lazily, the tracker has the live ones
+    return await fetch_roster(token['id'], since, request.headers.get("if-none-match"), session, presence.status_of)
@@ -0,0 +1,528 @@
+"""
+Websocket load benchmark.
+
+Starts the app in a subprocess against a temporary database, seeds it with
+users and chat history, connects simulated clients that chat, type, ping and
+ack, and writes a JSON report (throughput, latency percentiles, event loop
+lag and memory over time) that can be compared between versions.
+
+    python -m bench.websocket_load --users 2000 --messages 200000 --clients 1000 --duration 60 --output before.json
+
+Run it from the repository root. The clients share one process and one core
+with nothing else, keep an eye on `client_loop_lag_ms` in the report: when it
+grows the benchmark measures itself rather than the server. The server's own
+loop lag (`server_loop_lag_mean_ms`, `server_loop_lag_max_ms`) is scraped
+from its /metrics at every sample.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timezone
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The server and the token minting below must agree on these
+BENCH_ENV = {
+    "SECRET_KEY": "benchmark-secret-key-benchmark-secret-key",
+    "ALGORITHM": "HS256",
+    "ACCESS_TOKEN_EXPIRE_MINUTES": "1",
+    "BCRYPT_ROUNDS": "4",
+    "MONITORING_TOKEN": "benchmark-monitoring-token",
+}
+
+def percentiles(values: list) -> dict:
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+    pick = lambda q: round(values[min(len(values) - 1, int(q * len(values)))] * 1000, 3)
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values) * 1000, 3),
+        "p50": pick(0.50),
+        "p99": pick(0.99),
+        "p999": pick(0.999),
+        "max": round(values[-1] * 1000, 3),
+    }
+
+def server_lag_delta(before, after) -> tuple:
+    """
+    Mean and max server loop lag in ms between two scrapes of the histogram.
+    The max is the upper bound of the bucket the slowest wake up fell in, or
+    the largest finite bound when it was slower still.
+    """
+    if before is None or after is None or after[2] <= before[2]:
+        return None, None
+    buckets, total, count = after
+    mean = (total - before[1]) / (count - before[2])
+    bounds = sorted(buckets)
+    finite = [bound for bound in bounds if bound != float("inf")]
+    worst = next(bound for bound in bounds if buckets[bound] - before[0].get(bound, 0) == count - before[2])
+    return round(mean * 1000, 2), round(min(worst, finite[-1]) * 1000, 2)
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return None
+
+def seed(users: int, messages: int) -> list:
+    """
+    Creates the schema in the current directory and bulk inserts `users` users
+    and `messages` chats between random pairs. Returns (user_id, token) pairs.
+    """
+    from sqlalchemy import insert
+    from db.db import engine, create_db_and_tables
+    from models.User import Model as User
+    from models.Chat import Model as Chat, conversation_key
+    from utils.password_utils import hash_password
+    from utils.jwt_utils import create_access_token
+    from utils.avatar import avatar_name
+
+    create_db_and_tables()
+    hashed_password = hash_password("benchmark")
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+
+    with engine.begin() as conn:
+        conn.execute(insert(User), [
+            {
+                "user_name": f"bench{i}",
+                "hashed_password": hashed_password,
+                "profile_image": avatar_name(f"bench{i}"),
+                "status": "Offline",
+                "inbox_seq": 0,
+                "created_at": now,
+                "updated_at": now,
+            } for i in range(users)
+        ])
+        user_ids = [row[0] for row in conn.exec_driver_sql("SELECT id FROM users ORDER BY id")]
+
+        for start in range(0, messages, 10000):
+            rows = []
+            for _ in range(min(10000, messages - start)):
+                sender_id, receiver_id = random.sample(user_ids, 2)
+                user_low, user_high = conversation_key(sender_id, receiver_id)
+                rows.append({
+                    "sender_id": sender_id,
+                    "receiver_id": receiver_id,
+                    "user_low": user_low,
+                    "user_high": user_high,
+                    "message": f"seeded message {uuid.uuid4().hex[:12]}",
+                    "uuid": uuid.uuid4().hex,
+                    "status": random.choice(("sent", "delivered", "read")),
+                    "created_at": now,
+                    "updated_at": now,
+                })
+            conn.execute(insert(Chat), rows)
+
+    return [(user_id, create_access_token({"id": user_id, "user_name": f"bench{i}"})) for i, user_id in enumerate(user_ids)]
+
+class Stats:
+    def __init__(self):
+        self.recording = False
+        self.sent_at: dict = {}
+        self.delivery: list = []
+        self.confirm: list = []
+        self.ping: list = []
+        self.users_api: list = []
+        self.counts = {"sent": 0, "delivered": 0, "confirmed": 0, "typing": 0, "acks": 0, "frames": 0, "errors": 0}
+
+    def count(self, name: str, n: int = 1):
+        if self.recording:
+            self.counts[name] += n
+
+    def observe(self, series: list, seconds: float):
+        if self.recording:
+            series.append(seconds)
+
+class Client:
+    """One simulated user: chats with random connected peers, types first sometimes, pings and acks."""
+
+    def __init__(self, bench, user_id: int, token: str):
+        self.bench = bench
+        self.user_id = user_id
+        self.token = token
+        self.ws = None
+        self.ping_sent = None
+
+    def encode(self, payload: dict):
+        if self.bench.codec == "msgpack":
+            return self.bench.msgpack.packb(payload)
+        return json.dumps(payload)
+
+    def decode(self, frame) -> dict:
+        if frame == "pong" or frame == b"pong":
+            return {"type": "pong"}
+        if isinstance(frame, bytes):
+            return self.bench.msgpack.unpackb(frame, raw=False)
+        return json.loads(frame)
+
+    async def connect(self):
+        from websockets.asyncio.client import connect
+        protocols = ["bearer", self.token] + (["msgpack"] if self.bench.codec == "msgpack" else [])
+        self.ws = await connect(
+            f"ws://127.0.0.1:{self.bench.port}/ws/{self.user_id}",
+            subprotocols=protocols,
+            max_queue=None,
+            ping_interval=None,
+        )
+
+    async def run(self):
+        reader = asyncio.create_task(self.read())
+        rate = self.bench.args.rate
+        next_ping = time.monotonic() + random.uniform(0, self.bench.args.ping_interval)
+        try:
+            while True:
+                await asyncio.sleep(random.expovariate(rate) if rate > 0 else 3600)
+                peer = random.choice(self.bench.clients)
+                if peer is self:
+                    continue
+
+                if random.random() < self.bench.args.typing_ratio:
+                    await self.ws.send(self.encode({"type": "typing", "sender_id": self.user_id, "receiver_id": peer.user_id}))
+                    self.bench.stats.count("typing")
+
+                chat_uuid = uuid.uuid4().hex
+                self.bench.stats.sent_at[chat_uuid] = time.monotonic()
+                await self.ws.send(self.encode({
+                    "type": "chat",
+                    "sender_id": self.user_id,
+                    "receiver_id": peer.user_id,
+                    "message": "benchmark message",
+                    "uuid": chat_uuid,
+                    "created_at": datetime.now(timezone.utc).isoformat(),
+                }))
+                self.bench.stats.count("sent")
+
+                if time.monotonic() >= next_ping and self.ping_sent is None:
+                    self.ping_sent = time.monotonic()
+                    await self.ws.send(b"ping" if self.bench.codec == "msgpack" else "ping")
+                    next_ping = self.ping_sent + self.bench.args.ping_interval
+        except Exception:
+            self.bench.stats.count("errors")
+        finally:
+            reader.cancel()
+
+    async def read(self):
+        stats = self.bench.stats
+        try:
+            async for frame in self.ws:
+                now = time.monotonic()
+                event = self.decode(frame)
+                stats.count("frames")
+                kind = event.get("type")
+
+                if kind == "chat":
+                    sent_at = stats.sent_at.get(event.get("uuid"))
+                    if sent_at is not None:
+                        stats.observe(stats.delivery, now - sent_at)
+                        stats.count("delivered")
+                elif kind == "msg_update":
+                    sent_at = stats.sent_at.get(event.get("uuid"))
+                    if sent_at is not None:
+                        stats.observe(stats.confirm, now - sent_at)
+                        stats.count("confirmed")
+                elif kind == "pong" and self.ping_sent is not None:
+                    stats.observe(stats.ping, now - self.ping_sent)
+                    self.ping_sent = None
+
+                if "message_id" in event:
+                    ack = {"type": "ack", "message_id": event["message_id"]}
+                    if "seq" in event:
+                        ack["seq"] = event["seq"]
+                    await self.ws.send(self.encode(ack))
+                    stats.count("acks")
+        except Exception:
+            pass
+
+class Benchmark:
+    def __init__(self, args):
+        self.args = args
+        self.codec = args.codec
+        self.msgpack = None
+        if self.codec == "msgpack":
+            import msgpack
+            self.msgpack = msgpack
+        self.port = args.port or free_port()
+        self.stats = Stats()
+        self.clients: list = []
+        self.server = None
+        self.timeseries: list = []
+        self.loop_lag_max = 0.0
+
+    def start_server(self):
+        env = {**os.environ, **BENCH_ENV, "PYTHONPATH": REPO_DIR, "MESSAGE_BUS": "local"}
+        self.server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--port", str(self.port), "--log-level", "warning"],
+            cwd=os.getcwd(), env=env, stdout=subprocess.DEVNULL if not self.args.server_output else None,
+            stderr=subprocess.DEVNULL if not self.args.server_output else None,
+        )
+
+    async def wait_for_server(self):
+        import httpx
+        async with httpx.AsyncClient() as client:
+            for _ in range(300):
+                if self.server.poll() is not None:
+                    raise RuntimeError("The server exited during startup")
+                try:
+                    if (await client.get(f"http://127.0.0.1:{self.port}/openapi.json")).status_code == 200:
+                        return
+                except httpx.HTTPError:
+                    pass
+                await asyncio.sleep(0.1)
+        raise RuntimeError("The server did not start")
+
+    def server_memory_mb(self):
+        try:
+            with open(f"/proc/{self.server.pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return round(int(line.split()[1]) / 1024, 1)
+        except OSError:
+            return None
+
+    def server_cpu_seconds(self):
+        try:
+            with open(f"/proc/{self.server.pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        except OSError:
+            return None
+
+    async def watch_loop_lag(self):
+        # How late this process wakes up, i.e. whether the clients keep up
+        interval = 0.05
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(interval)
+            self.loop_lag_max = max(self.loop_lag_max, time.monotonic() - started - interval)
+
+    async def server_loop_lag(self, client):
+        """The server's `vetra_event_loop_lag_seconds` histogram: cumulative bucket counts by bound, sum and count."""
+        import httpx
+        try:
+            response = await client.get("/metrics", headers={"Authorization": f"Bearer {BENCH_ENV['MONITORING_TOKEN']}"})
+            response.raise_for_status()
+        except httpx.HTTPError:
+            return None
+        buckets, total, count = {}, 0.0, 0
+        for line in response.text.splitlines():
+            if not line.startswith("vetra_event_loop_lag_seconds"):
+                continue
+            name, value = line.rsplit(" ", 1)
+            if name.startswith("vetra_event_loop_lag_seconds_bucket"):
+                buckets[float(name.split('le="', 1)[1].split('"', 1)[0])] = int(float(value))
+            elif name == "vetra_event_loop_lag_seconds_sum":
+                total = float(value)
+            elif name == "vetra_event_loop_lag_seconds_count":
+                count = int(float(value))
+        return buckets, total, count
+
+    async def sample(self):
+        import httpx
+        interval = self.args.sample_interval
+        started = time.monotonic()
+        last_counts = dict(self.stats.counts)
+        last_ping = 0
+        last_cpu = self.server_cpu_seconds()
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{self.port}", timeout=30) as client:
+            last_lag = await self.server_loop_lag(client)
+            while True:
+                await asyncio.sleep(interval)
+                counts = dict(self.stats.counts)
+                pings = self.stats.ping[last_ping:]
+                last_ping = len(self.stats.ping)
+                cpu = self.server_cpu_seconds()
+                lag = await self.server_loop_lag(client)
+                lag_mean, lag_max = server_lag_delta(last_lag, lag)
+
+                self.timeseries.append({
+                    "t": round(time.monotonic() - started, 2),
+                    "connected": len(self.clients),
+                    "sent_per_s": round((counts["sent"] - last_counts["sent"]) / interval, 1),
+                    "delivered_per_s": round((counts["delivered"] - last_counts["delivered"]) / interval, 1),
+                    "ping_rtt_p50_ms": percentiles(pings).get("p50"),
+                    "server_rss_mb": self.server_memory_mb(),
+                    "server_cpu_percent": round((cpu - last_cpu) / interval * 100, 1) if cpu is not None and last_cpu is not None else None,
+                    "server_loop_lag_mean_ms": lag_mean,
+                    "server_loop_lag_max_ms": lag_max,
+                    "client_loop_lag_ms": round(self.loop_lag_max * 1000, 2),
+                })
+                last_counts, last_cpu, last_lag, self.loop_lag_max = counts, cpu, lag, 0.0
+
+    async def poll_users(self, tokens: list):
+        """Clients poll /users, its latency grows with the number of users and messages."""
+        import httpx
+        if self.args.users_rps <= 0:
+            return
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{self.port}", timeout=30) as client:
+            while True:
+                await asyncio.sleep(random.expovariate(self.args.users_rps))
+                _, token = random.choice(tokens)
+                started = time.monotonic()
+                try:
+                    response = await client.get("/users", headers={"Authorization": f"Bearer {token}"})
+                    response.raise_for_status()
+                    self.stats.observe(self.stats.users_api, time.monotonic() - started)
+                except httpx.HTTPError:
+                    self.stats.count("errors")
+
+    async def connect_clients(self, users: list):
+        gate = asyncio.Semaphore(self.args.connect_concurrency)
+
+        async def connect(user_id, token):
+            client = Client(self, user_id, token)
+            async with gate:
+                try:
+                    await client.connect()
+                except Exception:
+                    self.stats.counts["errors"] += 1
+                    return None
+            return client
+
+        started = time.monotonic()
+        connected = await asyncio.gather(*(connect(user_id, token) for user_id, token in users))
+        self.clients = [client for client in connected if client is not None]
+        return time.monotonic() - started
+
+    async def run(self, users: list) -> dict:
+        self.start_server()
+        background = []
+        try:
+            await self.wait_for_server()
+            background.append(asyncio.create_task(self.watch_loop_lag()))
+            background.append(asyncio.create_task(self.sample()))
+
+            connect_seconds = await self.connect_clients(users[:self.args.clients])
+            print(f"Connected {len(self.clients)} clients in {connect_seconds:.1f}s", file=sys.stderr)
+
+            background.append(asyncio.create_task(self.poll_users(users)))
+            background.extend(asyncio.create_task(client.run()) for client in self.clients)
+
+            await asyncio.sleep(self.args.warmup)
+            self.stats.recording = True
+            measured_from = time.monotonic()
+            await asyncio.sleep(self.args.duration)
+            self.stats.recording = False
+            measured = time.monotonic() - measured_from
+        finally:
+            for task in background:
+                task.cancel()
+            await asyncio.gather(*background, return_exceptions=True)
+            await asyncio.gather(*(client.ws.close() for client in self.clients if client.ws), return_exceptions=True)
+            self.stop_server()
+
+        counts = self.stats.counts
+        return {
+            "revision": git_revision(),
+            "config": vars(self.args),
+            "connect_seconds": round(connect_seconds, 2),
+            "measured_seconds": round(measured, 2),
+            "throughput": {
+                "sent_per_s": round(counts["sent"] / measured, 1),
+                "delivered_per_s": round(counts["delivered"] / measured, 1),
+                "frames_per_s": round(counts["frames"] / measured, 1),
+            },
+            "latency_ms": {
+                "delivery": percentiles(self.stats.delivery),
+                "sender_confirm": percentiles(self.stats.confirm),
+                "ping_rtt": percentiles(self.stats.ping),
+                "users_api": percentiles(self.stats.users_api),
+            },
+            "counts": counts,
+            "server": {
+                "peak_rss_mb": max((s["server_rss_mb"] or 0 for s in self.timeseries), default=None),
+                "peak_loop_lag_ms": max((s["server_loop_lag_max_ms"] or 0 for s in self.timeseries), default=None),
+            },
+            "timeseries": self.timeseries,
+        }
+
+    def stop_server(self):
+        if self.server is None or self.server.poll() is not None:
+            return
+        # SIGINT lets the lifespan shut down cleanly
+        self.server.send_signal(signal.SIGINT)
+        try:
+            self.server.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            self.server.kill()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Websocket load benchmark for the chat server.")
+    parser.add_argument("--users", type=int, default=1000, help="users to seed")
+    parser.add_argument("--messages", type=int, default=50000, help="chat history to seed")
+    parser.add_argument("--clients", type=int, default=500, help="simulated websocket clients, at most --users")
+    parser.add_argument("--duration", type=float, default=30, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=5, help="seconds of traffic before measuring")
+    parser.add_argument("--rate", type=float, default=0.5, help="chats per second per client")
+    parser.add_argument("--typing-ratio", type=float, default=0.5, help="share of chats preceded by a typing indicator")
+    parser.add_argument("--ping-interval", type=float, default=10, help="seconds between pings of a client")
+    parser.add_argument("--users-rps", type=float, default=2, help="GET /users requests per second")
+    parser.add_argument("--codec", choices=("json", "msgpack"), default="json")
+    parser.add_argument("--connect-concurrency", type=int, default=100)
+    parser.add_argument("--sample-interval", type=float, default=1)
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary directory and database")
+    parser.add_argument("--server-output", action="store_true", help="show the server's logs")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    args.clients = min(args.clients, args.users)
+
+    # Room for thousands of sockets on both ends
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    os.environ.update(BENCH_ENV)
+    sys.path.insert(0, REPO_DIR)
+    output_path = os.path.abspath(args.output) if args.output else None
+    workdir = tempfile.mkdtemp(prefix="vetra-bench-")
+    # The app keeps its database and files relative to the working directory
+    os.chdir(workdir)
+    try:
+        started = time.monotonic()
+        users = seed(args.users, args.messages)
+        print(f"Seeded {args.users} users and {args.messages} messages in {time.monotonic() - started:.1f}s", file=sys.stderr)
+
+        report = asyncio.run(Benchmark(args).run(users))
+        output = json.dumps(report, indent=2)
+        if output_path:
+            with open(output_path, "w") as f:
+                f.write(output)
+        else:
+            print(output)
+
+        delivery = report["latency_ms"]["delivery"]
+        print(
+            f"{report['throughput']['delivered_per_s']} msg/s delivered, "
+            f"p50 {delivery.get('p50')} ms, p99 {delivery.get('p99')} ms, p999 {delivery.get('p999')} ms",
+            file=sys.stderr
+        )
+    finally:
+        if args.keep:
+            print(f"Kept {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
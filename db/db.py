@@ -1,24 +1,79 @@
+import time
 from typing import Annotated
 
 from fastapi import Depends
-from sqlmodel import Session, SQLModel, create_engine
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlmodel import create_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
 from models.Chat import Model
 from models.User import Model
+from models.Inbox import Model
+from models.ConnectionRoute import Model
+from models.RevokedToken import Model
+from models.RosterChange import Model
+from models.Room import Model
+from models.RoomMember import Model
+from models.RoomMessage import Model
+from db.migrations import run_migrations
+from utils.metrics import registry
 
 sqlite_file_name = "database.db"
 sqlite_url = f"sqlite:///{sqlite_file_name}"
+async_sqlite_url = f"sqlite+aiosqlite:///{sqlite_file_name}"
 
 connect_args = {"check_same_thread": False}
+
+# The synchronous engine is only used for migrations at startup
 engine = create_engine(sqlite_url, connect_args=connect_args)
 
+# Request handlers and the websocket loop borrow short-lived sessions from this pool
+async_engine = create_async_engine(async_sqlite_url, connect_args=connect_args, pool_size=5, max_overflow=10)
+async_session = async_sessionmaker(async_engine, class_=AsyncSession, expire_on_commit=False)
+
+
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    # WAL lets readers proceed while a message is being committed
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.close()
+
+
+event.listen(engine, "connect", set_sqlite_pragma)
+event.listen(async_engine.sync_engine, "connect", set_sqlite_pragma)
+
+
+statement_seconds = registry.histogram(
+    "vetra_db_statement_seconds", "Time spent executing SQL statements.", labels=("operation",)
+)
+commit_seconds = registry.histogram("vetra_db_commit_seconds", "Time spent committing chat batches.")
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._query_started = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, "_query_started", None)
+    if started is not None:
+        operation = statement.lstrip()[:6].upper()
+        statement_seconds.labels(operation).observe(time.perf_counter() - started)
+
+
+# Only the request and websocket traffic is measured, not the migrations
+event.listen(async_engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+event.listen(async_engine.sync_engine, "after_cursor_execute", after_cursor_execute)
+
 
 def create_db_and_tables():
-    SQLModel.metadata.create_all(engine)
+    run_migrations(engine)
 
 
-def get_session():
-    with Session(engine) as session:
+async def get_session():
+    async with async_session() as session:
         yield session
 
 
-SessionDep = Annotated[Session, Depends(get_session)]
+SessionDep = Annotated[AsyncSession, Depends(get_session)]
@@ -0,0 +1,152 @@
+"""
+Versioned schema migrations for the SQLite database.
+
+The version of the schema is kept in `PRAGMA user_version`. A fresh database is
+created straight from the models and stamped with the latest version, an
+existing one gets every pending migration applied in order, each in its own
+transaction so that an interrupted upgrade resumes where it stopped.
+"""
+from datetime import datetime, timezone
+from sqlalchemy import inspect
+from sqlalchemy.engine import Connection, Engine
+from sqlmodel import SQLModel
+import logging
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS = []
+
+def migration(version: int):
+    def register(func):
+        MIGRATIONS.append((version, func))
+        return func
+    return register
+
+def latest_version() -> int:
+    return max(version for version, _ in MIGRATIONS)
+
+def get_version(connection: Connection) -> int:
+    return connection.exec_driver_sql("PRAGMA user_version").scalar()
+
+def set_version(connection: Connection, version: int):
+    connection.exec_driver_sql(f"PRAGMA user_version = {int(version)}")
+
+def columns(connection: Connection, table: str) -> set:
+    return {row[1] for row in connection.exec_driver_sql(f"PRAGMA table_info({table})")}
+
+def create_search_index(connection: Connection):
+    """
+    Full-text index of the chat messages. It is contentless, the text is read
+    from `chats` by rowid, and `members` holds the two participants as `u<id>`
+    tokens so that a search is restricted to the caller's conversations inside
+    the index itself.
+
+    `chats_fts_backfill` tracks the chats that existed before the index, those
+    up to `last_id` are indexed in the background from `next_id` onwards.
+    """
+    connection.exec_driver_sql(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS chats_fts USING fts5("
+        "message, members, content='', tokenize='unicode61 remove_diacritics 2')"
+    )
+    connection.exec_driver_sql(
+        "CREATE TABLE IF NOT EXISTS chats_fts_backfill ("
+        "id INTEGER PRIMARY KEY CHECK (id = 1), next_id INTEGER NOT NULL, last_id INTEGER NOT NULL)"
+    )
+    connection.exec_driver_sql(
+        "INSERT OR IGNORE INTO chats_fts_backfill (id, next_id, last_id) SELECT 1, 0, coalesce(max(id), 0) FROM chats"
+    )
+
+def run_migrations(engine: Engine):
+    with engine.begin() as connection:
+        fresh = not inspect(connection).has_table("chats")
+        version = get_version(connection)
+
+    if fresh:
+        SQLModel.metadata.create_all(engine)
+        with engine.begin() as connection:
+            create_search_index(connection)
+            set_version(connection, latest_version())
+        return
+
+    for migration_version, func in sorted(MIGRATIONS, key=lambda item: item[0]):
+        if migration_version <= version:
+            continue
+        with engine.begin() as connection:
+            func(connection)
+            set_version(connection, migration_version)
+        logger.info("Applied database migration %s: %s", migration_version, func.__name__)
+
+    # Tables introduced after the database was created
+    SQLModel.metadata.create_all(engine)
+
+
+def _sortable_timestamp(value):
+    """Normalizes the free-form date strings of old rows into naive UTC timestamps."""
+    if value is None:
+        return None
+    try:
+        parsed = datetime.fromisoformat(str(value).strip())
+    except ValueError:
+        return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed.strftime("%Y-%m-%d %H:%M:%S.%f")
+
+
+@migration(1)
+def chat_conversation_key(connection: Connection):
+    existing = columns(connection, "chats")
+
+    # The model gained `status` one change before the migrations existed, a
+    # database created earlier has no such column until this runs
+    if "status" not in existing:
+        connection.exec_driver_sql("ALTER TABLE chats ADD COLUMN status VARCHAR NOT NULL DEFAULT 'sent'")
+    if "user_low" not in existing:
+        connection.exec_driver_sql("ALTER TABLE chats ADD COLUMN user_low INTEGER NOT NULL DEFAULT 0")
+        connection.exec_driver_sql("ALTER TABLE chats ADD COLUMN user_high INTEGER NOT NULL DEFAULT 0")
+
+    connection.exec_driver_sql(
+        "UPDATE chats SET user_low = min(sender_id, receiver_id), user_high = max(sender_id, receiver_id)"
+    )
+
+    # Rewrite the string dates in chunks so that the rows stay sortable by time
+    last_id = 0
+    while True:
+        rows = connection.exec_driver_sql(
+            "SELECT id, created_at, updated_at FROM chats WHERE id > ? ORDER BY id LIMIT 5000", (last_id,)
+        ).all()
+        if not rows:
+            break
+        updates = []
+        for chat_id, created_at, updated_at in rows:
+            created = _sortable_timestamp(created_at)
+            updated = _sortable_timestamp(updated_at)
+            fallback = created or updated or "1970-01-01 00:00:00.000000"
+            updates.append((created or fallback, updated or fallback, chat_id))
+        connection.exec_driver_sql(
+            "UPDATE chats SET created_at = ?, updated_at = ? WHERE id = ?",
+            updates
+        )
+        last_id = rows[-1][0]
+
+    connection.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_chats_conversation ON chats (user_low, user_high, id)"
+    )
+    connection.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_chats_conversation_high ON chats (user_high, user_low, id)"
+    )
+    connection.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_chats_receiver_status ON chats (receiver_id, status, sender_id)"
+    )
+
+
+@migration(2)
+def user_inbox_sequence(connection: Connection):
+    if "inbox_seq" not in columns(connection, "users"):
+        connection.exec_driver_sql("ALTER TABLE users ADD COLUMN inbox_seq INTEGER NOT NULL DEFAULT 0")
+
+
+@migration(3)
+def chat_search_index(connection: Connection):
+    # Only creates the index, the existing chats are indexed by the server in chunks
+    create_search_index(connection)
@@ -1,18 +1,52 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
-from fastapi.staticfiles import StaticFiles
 from contextlib import asynccontextmanager
 from fastapi.middleware.cors import CORSMiddleware
-from db.db import create_db_and_tables
-from db.db import SessionDep
-from api.route import User
+from db.db import create_db_and_tables, async_engine, async_session
+from api.route import User, Chat, Upload, Monitoring, Avatar, Room
+from api.controller.UploadController import cleanup_uploads
+from api.controller.RoomController import insert_room_message
 import os
-import json
-from datetime import datetime
 import base64
-from websocket.ConnectionManager import ConnectionManager
-from api.controller.ChatController import insert_chat
-import aiofiles
+from websocket.ConnectionManager import ConnectionManager, frame_bytes
+from websocket.Presence import presence
+from websocket.ChatWriter import chat_writer
+from websocket.Denylist import denylist
+from websocket.Receipts import receipts
+from websocket.Codec import OutboundEvent, negotiate, receive_frame, is_ping
+from fastapi.concurrency import run_in_threadpool
+from utils.file_store import is_stored_name, safe_extension, store_bytes
+from utils.media_files import MediaFiles
+from utils.image_derivatives import derivatives
+from utils.password_utils import password_hasher
+from utils.search_backfill import search_backfill
+from utils.roster_cache import roster_cache
+from utils.upload_sweeper import upload_sweeper
+from utils.jwt_utils import token_cache, websocket_token
+from utils.logging_utils import configure_logging
+from utils.metrics import registry, loop_monitor
 import asyncio
+from typing import Optional
+import logging
+import time
+
+configure_logging()
+logger = logging.getLogger(__name__)
+
+inbound_frame_bytes = frame_bytes.labels("in")
+chat_seconds = registry.histogram("vetra_chat_seconds", "Time from receiving a chat to handing its deliveries to the connections.")
+
+# The loop only keeps weak references to tasks, these are held until they finish
+background_tasks: set = set()
+
+def run_in_background(coroutine):
+    task = asyncio.create_task(coroutine)
+    background_tasks.add(task)
+    task.add_done_callback(_background_done)
+
+def _background_done(task: asyncio.Task):
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Background task %s failed", task.get_coro().__qualname__, exc_info=task.exception())
 
 if not os.path.exists('static/profile'):
     os.makedirs('static/profile')
@@ -20,12 +54,38 @@ if not os.path.exists('static/profile'):
 if not os.path.exists('static/chat'):
     os.makedirs('static/chat')
 
+if not os.path.exists('uploads'):
+    os.makedirs('uploads')
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Create the database and tables if they do not exist
-    if not os.path.exists('database.db'):
-        create_db_and_tables()
+    # Create the database and tables, or bring an existing database up to date
+    create_db_and_tables()
+    cleanup_uploads()
+    await loop_monitor.start()
+    await derivatives.start()
+    await password_hasher.start()
+    await denylist.start()
+    await chat_writer.start()
+    await manager.start()
+    await presence.start(manager)
+    await receipts.start(manager)
+    await search_backfill.start()
+    await roster_cache.start()
+    await upload_sweeper.start()
     yield
+    await upload_sweeper.stop()
+    await roster_cache.stop()
+    await search_backfill.stop()
+    await receipts.stop()
+    await presence.stop()
+    await denylist.stop()
+    await manager.stop()
+    await chat_writer.stop()
+    await derivatives.stop()
+    await password_hasher.stop()
+    await loop_monitor.stop()
+    await async_engine.dispose()
 
 # Initialize the FastAPI app with metadata
 app = FastAPI(
@@ -65,68 +125,125 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Mount the static files directory
-app.mount("/static", StaticFiles(directory="static"), name="static")
+# Include avatar routes before the static mount, they render missing profile pictures
+app.include_router(Avatar.avatar_routes)
+
+# Mount the static files directory, content-addressed media is cached for good
+app.mount("/static", MediaFiles(directory="static"), name="static")
 
 # Include user routes from the User router
 app.include_router(User.user_routes)
 
+# Include chat routes from the Chat router
+app.include_router(Chat.chat_routes)
+
+# Include room routes from the Room router
+app.include_router(Room.room_routes)
+
+# Include upload routes from the Upload router
+app.include_router(Upload.upload_routes)
+
+# Include monitoring routes from the Monitoring router
+app.include_router(Monitoring.monitoring_routes)
+
 manager = ConnectionManager()
 
+PONG = OutboundEvent({'type': 'pong'})
+
 @app.websocket("/ws/{user_id}")
-async def websocket_endpoint(websocket: WebSocket, user_id: int, session: SessionDep):
-    await websocket.accept()
-    await manager.connect(websocket, user_id, session)
+async def websocket_endpoint(websocket: WebSocket, user_id: int, since: Optional[int] = None):
+    token, token_protocol = websocket_token(websocket)
+    claims = token_cache.verify(token) if token else None
+    # A client offering "msgpack" gets binary MessagePack frames, JSON text frames otherwise
+    codec, subprotocol = negotiate(websocket.scope.get('subprotocols', []))
+    await websocket.accept(subprotocol=subprotocol or token_protocol)
+    if claims is None or claims.get('id') != user_id:
+        # Accepted first so that the client sees the close code
+        await websocket.close(code=1008, reason="Invalid or missing token")
+        return
+
+    connection = await manager.connect(websocket, user_id, codec)
+    if since is not None:
+        # Replay what was missed while offline, alongside the live traffic
+        run_in_background(manager.resume(user_id, since))
     try:
         while True:
-            try:
-                data = await asyncio.wait_for(websocket.receive_text(), timeout=15)
-                await handle_received_data(websocket, data, session)
-            except asyncio.TimeoutError:
-                await websocket.close(code=1001, reason="Ping timeout")
-                await manager.disconnect(user_id, session)
-                break
+            # Idle connections are closed by the manager's sweep, receiving only stamps the time
+            data = await receive_frame(websocket)
+            connection.last_seen = time.monotonic()
+            inbound_frame_bytes.observe(len(data))
+            if is_ping(data):
+                connection.send(codec.pong)
+                continue
+            await handle_received_data(websocket, user_id, codec, data)
     except WebSocketDisconnect:
-        await manager.disconnect(user_id, session)
+        await manager.disconnect(user_id, websocket)
         
 
-async def handle_received_data(websocket: WebSocket, data: str, session: SessionDep):
+async def handle_received_data(websocket: WebSocket, user_id: int, codec, data):
     try:
-        json_data = json.loads(data)
+        json_data = codec.decode(data)
         message_type = json_data.get('type')
+        # The connection is authenticated, a client can only speak for itself
+        json_data['sender_id'] = user_id
 
         if message_type == 'chat':
-            await handle_chat(json_data, session)
+            await handle_chat(json_data)
+
+        if message_type == 'room_chat':
+            await handle_room_chat(json_data)
+
+        if message_type == 'room_read':
+            receipts.submit_room_read(user_id, int(json_data['room_id']), int(json_data['upto']))
+
+        if message_type == 'receipt':
+            # "delivered" or "read" for every chat from peer_id up to id upto
+            receipts.submit(user_id, int(json_data['peer_id']), json_data['status'], int(json_data['upto']))
 
         if message_type in ['typing', 'blur']:
             await manager.typing_indicator(message_type, json_data['receiver_id'], json_data['sender_id'])
 
         if message_type == 'ping':
-            await websocket.send_text(json.dumps({'type': 'pong'}))
+            connection = manager.active_connections.get(user_id)
+            if connection:
+                connection.send(PONG.encode(codec))
         
         if message_type == 'ack':
-            await manager.acknowledge_message(json_data['message_id'])
+            if 'message_id' in json_data:
+                await manager.acknowledge_message(user_id, json_data['message_id'])
+            if 'seq' in json_data:
+                await manager.acknowledge_seq(user_id, int(json_data['seq']))
 
-    except json.JSONDecodeError:
-        print("Received invalid JSON data")
     except KeyError as e:
-        print(f"Missing key in received data: {e}")
-    except Exception as e:
-        print(f"Unexpected error while handling data: {e}")
+        logger.warning("Missing key in received data: %s", e, extra={"user_id": user_id})
+    except ValueError:
+        logger.warning("Received invalid data", extra={"user_id": user_id})
+    except Exception:
+        logger.exception("Unexpected error while handling data", extra={"user_id": user_id})
 
-async def handle_chat(json_data: dict, session: SessionDep):
+async def handle_chat(json_data: dict):
+    started = time.perf_counter()
     try:
         sender_id = int(json_data['sender_id'])
         receiver_id = int(json_data['receiver_id'])
         message = json_data['message']
         uuid = json_data['uuid']
         created_at = json_data['created_at']
+        image = json_data.get('image')
         file_data = json_data.get('file')
 
         image_url = None
-        if file_data:
+        if image:
+            # A file completed through the /uploads endpoints
+            if not is_stored_name(image):
+                raise ValueError(f"Unknown file {image}")
+            image_url = image
+        elif file_data:
             image_url = await handle_file_upload(file_data)
 
+        # Rendered alongside the write, the variants follow in a msg_update
+        rendering = derivatives.schedule(image_url) if image_url else None
+
         post_data = {
             'sender_id': sender_id,
             'receiver_id': receiver_id,
@@ -138,32 +255,96 @@ async def handle_chat(json_data: dict, session: SessionDep):
         }
 
         try:
-            chat_message = insert_chat(post_data, session)
+            # Resolves once the batch holding this message has been committed
+            chat_message, deliveries = await chat_writer.submit(post_data)
             if chat_message:
-                if sender_id != receiver_id:
-                    await manager.send_chat(json.loads(chat_message))
-                    await manager.update_msg_status(sender_id, receiver_id, uuid)
-                    print(f"Message sent from user {sender_id} to {receiver_id}")
+                presence.add_contact(sender_id, receiver_id)
+                # The chat for the receiver and the msg_update for the sender
+                for delivery in deliveries:
+                    await manager.deliver(*delivery)
+                if rendering is not None and chat_message.variants is None:
+                    announce_variants(rendering, image_url, [sender_id, receiver_id], {
+                        'type': 'msg_update',
+                        'id': chat_message.id,
+                        'uuid': chat_message.uuid,
+                        'sender_id': sender_id,
+                        'receiver_id': receiver_id
+                    })
+                chat_seconds.observe(time.perf_counter() - started)
+                if deliveries:
+                    logger.debug("Message sent from user %s to %s", sender_id, receiver_id)
 
         except Exception as e:
-            print(e)
+            logger.warning("Failed to store chat %s: %s", uuid, e, extra={"user_id": sender_id})
             return
         
-    except Exception as e:
-        print(f"Error handling chat message: {e}")
+    except Exception:
+        logger.exception("Error handling chat message")
+
+def announce_variants(rendering, image: str, user_ids: list, payload: dict):
+    """
+    Sends `payload` with the thumbnail and preview of `image` to `user_ids`
+    once `rendering` finishes, for a message that went out without them.
+    Clients that miss it get the variants with the history.
+    """
+    def rendered(_):
+        variants = derivatives.variants(image)
+        if variants is not None:
+            run_in_background(manager.multicast(user_ids, {**payload, 'variants': variants}))
+    rendering.add_done_callback(rendered)
+
+async def handle_room_chat(json_data: dict):
+    try:
+        sender_id = int(json_data['sender_id'])
+        image = json_data.get('image')
+        if image and not is_stored_name(image):
+            raise ValueError(f"Unknown file {image}")
+        rendering = derivatives.schedule(image) if image else None
+
+        post_data = {
+            'room_id': int(json_data['room_id']),
+            'sender_id': sender_id,
+            'message': json_data['message'],
+            'uuid': json_data['uuid'],
+            'image': image,
+            'created_at': json_data['created_at']
+        }
+
+        try:
+            # Stored once, members that are offline catch up from their read cursor
+            async with async_session() as session:
+                room_message, member_ids = await insert_room_message(post_data, session)
+        except Exception as e:
+            logger.warning("Failed to store room message %s: %s", post_data['uuid'], e, extra={"user_id": sender_id})
+            return
+
+        await manager.multicast(
+            [member_id for member_id in member_ids if member_id != sender_id],
+            {'type': 'room_chat', **room_message.model_dump(mode="json")}
+        )
+        await manager.multicast(
+            [sender_id],
+            {'type': 'room_update', 'room_id': room_message.room_id, 'id': room_message.id, 'uuid': room_message.uuid}
+        )
+        if rendering is not None and room_message.variants is None:
+            announce_variants(rendering, image, member_ids, {
+                'type': 'room_update',
+                'room_id': room_message.room_id,
+                'id': room_message.id,
+                'uuid': room_message.uuid
+            })
+
+    except Exception:
+        logger.exception("Error handling room message")
 
 async def handle_file_upload(file_data: dict):
+    # Base64 files inside the chat frame are still accepted from older clients
     try:
         file_name = file_data['name']
         base64_data = file_data['data']
         file_content = base64.b64decode(base64_data)
 
-        unique_file_name = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}{os.path.splitext(file_name)[1]}"
-        file_path = os.path.join("static/chat", unique_file_name)
-        
-        async with aiofiles.open(file_path, "wb") as f:
-            await f.write(file_content)
-        return unique_file_name
+        return await run_in_threadpool(store_bytes, file_content, safe_extension(file_name))
     except Exception as e:
-        print(f"Error uploading file: {e}")
-        raise
\ No newline at end of file
+        logger.warning("Error uploading file: %s", e)
+        raise
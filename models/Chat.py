@@ -1,14 +1,24 @@
-from sqlmodel import Field, SQLModel
-from typing import Optional
+from sqlmodel import Field, SQLModel, Index
+from typing import Optional, List, Tuple, Dict
 from datetime import datetime, timezone
 
+def conversation_key(user_id: int, peer_id: int) -> Tuple[int, int]:
+    """Both directions of a one-to-one conversation share the ordered (low, high) pair."""
+    return (user_id, peer_id) if user_id <= peer_id else (peer_id, user_id)
+
+def utc_naive(value: datetime) -> datetime:
+    """Timestamps are stored as naive UTC so that they sort as plain strings in SQLite."""
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
 class InsertChat(SQLModel):
     sender_id: int
     receiver_id: int
     message: Optional[str] = None
     uuid: str
     image: Optional[str] = None
-    created_at: str
+    created_at: datetime
 
 class ChatResponse(SQLModel):
     id: int
@@ -17,16 +27,34 @@ class ChatResponse(SQLModel):
     message: Optional[str] = None
     uuid: str
     image: Optional[str] = None
+    # Derived renditions of an image, e.g. {"thumb": "derived/<hash>_160.webp"}
+    variants: Optional[Dict[str, str]] = None
     status: str = "sent"
-    created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc))
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+class ChatPage(SQLModel):
+    chats: List[ChatResponse] = []
+    next_before: Optional[int] = None
+
+class ChatSearchPage(SQLModel):
+    chats: List[ChatResponse] = []
+    next_offset: Optional[int] = None
 
 class Model(SQLModel, table=True):
     __tablename__ = "chats"
+    __table_args__ = (
+        Index("ix_chats_conversation", "user_low", "user_high", "id"),
+        Index("ix_chats_conversation_high", "user_high", "user_low", "id"),
+        Index("ix_chats_receiver_status", "receiver_id", "status", "sender_id"),
+    )
     id: Optional[int] = Field(default=None, primary_key=True)
     sender_id: int
     receiver_id: int
+    user_low: int
+    user_high: int
     message: Optional[str] = None
     uuid: str = Field(sa_column_kwargs={"unique": True})
     image: Optional[str] = None
-    created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc))
-    updated_at: str = Field(default_factory=lambda: datetime.now(timezone.utc))
\ No newline at end of file
+    status: str = Field(default="sent")
+    created_at: datetime = Field(default_factory=lambda: utc_naive(datetime.now(timezone.utc)))
+    updated_at: datetime = Field(default_factory=lambda: utc_naive(datetime.now(timezone.utc)))
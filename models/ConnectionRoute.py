@@ -0,0 +1,8 @@
+from sqlmodel import Field, SQLModel
+from datetime import datetime, timezone
+
+class Model(SQLModel, table=True):
+    __tablename__ = "connection_routes"
+    user_id: int = Field(primary_key=True)
+    worker_id: str = Field(index=True)
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc).replace(tzinfo=None))
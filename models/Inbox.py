@@ -0,0 +1,9 @@
+from sqlmodel import Field, SQLModel
+from datetime import datetime, timezone
+
+class Model(SQLModel, table=True):
+    __tablename__ = "inbox"
+    user_id: int = Field(primary_key=True)
+    seq: int = Field(primary_key=True)
+    payload: str
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc).replace(tzinfo=None), index=True)
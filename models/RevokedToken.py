@@ -0,0 +1,7 @@
+from sqlmodel import Field, SQLModel
+from datetime import datetime
+
+class Model(SQLModel, table=True):
+    __tablename__ = "revoked_tokens"
+    token_id: str = Field(primary_key=True)
+    expires_at: datetime = Field(index=True)
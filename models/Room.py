@@ -0,0 +1,29 @@
+from sqlmodel import Field, SQLModel
+from typing import Optional, List
+from datetime import datetime, timezone
+from models.RoomMessage import RoomMessageResponse
+
+class CreateRoom(SQLModel):
+    name: str = Field(..., min_length=1, max_length=100)
+    member_ids: List[int] = []
+
+class RoomMembers(SQLModel):
+    user_ids: List[int] = Field(..., min_length=1)
+
+class RoomResponse(SQLModel):
+    id: int
+    name: str
+    created_by: int
+    member_count: int = 0
+    last_message: Optional[RoomMessageResponse] = None
+    unread_count: int = 0
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+class Model(SQLModel, table=True):
+    __tablename__ = "rooms"
+    id: Optional[int] = Field(default=None, primary_key=True)
+    name: str
+    created_by: int
+    member_count: int = Field(default=0)
+    last_message_id: Optional[int] = None
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc).replace(tzinfo=None))
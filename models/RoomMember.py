@@ -0,0 +1,11 @@
+from sqlmodel import Field, SQLModel
+from datetime import datetime, timezone
+
+class Model(SQLModel, table=True):
+    __tablename__ = "room_members"
+    room_id: int = Field(primary_key=True)
+    user_id: int = Field(primary_key=True, index=True)
+    role: str = Field(default="member")
+    # Everything in the room up to this message id has been read by the member
+    last_read_id: int = Field(default=0)
+    joined_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc).replace(tzinfo=None))
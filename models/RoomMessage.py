@@ -0,0 +1,38 @@
+from sqlmodel import Field, SQLModel, Index
+from typing import Optional, List, Dict
+from datetime import datetime, timezone
+
+class InsertRoomMessage(SQLModel):
+    room_id: int
+    sender_id: int
+    message: Optional[str] = None
+    uuid: str
+    image: Optional[str] = None
+    created_at: datetime
+
+class RoomMessageResponse(SQLModel):
+    id: int
+    room_id: int
+    sender_id: int
+    message: Optional[str] = None
+    uuid: str
+    image: Optional[str] = None
+    variants: Optional[Dict[str, str]] = None
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+class RoomMessagePage(SQLModel):
+    messages: List[RoomMessageResponse] = []
+    next_before: Optional[int] = None
+
+class Model(SQLModel, table=True):
+    __tablename__ = "room_messages"
+    __table_args__ = (
+        Index("ix_room_messages_room", "room_id", "id"),
+    )
+    id: Optional[int] = Field(default=None, primary_key=True)
+    room_id: int
+    sender_id: int
+    message: Optional[str] = None
+    uuid: str = Field(sa_column_kwargs={"unique": True})
+    image: Optional[str] = None
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc).replace(tzinfo=None))
@@ -0,0 +1,20 @@
+from sqlmodel import Field, SQLModel, Index
+from typing import Optional
+from datetime import datetime, timezone
+
+class Model(SQLModel, table=True):
+    """
+    Change log of the /users roster, its id is the roster version. A row
+    without `peer_id` is a change of the user itself (signup, status, profile)
+    that every roster shows, a row with one is a change of the conversation
+    between the two users (last message, unread count).
+    """
+    __tablename__ = "roster_changes"
+    __table_args__ = (
+        Index("ix_roster_changes_peer", "peer_id", "id"),
+        Index("ix_roster_changes_user", "user_id", "id"),
+    )
+    id: Optional[int] = Field(default=None, primary_key=True)
+    user_id: int
+    peer_id: Optional[int] = None
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc).replace(tzinfo=None))
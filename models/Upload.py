@@ -0,0 +1,15 @@
+from sqlmodel import SQLModel
+
+class CreateUpload(SQLModel):
+    name: str
+    size: int
+
+class UploadStatus(SQLModel):
+    upload_id: str
+    offset: int
+    size: int
+    chunk_size: int
+
+class UploadedFile(SQLModel):
+    file: str
+    size: int
@@ -1,6 +1,7 @@
 from sqlmodel import Field, SQLModel
-from typing import Optional, List
+from typing import Optional
 from datetime import datetime, timezone
+from models.Chat import ChatResponse
 
 class CreateUser(SQLModel):
     user_name: str
@@ -17,7 +18,14 @@ class UserResponse(SQLModel):
     profile_image: str
     status: str
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
-    chats: Optional[List] = None
+    last_message: Optional[ChatResponse] = None
+    unread_count: int = 0
+
+class RosterDelta(SQLModel):
+    version: int
+    # True when the client was too far behind and `users` is the whole roster
+    full: bool = False
+    users: list[UserResponse] = []
 
 class Model(SQLModel, table=True):
     __tablename__ = "users"
@@ -26,5 +34,6 @@ class Model(SQLModel, table=True):
     hashed_password: str = Field(..., min_length=6) 
     profile_image: Optional[str] = None 
     status: str = Field(default="Offline")
+    inbox_seq: int = Field(default=0)
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
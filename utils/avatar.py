@@ -1,31 +1,124 @@
-from fastapi import HTTPException
 from PIL import Image, ImageDraw, ImageFont
+from collections import OrderedDict
+from functools import lru_cache
+from dotenv import load_dotenv
 import random
+import io
 import os
+import re
 
-def avatar(text, image_size=(200, 200), font_size=150, output_path="profile_image.png"):
-    try:
-        bg_color = (random.randint(0, 255), random.randint(0, 255), random.randint(0, 255))
-        image = Image.new('RGB', image_size, bg_color)
-        draw = ImageDraw.Draw(image)
+load_dotenv()
 
-        font_path = "font/Roboto-Bold.ttf"
-        if not os.path.exists(font_path):
-            font = ImageFont.load_default()
-        else:
-            font = ImageFont.truetype(font_path, font_size)
+AVATAR_DIR = "static/profile"
+FONT_PATH = "font/Roboto-Bold.ttf"
+AVATAR_SIZES = (48, 96, 200, 400)
+DEFAULT_AVATAR_SIZE = 200
+AVATAR_CACHE_ENTRIES = int(os.getenv("AVATAR_CACHE_ENTRIES", "2048"))
 
-        bbox = draw.textbbox((0, 0), text, font=font)
-        text_width = bbox[2] - bbox[0]
-        text_height = bbox[3] - bbox[1]
-        
-        x = (image_size[0] - text_width) // 2
-        y = (image_size[1] - (text_height + 60)) // 2
+# Background colors an avatar can get. A closed set keeps every (letter, color,
+# size) combination cacheable, in memory and on disk.
+PALETTE = (
+    "e53935", "d81b60", "8e24aa", "5e35b1", "3949ab", "1e88e5", "039be5", "00acc1",
+    "00897b", "43a047", "7cb342", "c0ca33", "fdd835", "fb8c00", "f4511e", "6d4c41",
+)
 
-        text_color = (255, 255, 255)
-        draw.text((x, y), text, font=font, fill=text_color)
+_avatar_name_pattern = re.compile(r"^([A-Z0-9]|sym)_([0-9a-f]{6})\.png$")
 
-        image.save(output_path)
+def avatar_name(user_name: str) -> str:
+    """
+    Deterministic file name describing the avatar of a new user, e.g.
+    `A_1e88e5.png`. Nothing is rendered until the image is first requested.
+    """
+    letter = user_name[:1].upper()
+    if not (letter.isascii() and letter.isalnum()):
+        letter = "sym"
+    return f"{letter}_{random.choice(PALETTE)}.png"
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error generating avatar: {str(e)}")
+def parse_avatar_name(name: str):
+    """Returns (letter, color) for a name made by `avatar_name`, None otherwise."""
+    match = _avatar_name_pattern.match(name)
+    if not match or match.group(2) not in PALETTE:
+        return None
+    letter = "#" if match.group(1) == "sym" else match.group(1)
+    return letter, match.group(2)
+
+def avatar_size(size: int = None) -> int:
+    """Snaps a requested size to the smallest rendered size that is at least as large."""
+    if not size:
+        return DEFAULT_AVATAR_SIZE
+    return next((s for s in AVATAR_SIZES if s >= size), AVATAR_SIZES[-1])
+
+def avatar_path(name: str, size: int) -> str:
+    return os.path.join(AVATAR_DIR, str(size), name)
+
+@lru_cache(maxsize=None)
+def _font(font_size: int):
+    # Read from disk once per size instead of once per avatar
+    if not os.path.exists(FONT_PATH):
+        return ImageFont.load_default()
+    return ImageFont.truetype(FONT_PATH, font_size)
+
+@lru_cache(maxsize=256)
+def _glyph(letter: str, size: int) -> Image.Image:
+    """Coverage mask of one centered letter, shared by every color."""
+    mask = Image.new("L", (size, size), 0)
+    draw = ImageDraw.Draw(mask)
+    font = _font(size * 3 // 4)
+
+    left, top, right, bottom = draw.textbbox((0, 0), letter, font=font)
+    x = (size - (right - left)) // 2 - left
+    y = (size - (bottom - top)) // 2 - top
+    draw.text((x, y), letter, font=font, fill=255)
+    return mask
+
+def render_avatar(letter: str, color: str, size: int) -> bytes:
+    image = Image.new("RGB", (size, size), "#" + color)
+    image.paste((255, 255, 255), mask=_glyph(letter, size))
+
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG")
+    return buffer.getvalue()
+
+def load_or_render(name: str, size: int):
+    """
+    Runs off the event loop: reads the avatar from the disk cache, or renders it
+    and stores it there. Returns None for a name that is not a generated avatar.
+    """
+    path = avatar_path(name, size)
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    parsed = parse_avatar_name(name)
+    if parsed is None:
+        return None
+    data = render_avatar(*parsed, size)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, path)
+    return data
+
+class AvatarCache:
+    """LRU of encoded avatars keyed by (name, size), i.e. by (letter, color, size)."""
+
+    def __init__(self, max_entries: int = AVATAR_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self.entries: OrderedDict = OrderedDict()
+
+    def get(self, name: str, size: int):
+        data = self.entries.get((name, size))
+        if data is not None:
+            self.entries.move_to_end((name, size))
+        return data
+
+    def put(self, name: str, size: int, data: bytes):
+        self.entries[(name, size)] = data
+        self.entries.move_to_end((name, size))
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+avatar_cache = AvatarCache()
@@ -0,0 +1,77 @@
+import os
+import re
+import gzip
+import shutil
+import hashlib
+
+CHAT_DIR = "static/chat"
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Text-like files that shrink well get a gzip copy next to them, see MediaFiles
+COMPRESSIBLE_EXTENSIONS = {".txt", ".csv", ".json", ".xml", ".svg", ".html", ".md", ".log", ".js", ".css"}
+PRECOMPRESS_MIN_BYTES = 1024
+
+_extension_pattern = re.compile(r"^\.[a-z0-9]{1,8}$")
+_stored_name_pattern = re.compile(r"^[0-9a-f]{64}(\.[a-z0-9]{1,8})?$")
+
+def safe_extension(file_name: str) -> str:
+    extension = os.path.splitext(file_name or "")[1].lower()
+    return extension if _extension_pattern.match(extension) else ""
+
+def is_stored_name(name: str) -> bool:
+    return bool(name) and bool(_stored_name_pattern.match(name)) and os.path.exists(os.path.join(CHAT_DIR, name))
+
+def hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def store_file(temp_path: str, extension: str, digest: str = None) -> str:
+    """
+    Moves a finished file into the chat store under its content hash. A file
+    that is already stored is kept as is and the duplicate is discarded.
+    """
+    digest = digest or hash_file(temp_path)
+    name = f"{digest}{extension}"
+    path = os.path.join(CHAT_DIR, name)
+
+    if os.path.exists(path):
+        os.unlink(temp_path)
+    else:
+        shutil.move(temp_path, path)
+        precompress(path, extension)
+    return name
+
+def store_bytes(data: bytes, extension: str) -> str:
+    name = f"{hashlib.sha256(data).hexdigest()}{extension}"
+    path = os.path.join(CHAT_DIR, name)
+
+    if not os.path.exists(path):
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+        precompress(path, extension)
+    return name
+
+def precompress(path: str, extension: str):
+    """
+    Writes `<path>.gz` for a compressible file when it is noticeably smaller.
+    Brotli copies (`<path>.br`) are served as well, but only made offline.
+    """
+    if extension not in COMPRESSIBLE_EXTENSIONS or os.path.getsize(path) < PRECOMPRESS_MIN_BYTES:
+        return
+
+    compressed_path = f"{path}.gz"
+    temp_path = f"{compressed_path}.{os.getpid()}.tmp"
+    with open(path, "rb") as source, open(temp_path, "wb") as target:
+        # mtime=0 keeps the copy identical for identical content
+        with gzip.GzipFile(fileobj=target, mode="wb", compresslevel=9, mtime=0) as compressed:
+            shutil.copyfileobj(source, compressed, HASH_CHUNK_SIZE)
+
+    if os.path.getsize(temp_path) < os.path.getsize(path) * 0.9:
+        os.replace(temp_path, compressed_path)
+    else:
+        os.unlink(temp_path)
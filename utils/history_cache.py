@@ -0,0 +1,195 @@
+import os
+import logging
+from collections import OrderedDict, deque
+from dotenv import load_dotenv
+from utils.image_derivatives import derivatives
+from utils.metrics import registry
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+HISTORY_CACHE_MESSAGES = int(os.getenv("HISTORY_CACHE_MESSAGES", "50"))
+HISTORY_CACHE_MAX_BYTES = int(os.getenv("HISTORY_CACHE_MAX_MB", "32")) * 1024 * 1024
+
+# Rough cost of the objects around each cached message, on top of its JSON
+ITEM_OVERHEAD = 256
+
+class _Conversation:
+    __slots__ = ("items", "complete", "pages", "size", "pending_variants")
+
+    def __init__(self, depth: int):
+        # [ChatResponse, JSON bytes, waiting for variants], oldest first
+        self.items: deque = deque(maxlen=depth)
+        # True while the buffer holds the whole conversation
+        self.complete = False
+        # limit -> serialized first page
+        self.pages: dict = {}
+        self.size = 0
+        # Items still waiting for their thumbnails
+        self.pending_variants = 0
+
+class HistoryCache:
+    """
+    The most recent messages of active conversations, so that opening a chat
+    does not go to SQLite.
+
+    Each conversation keeps a ring buffer of its last `HISTORY_CACHE_MESSAGES`
+    messages, each already serialized, and the first pages built from them.
+    A conversation enters the cache when its first page is read from the
+    database and is kept current write-through as chats are inserted and
+    receipts applied. Conversations are evicted least recently used first
+    once the cache exceeds `HISTORY_CACHE_MAX_MB`.
+
+    Other workers write to the same conversations, so the conversations a
+    worker changes are published on the bus and dropped by the others.
+    """
+
+    def __init__(self, depth: int = HISTORY_CACHE_MESSAGES, max_bytes: int = HISTORY_CACHE_MAX_BYTES):
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict = OrderedDict()
+        self.size = 0
+        # Conversations being read from the database -> whether they changed meanwhile
+        self.loading: dict = {}
+        self.bus = None
+
+        self.hits = registry.counter("vetra_history_cache_hits_total", "First pages of history served from memory.")
+        self.misses = registry.counter("vetra_history_cache_misses_total", "First pages of history read from the database.")
+        registry.gauge("vetra_history_cache_conversations", "Conversations in the history cache.", callback=lambda: len(self.entries))
+        registry.gauge("vetra_history_cache_bytes", "Estimated size of the history cache.", callback=lambda: self.size)
+
+    def start(self, bus):
+        self.bus = bus
+
+    def page(self, key: tuple, limit: int):
+        """Returns the serialized first page of `limit` chats, or None when it cannot be served from memory."""
+        entry = self.entries.get(key)
+        if entry is None or (len(entry.items) < limit and not entry.complete):
+            self.misses.inc()
+            return None
+        self.entries.move_to_end(key)
+        self.hits.inc()
+
+        if entry.pending_variants:
+            self._refresh_variants(entry)
+
+        page = entry.pages.get(limit)
+        if page is None:
+            items = list(entry.items)[-limit:]
+            next_before = str(items[0][0].id).encode() if len(items) == limit else b"null"
+            page = b'{"chats":[' + b",".join(item[1] for item in items) + b'],"next_before":' + next_before + b"}"
+            entry.pages[limit] = page
+            self._resize(entry, len(page))
+        return page
+
+    def begin_fill(self, key: tuple):
+        self.loading.setdefault(key, False)
+
+    def cancel_fill(self, key: tuple):
+        self.loading.pop(key, None)
+
+    def fill(self, key: tuple, chats: list, complete: bool):
+        """Caches the newest chats of a conversation read from the database, unless it changed during the read."""
+        changed = self.loading.pop(key, True)
+        if changed or key in self.entries or self.depth <= 0:
+            return
+        entry = _Conversation(self.depth)
+        entry.complete = complete and len(chats) <= self.depth
+        self.entries[key] = entry
+        for chat in chats[-self.depth:]:
+            self._push(entry, chat)
+        self._evict()
+
+    def append(self, key: tuple, chat):
+        entry = self.entries.get(key)
+        if entry is None:
+            if key in self.loading:
+                self.loading[key] = True
+            return
+        if len(entry.items) == entry.items.maxlen:
+            entry.complete = False
+        self._push(entry, chat)
+        self._evict()
+
+    def update_status(self, key: tuple, sender_id: int, upto: int, status: str, weaker: tuple):
+        entry = self.entries.get(key)
+        if entry is None:
+            if key in self.loading:
+                self.loading[key] = True
+            return
+        for item in entry.items:
+            chat = item[0]
+            if chat.sender_id == sender_id and chat.id <= upto and chat.status in weaker:
+                chat.status = status
+                self._serialize(entry, item)
+        self._clear_pages(entry)
+
+    def invalidate(self, keys):
+        for key in keys:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry.size
+            if key in self.loading:
+                self.loading[key] = True
+
+    async def publish(self, keys):
+        """Tells the other workers that these conversations changed."""
+        if self.bus is None or not keys:
+            return
+        try:
+            await self.bus.broadcast({'op': 'history', 'keys': [list(key) for key in keys]})
+        except Exception as e:
+            logger.warning("Failed to publish history changes: %s", e)
+
+    def _push(self, entry: _Conversation, chat):
+        if len(entry.items) == entry.items.maxlen:
+            dropped = entry.items[0]
+            self._resize(entry, -len(dropped[1]) - ITEM_OVERHEAD)
+            if dropped[2]:
+                entry.pending_variants -= 1
+        # Only images get variants, anything else never will
+        waiting = chat.variants is None and derivatives.is_image(chat.image)
+        item = [chat, b"", waiting]
+        entry.items.append(item)
+        self._resize(entry, ITEM_OVERHEAD)
+        self._serialize(entry, item)
+        if waiting:
+            entry.pending_variants += 1
+        self._clear_pages(entry)
+
+    def _serialize(self, entry: _Conversation, item: list):
+        encoded = item[0].model_dump_json().encode()
+        self._resize(entry, len(encoded) - len(item[1]))
+        item[1] = encoded
+
+    def _refresh_variants(self, entry: _Conversation):
+        # Thumbnails rendered after the chat was cached. Once a render is no
+        # longer in flight the disk is checked one last time, an image that
+        # still has none (skipped, failed, legacy) stops waiting for good.
+        for item in entry.items:
+            chat = item[0]
+            if not item[2] or derivatives.rendering(chat.image):
+                continue
+            item[2] = False
+            entry.pending_variants -= 1
+            chat.variants = derivatives.variants(chat.image)
+            if chat.variants is not None:
+                self._serialize(entry, item)
+                self._clear_pages(entry)
+
+    def _clear_pages(self, entry: _Conversation):
+        if entry.pages:
+            self._resize(entry, -sum(len(page) for page in entry.pages.values()))
+            entry.pages.clear()
+
+    def _resize(self, entry: _Conversation, delta: int):
+        entry.size += delta
+        self.size += delta
+
+    def _evict(self):
+        while self.size > self.max_bytes and self.entries:
+            _, entry = self.entries.popitem(last=False)
+            self.size -= entry.size
+
+
+history_cache = HistoryCache()
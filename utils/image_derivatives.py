@@ -0,0 +1,155 @@
+import os
+import asyncio
+import multiprocessing
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dotenv import load_dotenv
+from fastapi.concurrency import run_in_threadpool
+from PIL import Image, ImageOps
+from utils.file_store import CHAT_DIR
+from utils.metrics import registry
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+DERIVED_DIR = "derived"
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".gif", ".bmp", ".tif", ".tiff"}
+VARIANTS = {"thumb": 160, "preview": 720}
+READY_CACHE_SIZE = 100000
+
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", str(min(2, os.cpu_count() or 1))))
+IMAGE_QUEUE_SIZE = int(os.getenv("IMAGE_QUEUE_SIZE", "64"))
+
+def variant_name(name: str, size: int) -> str:
+    digest = os.path.splitext(name)[0]
+    return f"{DERIVED_DIR}/{digest}_{size}.webp"
+
+def render_variants(source_path: str, targets: list):
+    """
+    Runs in a pool process: renders every (path, size) target of one image as
+    WebP. Only the pixels are written, EXIF, GPS and other metadata are not.
+    """
+    with Image.open(source_path) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "transparency" in image.info or "A" in image.mode else "RGB")
+
+        for path, size in targets:
+            variant = image.copy()
+            variant.thumbnail((size, size), Image.LANCZOS)
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            variant.save(temp_path, "WEBP", quality=80, method=4)
+            os.replace(temp_path, path)
+
+def _rendered(names) -> set:
+    """The images of `names` whose derivatives all exist on disk."""
+    return {
+        name for name in names
+        if all(os.path.exists(os.path.join(CHAT_DIR, variant_name(name, size))) for size in VARIANTS.values())
+    }
+
+class DerivativePipeline:
+    """
+    Produces the thumbnail and preview of chat images on a bounded process pool.
+
+    Derivatives are cached on disk under the content hash of the original and
+    the target size, so each one is only rendered once. At most
+    `IMAGE_QUEUE_SIZE` images wait for the pool, further ones are skipped and
+    simply get no variants.
+    """
+
+    def __init__(self, workers: int = IMAGE_WORKERS, queue_size: int = IMAGE_QUEUE_SIZE):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.executor = None
+        self.in_flight: dict = {}
+        self.ready: set = set()
+
+        registry.gauge("vetra_image_renders_in_flight", "Images whose derivatives are being rendered.", callback=lambda: len(self.in_flight))
+
+    async def start(self):
+        os.makedirs(os.path.join(CHAT_DIR, DERIVED_DIR), exist_ok=True)
+        if self.executor is None:
+            self.executor = self._create_executor()
+
+    def _create_executor(self) -> ProcessPoolExecutor:
+        # Spawned rather than forked, the server process already runs threads
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    async def stop(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    def is_image(self, name: str) -> bool:
+        return bool(name) and os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS
+
+    def rendering(self, name: str) -> bool:
+        return name in self.in_flight
+
+    def variants(self, name: str):
+        """Lists the derivatives of `name` that exist on disk."""
+        if not self.is_image(name):
+            return None
+        if name not in self.ready:
+            paths = [os.path.join(CHAT_DIR, variant_name(name, size)) for size in VARIANTS.values()]
+            if not all(os.path.exists(path) for path in paths):
+                return None
+            self._mark_ready(name)
+        return {label: variant_name(name, size) for label, size in VARIANTS.items()}
+
+    async def lookup(self, names) -> dict:
+        """
+        The `variants` of each of `names`, for a whole page of chats. Only the
+        images not yet known to be ready are checked on disk, in a single call
+        off the event loop.
+        """
+        images = {name for name in names if self.is_image(name)}
+        found = {name for name in images if name in self.ready}
+        unknown = images - found
+        if unknown:
+            on_disk = await run_in_threadpool(_rendered, unknown)
+            for name in on_disk:
+                self._mark_ready(name)
+            found |= on_disk
+        return {name: {label: variant_name(name, size) for label, size in VARIANTS.items()} for name in found}
+
+    def schedule(self, name: str):
+        """Starts rendering the derivatives of `name` and returns the pending future."""
+        if not self.is_image(name) or self.executor is None:
+            return None
+        if name in self.in_flight:
+            return self.in_flight[name]
+        if self.variants(name) is not None or len(self.in_flight) >= self.queue_size:
+            return None
+
+        targets = [(os.path.join(CHAT_DIR, variant_name(name, size)), size) for size in VARIANTS.values()]
+        future = asyncio.get_running_loop().run_in_executor(
+            self.executor, render_variants, os.path.join(CHAT_DIR, name), targets
+        )
+        self.in_flight[name] = future
+        future.add_done_callback(lambda done: self._finished(name, done))
+        return future
+
+    def _mark_ready(self, name: str):
+        if len(self.ready) >= READY_CACHE_SIZE:
+            self.ready.clear()
+        self.ready.add(name)
+
+    def _finished(self, name: str, future):
+        self.in_flight.pop(name, None)
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:
+            logger.warning("Failed to render variants of %s: %s", name, error)
+            if isinstance(error, BrokenProcessPool) and self.executor is not None:
+                # A worker died (e.g. out of memory on a huge image), the pool is unusable from now on
+                self.executor.shutdown(wait=False, cancel_futures=True)
+                self.executor = self._create_executor()
+        else:
+            self._mark_ready(name)
+
+
+derivatives = DerivativePipeline()
@@ -1,13 +1,20 @@
-from fastapi import Security
+from fastapi import Security, HTTPException, WebSocket
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 import jwt
 from jwt import PyJWTError
+from collections import OrderedDict
 from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
+from typing import Optional
+from utils.metrics import registry
+import secrets
+import time
+import uuid
 import os
 
 
 auth_scheme = HTTPBearer()
+monitoring_scheme = HTTPBearer(auto_error=False)
 
 
 load_dotenv()
@@ -15,18 +22,129 @@ load_dotenv()
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = os.getenv("ALGORITHM")
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES"))
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+TOKEN_CACHE_SECONDS = float(os.getenv("TOKEN_CACHE_SECONDS", "300"))
+
+# Subprotocol a browser can carry its token in: new WebSocket(url, ["bearer", token])
+WS_TOKEN_PROTOCOL = "bearer"
+# Bearer token of the monitoring endpoints, which are disabled without one
+MONITORING_TOKEN = os.getenv("MONITORING_TOKEN", "")
+# Legacy clients pass the token in the URL, where proxies and access logs record it
+WS_QUERY_TOKEN = os.getenv("WS_QUERY_TOKEN", "false").lower() == "true"
 
 def create_access_token(data: dict) -> str:
     to_encode = data.copy()
     expire = datetime.now(timezone.utc) + timedelta(ACCESS_TOKEN_EXPIRE_MINUTES)
-    to_encode.update({"exp": expire})
+    to_encode.update({"exp": expire, "jti": uuid.uuid4().hex})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+def token_id(token: str, claims: dict) -> str:
+    """Identifies a token in the denylist. Tokens issued before `jti` existed use their signature."""
+    return claims.get("jti") or token.rsplit(".", 1)[-1]
+
+class TokenCache:
+    """
+    Claims of recently verified tokens, so that a token seen again is a dict
+    lookup instead of an HMAC check and a JSON decode.
+
+    An entry lives for `TOKEN_CACHE_SECONDS` at most and never past the
+    token's own `exp`. Tokens in `revoked` (token id -> exp) are refused even
+    when cached.
+    """
+
+    def __init__(self, max_entries: int = TOKEN_CACHE_SIZE, ttl: float = TOKEN_CACHE_SECONDS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries: OrderedDict = OrderedDict()
+        self.revoked: dict = {}
+        self.hits = 0
+        self.misses = 0
+
+        registry.counter("vetra_token_cache_hits_total", "Tokens verified from the cache.", callback=lambda: self.hits)
+        registry.counter("vetra_token_cache_misses_total", "Tokens verified with a signature check.", callback=lambda: self.misses)
+
+    def verify(self, token: str) -> Optional[dict]:
+        now = time.time()
+        cached = self.entries.get(token)
+        if cached is not None and cached[1] > now:
+            self.hits += 1
+            claims = cached[0]
+        else:
+            self.misses += 1
+            try:
+                claims = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+            except PyJWTError:
+                self.entries.pop(token, None)
+                return None
+            self._put(token, claims, now)
+
+        if self.revoked and token_id(token, claims) in self.revoked:
+            return None
+        return claims
+
+    def _put(self, token: str, claims: dict, now: float):
+        expires = now + self.ttl
+        if "exp" in claims:
+            expires = min(expires, float(claims["exp"]))
+        self.entries[token] = (claims, expires)
+        self.entries.move_to_end(token)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def revoke(self, token_id: str, exp: float):
+        self.revoked[token_id] = exp
+        self.prune()
+
+    def set_revoked(self, revoked: dict):
+        self.revoked = revoked
+
+    def prune(self):
+        # An expired token fails verification anyway, no need to keep denying it
+        now = time.time()
+        self.revoked = {key: exp for key, exp in self.revoked.items() if exp > now}
+
+
+token_cache = TokenCache()
+
 def decode_access_token(auth: HTTPAuthorizationCredentials = Security(auth_scheme)) -> dict:
-    token = auth.credentials
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        return payload
-    except PyJWTError:
-        return None
+    claims = token_cache.verify(auth.credentials)
+    if claims is None:
+        raise HTTPException(
+            status_code=401,
+            detail="Invalid or expired token",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+    return claims
+
+def verify_monitoring_token(auth: Optional[HTTPAuthorizationCredentials] = Security(monitoring_scheme)):
+    if not MONITORING_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if auth is None or not secrets.compare_digest(auth.credentials.encode(), MONITORING_TOKEN.encode()):
+        raise HTTPException(
+            status_code=401,
+            detail="Invalid or missing monitoring token",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+
+def websocket_token(websocket: WebSocket) -> tuple:
+    """
+    Finds the token of a websocket handshake in the `bearer, <token>`
+    subprotocols or the Authorization header, and in the `token` query
+    parameter only when `WS_QUERY_TOKEN` is enabled. Returns the token and the
+    subprotocol to accept with, if any.
+    """
+    protocols = [p.strip() for p in websocket.headers.get("sec-websocket-protocol", "").split(",")]
+    if len(protocols) >= 2 and protocols[0].lower() == WS_TOKEN_PROTOCOL:
+        return protocols[1], protocols[0]
+
+    authorization = websocket.headers.get("authorization", "")
+    if authorization.lower().startswith("bearer "):
+        return authorization[7:].strip(), None
+
+    if WS_QUERY_TOKEN:
+        token = websocket.query_params.get("token")
+        if token:
+            return token, None
+
+    return None, None
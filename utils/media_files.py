@@ -0,0 +1,116 @@
+import os
+import re
+from mimetypes import guess_type
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse
+from starlette.staticfiles import StaticFiles, NotModifiedResponse
+from utils.file_store import COMPRESSIBLE_EXTENSIONS
+
+# A year, the longest lifetime caches honour
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "no-cache"
+MEDIA_CHUNK_SIZE = 256 * 1024
+
+# Precompressed copies next to a file, preferred in this order
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+# Chat files and their derivatives are named after the hash of their content
+_content_addressed_pattern = re.compile(r"^chat/(?:derived/)?([0-9a-f]{64}(?:_\d+)?)(?:\.[a-z0-9]{1,8})?$")
+
+def accepted_encodings(accept_encoding: str) -> set:
+    """The content codings of an Accept-Encoding header, without those refused with q=0."""
+    accepted = set()
+    for item in accept_encoding.split(","):
+        coding, _, params = item.partition(";")
+        quality = params.strip()
+        if quality.startswith("q="):
+            try:
+                if float(quality[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        if coding.strip():
+            accepted.add(coding.strip().lower())
+    return accepted
+
+class MediaFileResponse(FileResponse):
+    """
+    A FileResponse that lets the server send the file without copying it
+    through Python when it supports the ASGI `http.response.pathsend` or
+    `http.response.zerocopysend` extension (sendfile). Otherwise the file is
+    read in larger chunks than Starlette's default.
+    """
+
+    chunk_size = MEDIA_CHUNK_SIZE
+
+    async def __call__(self, scope, receive, send):
+        self.extensions = scope.get("extensions") or {}
+        await super().__call__(scope, receive, send)
+
+    async def _handle_simple(self, send, send_header_only: bool):
+        if not send_header_only and "http.response.pathsend" in self.extensions:
+            await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+            await send({"type": "http.response.pathsend", "path": os.path.abspath(self.path)})
+        elif not send_header_only and "http.response.zerocopysend" in self.extensions:
+            await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+            with open(self.path, "rb") as file:
+                await send({"type": "http.response.zerocopysend", "file": file, "more_body": False})
+        else:
+            await super()._handle_simple(send, send_header_only)
+
+    async def _handle_single_range(self, send, start: int, end: int, file_size: int, send_header_only: bool):
+        if send_header_only or "http.response.zerocopysend" not in self.extensions:
+            await super()._handle_single_range(send, start, end, file_size, send_header_only)
+            return
+        self.headers["content-range"] = f"bytes {start}-{end - 1}/{file_size}"
+        self.headers["content-length"] = str(end - start)
+        await send({"type": "http.response.start", "status": 206, "headers": self.raw_headers})
+        with open(self.path, "rb") as file:
+            await send({"type": "http.response.zerocopysend", "file": file, "offset": start, "count": end - start, "more_body": False})
+
+class MediaFiles(StaticFiles):
+    """
+    The /static mount.
+
+    Files named after the hash of their content never change, so they are
+    served with `IMMUTABLE_CACHE_CONTROL` and the hash as a strong ETag: a
+    client that has one never asks again. Other files (older uploads, legacy
+    profile pictures) are revalidated, which costs a 304.
+
+    Compressible files are served from their precompressed `.br` or `.gz`
+    copy when the client accepts it. Byte ranges and If-Range are handled by
+    Starlette's FileResponse, on the representation being sent.
+    """
+
+    def file_response(self, full_path, stat_result: os.stat_result, scope, status_code: int = 200):
+        request_headers = Headers(scope=scope)
+        name = os.path.relpath(full_path, os.path.realpath(self.directory)).replace(os.sep, "/")
+        content_addressed = _content_addressed_pattern.match(name)
+
+        headers = {"Cache-Control": IMMUTABLE_CACHE_CONTROL if content_addressed else REVALIDATE_CACHE_CONTROL}
+        media_type = guess_type(str(full_path))[0] or "text/plain"
+        path, encoding = full_path, None
+
+        if status_code == 200 and os.path.splitext(name)[1] in COMPRESSIBLE_EXTENSIONS:
+            headers["Vary"] = "Accept-Encoding"
+            accepted = accepted_encodings(request_headers.get("accept-encoding", ""))
+            for coding, suffix in ENCODINGS:
+                if coding not in accepted:
+                    continue
+                try:
+                    stat_result = os.stat(f"{full_path}{suffix}")
+                except FileNotFoundError:
+                    continue
+                path, encoding = f"{full_path}{suffix}", coding
+                headers["Content-Encoding"] = coding
+                break
+
+        if content_addressed:
+            # Each encoding is a different representation with its own tag
+            tag = content_addressed.group(1) + (f"-{encoding}" if encoding else "")
+            headers["ETag"] = f'"{tag}"'
+
+        response = MediaFileResponse(path, status_code=status_code, stat_result=stat_result, headers=headers, media_type=media_type)
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
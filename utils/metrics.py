@@ -0,0 +1,202 @@
+import time
+import asyncio
+from bisect import bisect_left
+
+# Seconds, from sub-millisecond statements to multi-second stalls
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (64, 128, 256, 512, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+def _format_labels(names: tuple, values: tuple) -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), callback=None):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.children: dict = {}
+        # Reads the value of an unlabelled metric when scraped, for state that is already tracked elsewhere
+        self.callback = callback
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self._child()
+        return child
+
+    def render(self) -> list:
+        if self.callback is not None:
+            try:
+                self.labels().set(self.callback())
+            except Exception:
+                pass
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in sorted(self.children.items()):
+            lines.extend(child.render(self.name, _format_labels(self.label_names, values)))
+        return lines
+
+class _Value:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def set(self, value: float):
+        self.value = value
+
+    def render(self, name: str, labels: str) -> list:
+        return [f"{name}{labels} {_format_value(self.value)}"]
+
+class Counter(Metric):
+    """Monotonic count. Incrementing is a single addition."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), callback=None):
+        super().__init__(name, documentation, labels, callback)
+        if not self.label_names:
+            self.default = self.labels()
+
+    def _child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1):
+        self.default.value += amount
+
+class Gauge(Metric):
+    """A value that goes up and down, either set directly or read from `callback` when scraped."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), callback=None):
+        super().__init__(name, documentation, labels, callback)
+        if not self.label_names:
+            self.default = self.labels()
+
+    def _child(self):
+        return _Value()
+
+    def set(self, value: float):
+        self.default.value = value
+
+class _Buckets:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: tuple):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name: str, labels: str) -> list:
+        lines = []
+        cumulative = 0
+        inner = labels[1:-1] + "," if labels else ""
+        for bound, count in zip(self.bounds + (float("inf"),), self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{inner}le="{_format_value(float(bound))}"}} {cumulative}')
+        lines.append(f"{name}_sum{labels} {_format_value(self.sum)}")
+        lines.append(f"{name}_count{labels} {self.count}")
+        return lines
+
+class Histogram(Metric):
+    """
+    Distribution over fixed buckets. Observing is a bisect and three additions,
+    the cumulative counts are only built when scraped.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        if not self.label_names:
+            self.default = self.labels()
+
+    def _child(self):
+        return _Buckets(self.buckets)
+
+    def observe(self, value: float):
+        self.default.observe(value)
+
+class Registry:
+    def __init__(self):
+        self.metrics: dict = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def _existing(self, name: str, callback):
+        metric = self.metrics.get(name)
+        if metric is not None and callback is not None:
+            # A newer instance of the component registering it reports from now on
+            metric.callback = callback
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: tuple = (), callback=None) -> Counter:
+        return self._existing(name, callback) or self.register(Counter(name, documentation, labels, callback))
+
+    def gauge(self, name: str, documentation: str, labels: tuple = (), callback=None) -> Gauge:
+        return self._existing(name, callback) or self.register(Gauge(name, documentation, labels, callback))
+
+    def histogram(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self.metrics.get(name) or self.register(Histogram(name, documentation, labels, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes up a sleeping task, i.e. how long callbacks block it."""
+
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self.histogram = registry.histogram("vetra_event_loop_lag_seconds", "Delay of the event loop in waking up a timer.")
+        self.gauge = registry.gauge("vetra_event_loop_lag_last_seconds", "Most recent event loop lag sample.")
+        self.task = None
+
+    async def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.perf_counter() - started - self.interval)
+            self.histogram.observe(lag)
+            self.gauge.set(lag)
+
+
+loop_monitor = LoopLagMonitor()
@@ -1,10 +1,108 @@
+import os
+import asyncio
 import bcrypt
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dotenv import load_dotenv
+from utils.metrics import registry
 
-def hash_password(password: str) -> str:
-    salt = bcrypt.gensalt()
+load_dotenv()
+
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", str(max(1, (os.cpu_count() or 1) - 1))))
+PASSWORD_QUEUE_SIZE = int(os.getenv("PASSWORD_QUEUE_SIZE", "32"))
+
+def hash_password(password: str, rounds: int = BCRYPT_ROUNDS) -> str:
+    salt = bcrypt.gensalt(rounds)
     hashed_password = bcrypt.hashpw(password.encode('utf-8'), salt)
     return hashed_password.decode('utf-8')
 
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return bcrypt.checkpw(plain_password.encode('utf-8'), hashed_password.encode('utf-8'))
+
+
+def needs_rehash(hashed_password: str, rounds: int = BCRYPT_ROUNDS) -> bool:
+    """True when a stored hash ($2b$<cost>$...) was made with another cost factor."""
+    try:
+        return int(hashed_password.split('$')[2]) != rounds
+    except (IndexError, ValueError):
+        return True
+
+class PasswordPoolSaturated(Exception):
+    pass
+
+class PasswordHasher:
+    """
+    Runs bcrypt on a dedicated process pool, away from the event loop and from
+    the threadpool shared by everything else.
+
+    At most `workers` hashes run at once and `queue_size` more may wait for a
+    process. Anything beyond that is refused right away with
+    PasswordPoolSaturated, so a wave of logins gets fast errors instead of
+    piling up behind each other.
+    """
+
+    def __init__(self, workers: int = PASSWORD_WORKERS, queue_size: int = PASSWORD_QUEUE_SIZE):
+        self.workers = workers
+        self.capacity = workers + queue_size
+        self.executor = None
+        self.pending = 0
+        self.rejected = 0
+
+        registry.gauge("vetra_password_hashes_pending", "Password hashes running or waiting for a process.", callback=lambda: self.pending)
+        registry.counter("vetra_password_hashes_rejected_total", "Password hashes refused because the pool was full.", callback=lambda: self.rejected)
+
+    async def start(self):
+        if self.executor is None:
+            self.executor = self._create_executor()
+
+    async def stop(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    def _create_executor(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def saturated(self) -> bool:
+        return self.pending >= self.capacity
+
+    async def hash(self, password: str) -> str:
+        return await self._submit(hash_password, password)
+
+    async def verify(self, password: str, hashed_password: str) -> bool:
+        return await self._submit(verify_password, password, hashed_password)
+
+    async def _submit(self, fn, *args):
+        if self.saturated():
+            self.rejected += 1
+            raise PasswordPoolSaturated()
+        if self.executor is None:
+            self.executor = self._create_executor()
+
+        executor = self.executor
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+        except BrokenProcessPool:
+            # A worker died, the pool is unusable from now on
+            if self.executor is executor:
+                executor.shutdown(wait=False, cancel_futures=True)
+                self.executor = self._create_executor()
+            raise
+        finally:
+            self.pending -= 1
+
+    def stats(self) -> dict:
+        return {
+            'workers': self.workers,
+            'capacity': self.capacity,
+            'pending': self.pending,
+            'rejected': self.rejected,
+            'rounds': BCRYPT_ROUNDS,
+        }
+
+
+password_hasher = PasswordHasher()
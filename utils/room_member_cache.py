@@ -0,0 +1,77 @@
+import os
+import logging
+from collections import OrderedDict
+from dotenv import load_dotenv
+from utils.metrics import registry
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+ROOM_MEMBER_CACHE_ROOMS = int(os.getenv("ROOM_MEMBER_CACHE_ROOMS", "10000"))
+
+class RoomMemberCache:
+    """
+    The member ids of active rooms, so that a room post is fanned out without
+    reading the member list again.
+
+    A room enters the cache when its members are read for a post, and is
+    dropped whenever members are added or removed. Membership changes on
+    other workers are published on the bus like history changes. Rooms are
+    evicted least recently used first above `ROOM_MEMBER_CACHE_ROOMS`.
+    """
+
+    def __init__(self, max_rooms: int = ROOM_MEMBER_CACHE_ROOMS):
+        self.max_rooms = max_rooms
+        self.entries: OrderedDict = OrderedDict()
+        # Rooms being read from the database -> whether they changed meanwhile
+        self.loading: dict = {}
+        self.bus = None
+
+        self.hits = registry.counter("vetra_room_member_cache_hits_total", "Room posts fanned out from cached members.")
+        self.misses = registry.counter("vetra_room_member_cache_misses_total", "Room posts that read the members from the database.")
+        registry.gauge("vetra_room_member_cache_rooms", "Rooms in the member cache.", callback=lambda: len(self.entries))
+
+    def start(self, bus):
+        self.bus = bus
+
+    def get(self, room_id: int):
+        member_ids = self.entries.get(room_id)
+        if member_ids is None:
+            self.misses.inc()
+            return None
+        self.entries.move_to_end(room_id)
+        self.hits.inc()
+        return member_ids
+
+    def begin_fill(self, room_id: int):
+        self.loading.setdefault(room_id, False)
+
+    def cancel_fill(self, room_id: int):
+        self.loading.pop(room_id, None)
+
+    def fill(self, room_id: int, member_ids: tuple):
+        """Caches the members read from the database, unless they changed during the read."""
+        changed = self.loading.pop(room_id, True)
+        if changed or self.max_rooms <= 0:
+            return
+        self.entries[room_id] = member_ids
+        while len(self.entries) > self.max_rooms:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, room_ids):
+        for room_id in room_ids:
+            self.entries.pop(room_id, None)
+            if room_id in self.loading:
+                self.loading[room_id] = True
+
+    async def publish(self, room_ids):
+        """Tells the other workers that the members of these rooms changed."""
+        if self.bus is None or not room_ids:
+            return
+        try:
+            await self.bus.broadcast({'op': 'room_members', 'room_ids': list(room_ids)})
+        except Exception as e:
+            logger.warning("Failed to publish room member changes: %s", e)
+
+
+room_member_cache = RoomMemberCache()
@@ -0,0 +1,184 @@
+import os
+import asyncio
+import logging
+from bisect import insort
+from collections import OrderedDict
+from typing import Optional
+from dotenv import load_dotenv
+from api.controller.RosterController import prune_roster_changes
+from db.db import async_session
+from utils.metrics import registry
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+ROSTER_CACHE_MAX_BYTES = int(os.getenv("ROSTER_CACHE_MAX_MB", "32")) * 1024 * 1024
+ROSTER_LOG_SIZE = int(os.getenv("ROSTER_LOG_SIZE", "100000"))
+ROSTER_PRUNE_SECONDS = float(os.getenv("ROSTER_PRUNE_SECONDS", "60"))
+
+class _ViewerRoster:
+    __slots__ = ("version", "contacts", "size")
+
+    def __init__(self, version: int):
+        self.version = version
+        # peer_id -> serialized entry, only for the users this viewer shares a conversation with
+        self.contacts: dict = {}
+        self.size = 0
+
+def _encode(user) -> bytes:
+    return user.model_dump_json().encode()
+
+class RosterCache:
+    """
+    Pre-serialized `GET /users` rosters, patched from the roster change log.
+
+    Most users of a roster look the same to every viewer: no last message,
+    no unread chats. Those entries are serialized once and shared. Each
+    viewer only keeps the entries of their own conversations. When a version
+    moves, only the users named in the change log since the cached version
+    are read again, and a roster is assembled by joining the cached bytes.
+    The reads themselves are done by `fetch_roster`.
+
+    Viewers are evicted least recently used first above `ROSTER_CACHE_MAX_MB`.
+    The change log itself is trimmed to its last `ROSTER_LOG_SIZE` entries.
+    """
+
+    def __init__(self, max_bytes: int = ROSTER_CACHE_MAX_BYTES, log_size: int = ROSTER_LOG_SIZE, prune_seconds: float = ROSTER_PRUNE_SECONDS):
+        self.max_bytes = max_bytes
+        self.log_size = log_size
+        self.prune_interval = prune_seconds
+        self.version = -1
+        self.entries: dict = {}
+        self.order: list = []
+        self.viewers: OrderedDict = OrderedDict()
+        self.size = 0
+        self.task = None
+
+        self.patches = registry.counter("vetra_roster_cache_patches_total", "Rosters brought up to date from the change log.")
+        self.rebuilds = registry.counter("vetra_roster_cache_rebuilds_total", "Rosters read in full.")
+        registry.gauge("vetra_roster_cache_viewers", "Viewers with a cached roster.", callback=lambda: len(self.viewers))
+
+    async def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def body(self, viewer_id: int) -> bytes:
+        contacts = self.viewers[viewer_id].contacts
+        return b"[" + b",".join(self._entries_for(viewer_id, contacts, self._ids(contacts))) + b"]"
+
+    def delta(self, viewer_id: int, version: int, changed) -> bytes:
+        """A `RosterDelta` of the users in `changed`, or of everyone when `changed` is None."""
+        contacts = self.viewers[viewer_id].contacts
+        ids = self._ids(contacts) if changed is None else sorted(changed)
+        users = b",".join(self._entries_for(viewer_id, contacts, ids))
+        full = b"true" if changed is None else b"false"
+        return b'{"version":' + str(version).encode() + b',"full":' + full + b',"users":[' + users + b"]}"
+
+    def fill_entries(self, started: int, version: int, users: list):
+        """Replaces the shared entries with `users`, read after version `started` was current."""
+        # Another request may have applied newer data meanwhile
+        if self.version != started:
+            return
+        self.entries = {user.id: _encode(user) for user in users}
+        self.order = sorted(self.entries)
+        self.version = version
+
+    def patch_entries(self, started: int, version: int, users: list):
+        if self.version != started:
+            return
+        for user in users:
+            if user.id not in self.entries:
+                insort(self.order, user.id)
+            self.entries[user.id] = _encode(user)
+        self.version = version
+
+    def viewer_version(self, viewer_id: int) -> Optional[int]:
+        roster = self.viewers.get(viewer_id)
+        if roster is None:
+            return None
+        self.viewers.move_to_end(viewer_id)
+        return roster.version
+
+    def affected(self, viewer_id: int, changed: set, peers: set) -> set:
+        """
+        The users to read again for a viewer. The changes of other users only
+        matter for their contacts, everyone else uses the shared entries.
+        """
+        ids = (changed & self.viewers[viewer_id].contacts.keys()) | peers
+        ids.discard(viewer_id)
+        return ids
+
+    def fill_viewer(self, viewer_id: int, version: int, users: list):
+        previous = self.viewers.get(viewer_id)
+        if previous is not None and previous.version >= version:
+            return
+        self.rebuilds.inc()
+        roster = _ViewerRoster(version)
+        for user in users:
+            self._set_contact(roster, user)
+        if previous is not None:
+            self.size -= previous.size
+        self.viewers[viewer_id] = roster
+        self.size += roster.size
+        self._evict()
+
+    def patch_viewer(self, viewer_id: int, started: int, version: int, users: list):
+        roster = self.viewers.get(viewer_id)
+        if roster is None or roster.version != started:
+            return
+        self.patches.inc()
+        before = roster.size
+        for user in users:
+            self._set_contact(roster, user)
+        roster.version = version
+        self.size += roster.size - before
+        self._evict()
+
+    def _ids(self, contacts: dict) -> list:
+        # A contact can be newer than the shared entries when they signed up a moment ago
+        if all(peer_id in self.entries for peer_id in contacts):
+            return self.order
+        return sorted(set(self.order) | contacts.keys())
+
+    def _entries_for(self, viewer_id: int, contacts: dict, ids):
+        for user_id in ids:
+            if user_id == viewer_id:
+                continue
+            entry = contacts.get(user_id) or self.entries.get(user_id)
+            if entry is not None:
+                yield entry
+
+    def _set_contact(self, roster: _ViewerRoster, user):
+        previous = roster.contacts.pop(user.id, None)
+        if previous is not None:
+            roster.size -= len(previous)
+        if user.last_message is not None or user.unread_count:
+            encoded = _encode(user)
+            roster.contacts[user.id] = encoded
+            roster.size += len(encoded)
+
+    def _evict(self):
+        while self.size > self.max_bytes and len(self.viewers) > 1:
+            _, evicted = self.viewers.popitem(last=False)
+            self.size -= evicted.size
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.prune_interval)
+            try:
+                async with async_session() as session:
+                    await prune_roster_changes(self.log_size, session)
+            except Exception as e:
+                logger.warning("Failed to prune roster changes: %s", e)
+
+
+roster_cache = RosterCache()
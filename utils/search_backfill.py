@@ -0,0 +1,62 @@
+import os
+import asyncio
+import logging
+from dotenv import load_dotenv
+from api.controller.SearchController import backfill_search_index
+from db.db import async_session
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+SEARCH_BACKFILL_CHUNK = int(os.getenv("SEARCH_BACKFILL_CHUNK", "5000"))
+SEARCH_BACKFILL_PAUSE_MS = float(os.getenv("SEARCH_BACKFILL_PAUSE_MS", "50"))
+
+class SearchBackfill:
+    """
+    Indexes the chats written before the search index existed, one chunk per
+    transaction with a pause in between, so that live writes keep getting the
+    database lock. Progress is stored with each chunk and picked up again
+    after a restart. New chats are indexed as they are inserted.
+    """
+
+    def __init__(self, chunk: int = SEARCH_BACKFILL_CHUNK, pause_ms: float = SEARCH_BACKFILL_PAUSE_MS):
+        self.chunk = chunk
+        self.pause = pause_ms / 1000
+        self.task = None
+
+    async def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def _run(self):
+        chunks = 0
+        while True:
+            try:
+                async with async_session() as session:
+                    more = await backfill_search_index(self.chunk, session)
+            except Exception as e:
+                logger.warning("Failed to backfill the search index: %s", e)
+                more = True
+                await asyncio.sleep(5)
+
+            if not more:
+                break
+            chunks += 1
+            if chunks % 100 == 0:
+                logger.info("Search index backfill: %s chunks indexed", chunks)
+            await asyncio.sleep(self.pause)
+
+        if chunks:
+            logger.info("Search index backfill complete")
+
+
+search_backfill = SearchBackfill()
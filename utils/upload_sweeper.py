@@ -0,0 +1,47 @@
+import os
+import asyncio
+import logging
+from dotenv import load_dotenv
+from api.controller.UploadController import sweep_uploads
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+UPLOAD_SWEEP_SECONDS = float(os.getenv("UPLOAD_SWEEP_SECONDS", "600"))
+
+class UploadSweeper:
+    """
+    Removes abandoned resumable uploads while the server runs, instead of
+    only at startup, so that their data files and running hashes do not
+    accumulate until the next restart.
+    """
+
+    def __init__(self, interval: float = UPLOAD_SWEEP_SECONDS):
+        self.interval = interval
+        self.task = None
+
+    async def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                removed = await sweep_uploads()
+                if removed:
+                    logger.info("Removed %s abandoned uploads", len(removed))
+            except Exception as e:
+                logger.warning("Failed to sweep uploads: %s", e)
+
+
+upload_sweeper = UploadSweeper()
@@ -0,0 +1,145 @@
+import os
+import time
+import asyncio
+from dotenv import load_dotenv
+from api.controller.ChatController import insert_chats
+from db.db import async_session
+from models.Chat import conversation_key
+from utils.history_cache import history_cache
+from utils.metrics import registry
+
+load_dotenv()
+
+CHAT_BATCH_SIZE = int(os.getenv("CHAT_BATCH_SIZE", "128"))
+CHAT_BATCH_MAX_DELAY_MS = float(os.getenv("CHAT_BATCH_MAX_DELAY_MS", "5"))
+CHAT_QUEUE_MAXSIZE = int(os.getenv("CHAT_QUEUE_MAXSIZE", "10000"))
+
+batch_seconds = registry.histogram("vetra_chat_batch_seconds", "Time spent writing a batch of chats, fallbacks included.")
+batch_messages = registry.histogram("vetra_chat_batch_messages", "Number of chats per written batch.", buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512))
+
+class ChatWriter:
+    """
+    Write-behind stage for incoming chats.
+
+    Messages from every socket are queued and written in micro-batches, one
+    transaction per batch, so that a burst of N messages costs one commit
+    instead of N. `submit` only returns once the batch holding the message is
+    durable, with the chat and the inbox events that deliver it, which is what
+    gates the sender's `msg_update`.
+    """
+
+    def __init__(self, batch_size: int = CHAT_BATCH_SIZE, max_delay_ms: float = CHAT_BATCH_MAX_DELAY_MS, queue_maxsize: int = CHAT_QUEUE_MAXSIZE):
+        self.batch_size = batch_size
+        self.max_delay = max_delay_ms / 1000
+        self.queue_maxsize = queue_maxsize
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_maxsize)
+        self.task = None
+
+        self.batches_written = 0
+        self.messages_written = 0
+        self.messages_failed = 0
+        self.last_batch_size = 0
+        self.last_commit_ms = 0.0
+
+        registry.gauge("vetra_chat_queue_depth", "Chats waiting to be written.", callback=lambda: self.queue.qsize())
+        registry.counter("vetra_chats_written_total", "Chats stored.", callback=lambda: self.messages_written)
+        registry.counter("vetra_chats_failed_total", "Chats that could not be stored.", callback=lambda: self.messages_failed)
+
+    async def start(self):
+        if self.task is None:
+            self.queue = asyncio.Queue(maxsize=self.queue_maxsize)
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # Flush whatever is still queued before shutting down
+        if self.task is not None:
+            await self.queue.put(None)
+            await self.task
+            self.task = None
+
+    async def submit(self, chat_data: dict):
+        future = asyncio.get_running_loop().create_future()
+        # Blocks the submitting socket when the queue is full
+        await self.queue.put((chat_data, future))
+        return await future
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue.qsize(),
+            "queue_maxsize": self.queue.maxsize,
+            "batch_size": self.batch_size,
+            "max_delay_ms": self.max_delay * 1000,
+            "batches_written": self.batches_written,
+            "messages_written": self.messages_written,
+            "messages_failed": self.messages_failed,
+            "last_batch_size": self.last_batch_size,
+            "last_commit_ms": round(self.last_commit_ms, 3),
+        }
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+
+        while not stopping:
+            item = await self.queue.get()
+            if item is None:
+                break
+
+            batch = [item]
+            deadline = loop.time() + self.max_delay
+
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self.queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            await self._write(batch)
+
+    async def _write(self, batch: list):
+        started = time.perf_counter()
+        try:
+            async with async_session() as session:
+                results = await insert_chats([chat_data for chat_data, _ in batch], session)
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+            self.messages_written += len(batch)
+        except Exception:
+            # A single bad message (e.g. a duplicate uuid) must not fail the
+            # rest of its batch, so fall back to one transaction per message
+            for chat_data, future in batch:
+                try:
+                    async with async_session() as session:
+                        result = (await insert_chats([chat_data], session))[0]
+                    self.messages_written += 1
+                    if not future.done():
+                        future.set_result(result)
+                except Exception as e:
+                    self.messages_failed += 1
+                    if not future.done():
+                        future.set_exception(e)
+
+        await history_cache.publish({
+            conversation_key(int(chat_data['sender_id']), int(chat_data['receiver_id'])) for chat_data, _ in batch
+        })
+
+        self.batches_written += 1
+        self.last_batch_size = len(batch)
+        self.last_commit_ms = (time.perf_counter() - started) * 1000
+        batch_seconds.observe(self.last_commit_ms / 1000)
+        batch_messages.observe(len(batch))
+
+
+chat_writer = ChatWriter()
@@ -0,0 +1,82 @@
+import orjson
+import msgpack
+from fastapi import WebSocket, WebSocketDisconnect
+
+class JsonCodec:
+    """Text frames holding JSON, what every client understands."""
+
+    name = "json"
+    pong = "pong"
+
+    def encode(self, payload: dict) -> str:
+        return orjson.dumps(payload).decode()
+
+    def decode(self, frame) -> dict:
+        return orjson.loads(frame)
+
+class MsgpackCodec:
+    """Binary frames holding MessagePack, smaller and cheaper to parse than JSON."""
+
+    name = "msgpack"
+    pong = b"pong"
+
+    def encode(self, payload: dict) -> bytes:
+        return msgpack.packb(payload, use_bin_type=True)
+
+    def decode(self, frame) -> dict:
+        if isinstance(frame, str):
+            # A client may still send the odd text frame
+            return orjson.loads(frame)
+        return msgpack.unpackb(frame, raw=False)
+
+
+JSON = JsonCodec()
+MSGPACK = MsgpackCodec()
+
+# Preferred first when a client offers several
+CODECS = (MSGPACK, JSON)
+
+def negotiate(offered: list):
+    """
+    Picks the codec of a handshake from the subprotocols the client offered.
+    Returns the codec and the subprotocol to accept with, None when the client
+    did not ask for one (plain JSON).
+    """
+    for codec in CODECS:
+        if codec.name in offered:
+            return codec, codec.name
+    return JSON, None
+
+class OutboundEvent:
+    """
+    An event to push, encoded at most once per codec however many
+    connections it is sent to.
+    """
+
+    __slots__ = ("payload", "encoded")
+
+    def __init__(self, payload: dict):
+        self.payload = payload
+        self.encoded: dict = {}
+
+    def encode(self, codec):
+        frame = self.encoded.get(codec.name)
+        if frame is None:
+            frame = self.encoded[codec.name] = codec.encode(self.payload)
+        return frame
+
+def is_ping(frame) -> bool:
+    """
+    A bare "ping" frame, text or binary. It is answered with the codec's bare
+    "pong" without being decoded, and cannot be mistaken for an event since
+    it is neither valid JSON nor a MessagePack map.
+    """
+    return frame == "ping" or frame == b"ping"
+
+async def receive_frame(websocket: WebSocket):
+    """Returns the next text or binary frame of a connection."""
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000), message.get("reason"))
+    text = message.get("text")
+    return text if text is not None else message.get("bytes")
@@ -0,0 +1,181 @@
+import os
+import time
+import asyncio
+from collections import deque
+from fastapi import WebSocket
+from dotenv import load_dotenv
+from websocket.Codec import JSON
+from utils.metrics import registry
+import logging
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+SEND_BUFFER_MAX_BYTES = int(os.getenv("SEND_BUFFER_MAX_BYTES", str(1024 * 1024)))
+SEND_BUFFER_MAX_MESSAGES = int(os.getenv("SEND_BUFFER_MAX_MESSAGES", "1000"))
+
+# Close code of a slow consumer, the client reconnects with ?since=<seq> and misses nothing
+SLOW_CONSUMER_CLOSE_CODE = 4002
+
+# What a connection that falls behind does with each class of event, the first choice is the default:
+#   ephemeral (typing indicators): "drop" them while congested, or "keep" sending the latest one
+#   presence: "merge" the changes into one update until the connection catches up, or "keep" sending them
+#   reliable: "disconnect" with SLOW_CONSUMER_CLOSE_CODE when the buffer overflows, or "drop" the frame
+#             and leave it to retransmission and the inbox
+OVERFLOW_POLICIES = {"ephemeral": ("drop", "keep"), "presence": ("merge", "keep"), "reliable": ("disconnect", "drop")}
+
+def parse_overflow_policy(spec: str) -> dict:
+    """Reads "class=policy" pairs, e.g. "ephemeral=keep,reliable=drop", over the defaults."""
+    policy = {event_class: choices[0] for event_class, choices in OVERFLOW_POLICIES.items()}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        event_class, _, choice = item.partition("=")
+        event_class, choice = event_class.strip(), choice.strip()
+        if choice not in OVERFLOW_POLICIES.get(event_class, ()):
+            raise ValueError(f"Invalid SEND_OVERFLOW_POLICY entry {item!r}")
+        policy[event_class] = choice
+    return policy
+
+SEND_OVERFLOW_POLICY = parse_overflow_policy(os.getenv("SEND_OVERFLOW_POLICY", ""))
+
+ephemeral_dropped = registry.counter("vetra_ephemeral_dropped_total", "Typing indicators dropped because the connection was congested.")
+slow_consumers = registry.counter("vetra_slow_consumer_disconnects_total", "Connections closed because their send buffer overflowed.")
+reliable_dropped = registry.counter("vetra_reliable_dropped_total", "Reliable frames left to retransmission because the send buffer was full.")
+
+class Connection:
+    """
+    A connected websocket and its outbound queue.
+
+    Frames are sent in order by a single writer task per connection, so
+    producers only append to the queue and never await the socket, and a slow
+    socket only ever holds up its own writer.
+
+    Ephemeral frames (typing indicators) are not queued but kept in slots: a
+    newer frame for the same slot replaces the one still waiting, and they
+    are written after the reliable frames that are ready. They are dropped
+    altogether while the connection is congested, i.e. its queue is over half
+    of either limit.
+
+    The queue is bounded by `SEND_BUFFER_MAX_BYTES` and
+    `SEND_BUFFER_MAX_MESSAGES`. A client that falls further behind is
+    disconnected with `SLOW_CONSUMER_CLOSE_CODE` instead of buffering without
+    end, everything reliable is in its inbox for when it resumes.
+
+    These are the default `SEND_OVERFLOW_POLICY`, each class of event can be
+    set to a different policy (see `OVERFLOW_POLICIES`).
+
+    Frames are already encoded with the codec negotiated at the handshake,
+    bytes go out as binary frames and str as text frames.
+    """
+
+    def __init__(self, user_id: int, websocket: WebSocket, codec=JSON, max_bytes: int = SEND_BUFFER_MAX_BYTES, max_messages: int = SEND_BUFFER_MAX_MESSAGES, overflow_policy: dict = SEND_OVERFLOW_POLICY, on_broken=None):
+        self.user_id = user_id
+        self.websocket = websocket
+        self.codec = codec
+        # Awaited with this connection once a send fails, so the owner can drop it
+        self.on_broken = on_broken
+        self.max_bytes = max_bytes
+        self.max_messages = max_messages
+        self.overflow_policy = overflow_policy
+        self.outbound: deque = deque()
+        self.outbound_bytes = 0
+        self.closed = False
+        # time.monotonic() of the last frame received, checked by the idle sweep
+        self.last_seen = time.monotonic()
+        self.ephemeral: dict = {}
+        self.ready = asyncio.Event()
+        self.drained = asyncio.Event()
+        self.drained.set()
+        self.resume_task = None
+        self.task = asyncio.create_task(self._writer())
+
+    @property
+    def congested(self) -> bool:
+        return self.outbound_bytes * 2 > self.max_bytes or len(self.outbound) * 2 > self.max_messages
+
+    def defers(self, event_class: str) -> bool:
+        """Whether events of `event_class` are held back right now, i.e. congested with a drop or merge policy."""
+        return self.overflow_policy[event_class] != "keep" and self.congested
+
+    def send(self, message):
+        if self.closed:
+            return
+        # A single oversized frame still goes out when nothing is ahead of it
+        if self.outbound and (len(self.outbound) >= self.max_messages or self.outbound_bytes + len(message) > self.max_bytes):
+            if self.overflow_policy["reliable"] == "drop":
+                reliable_dropped.inc()
+            else:
+                self.overflow()
+            return
+        self.outbound.append(message)
+        self.outbound_bytes += len(message)
+        self.drained.clear()
+        self.ready.set()
+
+    def send_ephemeral(self, slot: str, message):
+        if self.closed:
+            return
+        if self.defers("ephemeral"):
+            ephemeral_dropped.inc()
+            self.ephemeral.pop(slot, None)
+            return
+        self.ephemeral[slot] = message
+        self.ready.set()
+
+    def overflow(self):
+        """Gives up on a client that cannot keep up. The receive loop sees the close and disconnects it."""
+        slow_consumers.inc()
+        logger.warning(
+            "Closing slow consumer %s with %s frames (%s bytes) queued",
+            self.user_id, len(self.outbound), self.outbound_bytes, extra={"user_id": self.user_id}
+        )
+        self.close()
+        asyncio.create_task(self._close_socket())
+
+    async def _close_socket(self):
+        try:
+            await self.websocket.close(code=SLOW_CONSUMER_CLOSE_CODE, reason="Slow consumer")
+        except Exception:
+            pass
+
+    async def _broken(self):
+        # Nothing more goes out, a resume waiting for the buffer to drain stops
+        self.close()
+        self.drained.set()
+        if self.on_broken is not None:
+            await self.on_broken(self)
+        try:
+            await self.websocket.close(code=1011, reason="Send failed")
+        except Exception:
+            pass
+
+    def close(self):
+        self.closed = True
+        # The writer closes its own connection when a send fails
+        if self.task is not asyncio.current_task():
+            self.task.cancel()
+        if self.resume_task:
+            self.resume_task.cancel()
+        self.outbound.clear()
+        self.outbound_bytes = 0
+        self.ephemeral.clear()
+
+    async def _writer(self):
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            while self.outbound or self.ephemeral:
+                if self.outbound:
+                    message = self.outbound.popleft()
+                    self.outbound_bytes -= len(message)
+                else:
+                    message = self.ephemeral.pop(next(iter(self.ephemeral)))
+                try:
+                    if isinstance(message, bytes):
+                        await self.websocket.send_bytes(message)
+                    else:
+                        await self.websocket.send_text(message)
+                except Exception as e:
+                    logger.info("Failed to send message to %s: %s", self.user_id, e)
+                    await self._broken()
+                    return
+            self.drained.set()
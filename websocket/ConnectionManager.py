@@ -1,97 +1,437 @@
+import os
 import uuid
 import time
-import json
 import asyncio
+import logging
+from collections import OrderedDict
 from fastapi import WebSocket
 from dotenv import load_dotenv
-from api.controller.UserController import update_status
-from db.db import SessionDep
+from websocket.Connection import Connection
+from websocket.Codec import JSON, OutboundEvent
+from websocket.Presence import presence
+from websocket.Inbox import inbox
+from websocket.TimerWheel import TimerWheel
+from websocket.MessageBus import MessageBus, create_bus
+from websocket.Directory import create_directory
+from utils.history_cache import history_cache
+from utils.room_member_cache import room_member_cache
+from utils.metrics import registry, SIZE_BUCKETS
 
 load_dotenv()
+logger = logging.getLogger(__name__)
+
+PENDING_MAX_MESSAGES = int(os.getenv("PENDING_MAX_MESSAGES", "100000"))
+PENDING_MAX_BYTES = int(os.getenv("PENDING_MAX_BYTES", str(64 * 1024 * 1024)))
+PENDING_MAX_PER_USER = int(os.getenv("PENDING_MAX_PER_USER", "1000"))
+TYPING_DEBOUNCE_MS = float(os.getenv("TYPING_DEBOUNCE_MS", "1000"))
+TYPING_STATE_SIZE = 100000
+# A connection that sends nothing, not even a ping, for this long is closed
+IDLE_TIMEOUT_SECONDS = float(os.getenv("IDLE_TIMEOUT_SECONDS", "15"))
+
+messages_queued = registry.counter("vetra_messages_queued_total", "Reliable messages sent to a local connection.")
+messages_retransmitted = registry.counter("vetra_messages_retransmitted_total", "Unacked messages sent again.")
+messages_acked = registry.counter("vetra_messages_acked_total", "Messages acknowledged by the client.")
+messages_expired = registry.counter("vetra_messages_expired_total", "Messages given up on after their last retry or a disconnect.")
+messages_evicted = registry.counter("vetra_messages_evicted_total", "Unacked messages dropped to stay under the pending caps.")
+multicast_recipients = registry.histogram("vetra_multicast_recipients", "Local connections a room message was written to.", buckets=(0, 1, 5, 10, 50, 100, 250, 500, 1000))
+messages_forwarded = registry.counter("vetra_messages_forwarded_total", "Messages and indicators forwarded to another worker.")
+idle_disconnects = registry.counter("vetra_idle_disconnects_total", "Connections closed for receiving nothing within the idle timeout.")
+typing_debounced = registry.counter("vetra_typing_debounced_total", "Typing indicators dropped as repeats.")
+ack_seconds = registry.histogram("vetra_message_ack_seconds", "Time from first sending a message to its ack.")
+frame_bytes = registry.histogram("vetra_frame_bytes", "Size of websocket frames.", labels=("direction",), buckets=SIZE_BUCKETS)
+outbound_frame_bytes = frame_bytes.labels("out")
+
+class PendingMessage:
+    __slots__ = ("receiver_id", "message", "retries", "retry_interval", "attempts", "seqs", "queued_at")
+
+    def __init__(self, receiver_id: int, message, retries: int, retry_interval: float, seqs: tuple = ()):
+        self.receiver_id = receiver_id
+        self.message = message
+        self.retries = retries
+        self.retry_interval = retry_interval
+        self.attempts = 1
+        # Inbox sequence numbers that are delivered once this message is acked
+        self.seqs = seqs
+        self.queued_at = time.monotonic()
 
 class ConnectionManager:
-    def __init__(self):
+    def __init__(self, bus: MessageBus = None, directory=None):
         self.active_connections: dict = {}
-        self.pending_messages: dict = {}
+        # Other workers are reached through the bus, the directory says which
+        # worker holds a user's socket
+        self.bus = bus or create_bus()
+        self.directory = directory or create_directory()
+        # (receiver_id, message_id) -> PendingMessage, oldest first, and the
+        # same keys grouped per receiver for per-user caps and cleanup
+        self.pending_messages: OrderedDict = OrderedDict()
+        self.pending_by_user: dict = {}
+        self.pending_bytes = 0
+        self.retransmit_wheel = TimerWheel(self._retransmit)
+        self.idle_timeout = IDLE_TIMEOUT_SECONDS
+        # One deadline per connection, see _sweep_idle
+        self.idle_wheel = TimerWheel(self._sweep_idle, tick=1.0)
+        # (sender_id, receiver_id) -> (last indicator sent, when)
+        self.typing_sent: dict = {}
+        self.typing_debounce = TYPING_DEBOUNCE_MS / 1000
 
-    async def connect(self, websocket: WebSocket, user_id: int, session: SessionDep):
-        if user_id in self.active_connections:
-            return
-        self.active_connections[user_id] = websocket
+        registry.gauge("vetra_connections", "Open websocket connections on this worker.", callback=lambda: len(self.active_connections))
+        registry.gauge("vetra_pending_messages", "Sent messages waiting for an ack.", callback=lambda: len(self.pending_messages))
+        registry.gauge("vetra_pending_bytes", "Size of the messages waiting for an ack.", callback=lambda: self.pending_bytes)
+        registry.gauge("vetra_retransmit_timers", "Retransmissions scheduled on the timer wheel.", callback=lambda: len(self.retransmit_wheel))
+        registry.gauge("vetra_idle_timers", "Connections with an idle deadline on the timer wheel.", callback=lambda: len(self.idle_wheel))
+
+    @property
+    def worker_id(self) -> str:
+        return self.bus.worker_id
+
+    async def start(self):
+        await self.directory.clear(self.worker_id)
+        await self.bus.start(self.handle_bus_event)
+        history_cache.start(self.bus)
+        room_member_cache.start(self.bus)
+        await self.retransmit_wheel.start()
+        await self.idle_wheel.start()
+        await inbox.start()
+
+    async def stop(self):
+        await self.retransmit_wheel.stop()
+        await self.idle_wheel.stop()
+        await inbox.stop()
+        for connection in self.active_connections.values():
+            connection.close()
+        await self.directory.clear(self.worker_id)
+        await self.bus.stop()
+
+    async def connect(self, websocket: WebSocket, user_id: int, codec=JSON) -> Connection:
+        previous = self.active_connections.get(user_id)
+        connection = self.active_connections[user_id] = Connection(user_id, websocket, codec, on_broken=self._drop_broken)
+        self.idle_wheel.schedule(connection, self.idle_timeout)
+        if previous:
+            # The newest socket takes over, the old one can no longer receive
+            self.idle_wheel.cancel(previous)
+            previous.close()
+            self._drop_pending_for(user_id)
+            try:
+                # Ends the old receive loop, which could otherwise still post as this user
+                await previous.websocket.close(code=4001, reason="Connected elsewhere")
+            except Exception:
+                pass
+            return connection
         try:
-            user = update_status(user_id, "Online", session)
-            await self.notify_status_change(user_id, "Online")
-            return user
-        except Exception as e:
-            print(f"Failed to connect user {user_id}: {e}")
+            previous_worker = await self.directory.register(user_id, self.worker_id)
+            if previous_worker and previous_worker != self.worker_id:
+                await self.bus.send(previous_worker, {'op': 'evict', 'user_id': user_id})
+            await presence.connect(user_id)
+        except Exception:
+            logger.exception("Failed to connect user %s", user_id)
+        return connection
 
-    async def disconnect(self, user_id: int, session: SessionDep):
+    async def disconnect(self, user_id: int, websocket: WebSocket):
+        connection = self.active_connections.get(user_id)
+        if not connection or connection.websocket is not websocket:
+            return
         self.active_connections.pop(user_id)
+        self.idle_wheel.cancel(connection)
+        connection.close()
+        self._drop_pending_for(user_id)
         try:
-            update_status(user_id, "Offline", session)
-            print(f"User {user_id} disconnected")
-            await self.notify_status_change(user_id, "Offline")
-        except Exception as e:
-            print(f"Failed to disconnect user {user_id}: {e}")
+            presence.disconnect(user_id)
+            await self.directory.unregister(user_id, self.worker_id)
+            logger.info("User %s disconnected", user_id)
+        except Exception:
+            logger.exception("Failed to disconnect user %s", user_id)
+
+    async def _drop_broken(self, connection: Connection):
+        await self.disconnect(connection.user_id, connection.websocket)
 
-    async def send_chat(self, chat):
-        websocket = self.active_connections.get(chat['receiver_id'])
+    async def deliver(self, user_id: int, seq: int, payload: dict):
+        """Pushes an event that is already stored in the user's inbox."""
         message_id = self.generate_message_id()
-        message = json.dumps({'type': 'chat', 'message_id': message_id, **chat})
+        event = OutboundEvent({**payload, 'seq': seq, 'message_id': message_id})
+        await self.queue_message(user_id, event, message_id, seqs=(seq,))
 
-        if websocket:
-            await self.queue_message(chat['receiver_id'], message, message_id)
+    async def resume(self, user_id: int, since: int):
+        """
+        Streams the inbox events after `since` in batches. The next batch is only
+        read once the previous one has been written to the socket.
+        """
+        connection = self.active_connections.get(user_id)
+        if not connection:
+            return
+        connection.resume_task = asyncio.current_task()
+        try:
+            while True:
+                events, more = await inbox.fetch(user_id, since)
+                if self.active_connections.get(user_id) is not connection:
+                    return
 
-    async def update_msg_status(self, user_id: int, receiver_id:int, uuid: str):
-        websocket = self.active_connections.get(user_id)
-        if websocket:
-            message_id = self.generate_message_id()
-            message = json.dumps({'type': 'msg_update',  'receiver_id': receiver_id, 'uuid': uuid, 'message_id': message_id})
-            await self.queue_message(user_id, message, message_id)
+                message_id = self.generate_message_id()
+                event = OutboundEvent({
+                    'type': 'inbox',
+                    'events': [{**payload, 'seq': seq} for seq, payload in events],
+                    'more': more,
+                    'message_id': message_id
+                })
+                await self.queue_message(user_id, event, message_id, seqs=tuple(seq for seq, _ in events))
+
+                if not more:
+                    return
+                since = events[-1][0]
+                await connection.drained.wait()
+                if connection.closed:
+                    return
+        except Exception:
+            logger.exception("Failed to resume inbox for %s", user_id)
+        finally:
+            if connection.resume_task is asyncio.current_task():
+                connection.resume_task = None
 
     async def typing_indicator(self, type: str, receiver_id: int, sender_id: int):
-        websocket = self.active_connections.get(receiver_id)
-        if websocket:
-            try:
-                message_id = self.generate_message_id()
-                message = json.dumps({'type': type, 'sender_id': sender_id, 'message_id': message_id})
-                await self.queue_message(receiver_id, message, message_id)
-            except Exception as e:
-                print(f"Failed to send typing indicator to {receiver_id}: {e}")
-
-    async def acknowledge_message(self, message_id: str):
-        if message_id in self.pending_messages:
-            del self.pending_messages[message_id]
-
-    async def queue_message(self, receiver_id: int, message: str, message_id: str, retries: int = 5, retry_interval: int = 2):
-        self.pending_messages[message_id] = message
-        websocket = self.active_connections.get(receiver_id)
-        if websocket:
-            asyncio.create_task(self._retry_send_message(receiver_id, message, message_id, retries, retry_interval))
-
-    async def _retry_send_message(self, receiver_id: int, message: str, message_id: str, retries: int, retry_interval: int):
-        retry_count = 0
-        while retry_count < retries:
-            try:
-                websocket = self.active_connections.get(receiver_id)
-                if websocket:
-                    await websocket.send_text(message)
-                    await asyncio.sleep(retry_interval * (2 ** retry_count))
+        """
+        Best effort: no message id, no ack and no retransmission. The same
+        indicator repeated within `TYPING_DEBOUNCE_MS` is dropped, a change
+        (typing -> blur) always goes out.
+        """
+        try:
+            key = (sender_id, receiver_id)
+            now = time.monotonic()
+            last = self.typing_sent.get(key)
+            if last is not None and last[0] == type and now - last[1] < self.typing_debounce:
+                typing_debounced.inc()
+                return
+            if len(self.typing_sent) >= TYPING_STATE_SIZE:
+                self.typing_sent.clear()
+            self.typing_sent[key] = (type, now)
+
+            event = OutboundEvent({'type': type, 'sender_id': sender_id})
+            await self.send_ephemeral(receiver_id, f"typing:{sender_id}", event)
+        except Exception as e:
+            logger.warning("Failed to send typing indicator to %s: %s", receiver_id, e)
 
-                    if message_id not in self.pending_messages:
-                        return
+    async def send_ephemeral(self, receiver_id: int, slot: str, event: OutboundEvent):
+        """Sends a frame that is only worth its latest value, dropped if the receiver is offline."""
+        connection = self.active_connections.get(receiver_id)
+        if connection:
+            connection.send_ephemeral(slot, event.encode(connection.codec))
+            return
+
+        worker_id = await self.directory.locate(receiver_id)
+        if worker_id and worker_id != self.worker_id:
+            bus_event = {'op': 'ephemeral', 'receiver_id': receiver_id, 'slot': slot, 'payload': event.payload}
+            if await self.bus.send(worker_id, bus_event):
+                messages_forwarded.inc()
+            else:
+                self.directory.invalidate(receiver_id)
+
+    async def multicast(self, member_ids: list, payload: dict, forward: bool = True):
+        """
+        Pushes one event to many users, e.g. the members of a room. The frame is
+        encoded once per codec and the very same buffer is queued on every
+        local connection, each still acked and retransmitted on its own. The
+        members on other workers are reached with a single broadcast.
+        """
+        message_id = self.generate_message_id()
+        event = OutboundEvent({**payload, 'message_id': message_id})
+        remote = []
+        local = 0
+        for member_id in member_ids:
+            if member_id in self.active_connections:
+                await self.queue_message(member_id, event, message_id)
+                local += 1
+            else:
+                remote.append(member_id)
+        multicast_recipients.observe(local)
+
+        if forward and remote:
+            await self.bus.broadcast({'op': 'multicast', 'member_ids': remote, 'payload': payload})
+
+    async def acknowledge_message(self, user_id: int, message_id: str):
+        pending = self.pending_messages.get((user_id, message_id))
+        if pending is None:
+            return
+        messages_acked.inc()
+        ack_seconds.observe(time.monotonic() - pending.queued_at)
+        if pending.seqs:
+            inbox.ack(user_id, pending.seqs)
+        self._remove_pending((user_id, message_id))
 
-                    retry_count += 1
-            except Exception as e:
-                print(f"Failed to send message {message_id} to {receiver_id}: {e}")
-                break
+    async def acknowledge_seq(self, user_id: int, seq: int):
+        inbox.ack_upto(user_id, seq)
+
+    def defers(self, user_id: int, event_class: str) -> bool:
+        """Whether the overflow policy of a local connection holds back `event_class` events right now."""
+        connection = self.active_connections.get(user_id)
+        return connection is not None and connection.defers(event_class)
+
+    async def queue_message(self, receiver_id: int, event: OutboundEvent, message_id: str, retries: int = 5, retry_interval: int = 2, seqs: tuple = ()):
+        connection = self.active_connections.get(receiver_id)
+        if not connection:
+            await self._forward(receiver_id, event, message_id, retries, retry_interval, seqs)
+            return
+        if connection.closed:
+            # Closed as a slow consumer, the client resumes from its inbox
+            return
+
+        # Encoded once per codec, the pending copy is the very frame that was sent
+        message = event.encode(connection.codec)
+        key = (receiver_id, message_id)
+        self._remove_pending(key)
+        self._evict_for(receiver_id, len(message))
+
+        self.pending_messages[key] = PendingMessage(receiver_id, message, retries, retry_interval, seqs)
+        self.pending_by_user.setdefault(receiver_id, {})[key] = None
+        self.pending_bytes += len(message)
+
+        messages_queued.inc()
+        outbound_frame_bytes.observe(len(message))
+        connection.send(message)
+        self.retransmit_wheel.schedule(key, retry_interval)
+
+    async def _forward(self, receiver_id: int, event: OutboundEvent, message_id: str, retries: int, retry_interval: int, seqs: tuple):
+        worker_id = await self.directory.locate(receiver_id)
+        if not worker_id or worker_id == self.worker_id:
+            return
+        # The payload travels decoded, the other worker encodes it for its connection
+        bus_event = {
+            'op': 'queue',
+            'receiver_id': receiver_id,
+            'payload': event.payload,
+            'message_id': message_id,
+            'retries': retries,
+            'retry_interval': retry_interval,
+            'seqs': list(seqs)
+        }
+        if await self.bus.send(worker_id, bus_event):
+            messages_forwarded.inc()
+        else:
+            self.directory.invalidate(receiver_id)
+
+    async def handle_bus_event(self, event: dict):
+        op = event.get('op')
+
+        if op == 'queue':
+            # Only delivered if the user is still connected here, never forwarded twice
+            if event['receiver_id'] in self.active_connections:
+                await self.queue_message(
+                    event['receiver_id'], OutboundEvent(event['payload']), event['message_id'],
+                    event['retries'], event['retry_interval'], tuple(event['seqs'])
+                )
+
+        if op == 'multicast':
+            local = [member_id for member_id in event['member_ids'] if member_id in self.active_connections]
+            if local:
+                await self.multicast(local, event['payload'], forward=False)
+
+        if op == 'ephemeral':
+            connection = self.active_connections.get(event['receiver_id'])
+            if connection:
+                connection.send_ephemeral(event['slot'], connection.codec.encode(event['payload']))
+
+        if op == 'history':
+            history_cache.invalidate(tuple(key) for key in event['keys'])
+
+        if op == 'room_members':
+            room_member_cache.invalidate(event['room_ids'])
+
+        if op == 'presence':
+            presence.apply_remote(event['changes'])
+
+        if op == 'evict':
+            connection = self.active_connections.pop(event['user_id'], None)
+            if connection:
+                # The user reconnected to another worker, which now owns them
+                self.idle_wheel.cancel(connection)
+                connection.close()
+                self._drop_pending_for(event['user_id'])
+                presence.forget(event['user_id'])
+                try:
+                    await connection.websocket.close(code=4001, reason="Connected elsewhere")
+                except Exception:
+                    pass
+
+    async def _sweep_idle(self, connections: list):
+        """
+        Closes the connections whose deadline passed without receiving
+        anything. Frames only stamp `last_seen`, so a connection that was
+        active meanwhile is pushed back to its real deadline here, once per
+        timeout instead of once per frame.
+        """
+        now = time.monotonic()
+        idle = []
+        for connection in connections:
+            if connection.closed:
+                continue
+            remaining = connection.last_seen + self.idle_timeout - now
+            if remaining > 0:
+                self.idle_wheel.schedule(connection, remaining)
+            else:
+                idle.append(connection)
+        if idle:
+            idle_disconnects.inc(len(idle))
+            await asyncio.gather(*(self._close_idle(connection) for connection in idle))
+
+    async def _close_idle(self, connection: Connection):
+        await self.disconnect(connection.user_id, connection.websocket)
+        try:
+            await connection.websocket.close(code=1001, reason="Ping timeout")
+        except Exception:
+            pass
+
+    async def _retransmit(self, keys: list):
+        for key in keys:
+            pending = self.pending_messages.get(key)
+            if pending is None:
+                continue
+
+            connection = self.active_connections.get(pending.receiver_id)
+            if not connection or pending.attempts >= pending.retries:
+                messages_expired.inc()
+                self._remove_pending(key)
+                continue
+
+            if connection.congested:
+                # The frame is most likely still in the queue, sending it again only adds to the backlog
+                self.retransmit_wheel.schedule(key, pending.retry_interval * (2 ** (pending.attempts - 1)))
+                continue
+
+            messages_retransmitted.inc()
+            connection.send(pending.message)
+            self.retransmit_wheel.schedule(key, pending.retry_interval * (2 ** pending.attempts))
+            pending.attempts += 1
+
+    def _evict_for(self, receiver_id: int, size: int):
+        # Hard caps: the oldest unacked messages go first
+        user_keys = self.pending_by_user.get(receiver_id, {})
+        while len(user_keys) >= PENDING_MAX_PER_USER:
+            messages_evicted.inc()
+            self._remove_pending(next(iter(user_keys)))
+
+        while self.pending_messages and (
+            len(self.pending_messages) >= PENDING_MAX_MESSAGES or self.pending_bytes + size > PENDING_MAX_BYTES
+        ):
+            messages_evicted.inc()
+            self._remove_pending(next(iter(self.pending_messages)))
+
+    def _remove_pending(self, key):
+        pending = self.pending_messages.pop(key, None)
+        if pending is None:
+            return
+        self.pending_bytes -= len(pending.message)
+        self.retransmit_wheel.cancel(key)
+        user_keys = self.pending_by_user.get(key[0])
+        if user_keys is not None:
+            user_keys.pop(key, None)
+            if not user_keys:
+                del self.pending_by_user[key[0]]
+
+    def _drop_pending_for(self, user_id: int):
+        for key in list(self.pending_by_user.get(user_id, ())):
+            self._remove_pending(key)
 
     def generate_message_id(self) -> str:
         return f"{uuid.uuid4()}-{int(time.time())}"
 
-    async def notify_status_change(self, user_id: int, status: str):
+    async def send_presence(self, receiver_id: int, changes: list):
         message_id = self.generate_message_id()
-        message = json.dumps({'type': 'status', 'user_id': user_id, 'status': status, 'message_id': message_id})
-
-        for connection_id in self.active_connections.keys():
-            await self.queue_message(connection_id, message, message_id)
\ No newline at end of file
+        event = OutboundEvent({'type': 'presence', 'changes': changes, 'message_id': message_id})
+        await self.queue_message(receiver_id, event, message_id)
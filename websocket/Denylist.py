@@ -0,0 +1,81 @@
+import os
+import time
+import asyncio
+import logging
+from dotenv import load_dotenv
+from api.controller.TokenController import revoke_token, fetch_revoked_tokens, prune_revoked_tokens
+from utils.jwt_utils import token_cache, token_id
+from db.db import async_session
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+DENYLIST_REFRESH_SECONDS = float(os.getenv("DENYLIST_REFRESH_SECONDS", "5"))
+DENYLIST_PRUNE_SECONDS = float(os.getenv("DENYLIST_PRUNE_SECONDS", "3600"))
+
+class TokenDenylist:
+    """
+    Tokens revoked before their expiry, e.g. on logout.
+
+    A revocation is applied to this worker's token cache right away and
+    stored in the database. Every worker reloads the unexpired entries every
+    `DENYLIST_REFRESH_SECONDS`, a read only query, so a logout reaches the
+    other workers within that delay. Expired rows are deleted every
+    `DENYLIST_PRUNE_SECONDS`, until then they only take space: the tokens
+    they name are rejected for their expiry anyway.
+    """
+
+    def __init__(self, refresh_seconds: float = DENYLIST_REFRESH_SECONDS, prune_seconds: float = DENYLIST_PRUNE_SECONDS):
+        self.refresh_interval = refresh_seconds
+        self.prune_interval = prune_seconds
+        self.next_prune = time.monotonic() + prune_seconds
+        self.task = None
+
+    async def start(self):
+        await self.refresh()
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def revoke(self, token: str, claims: dict):
+        key = token_id(token, claims)
+        expires_at = float(claims.get("exp", time.time()))
+        token_cache.revoke(key, expires_at)
+        async with async_session() as session:
+            await revoke_token(key, expires_at, session)
+
+    async def refresh(self):
+        async with async_session() as session:
+            revoked = await fetch_revoked_tokens(session)
+        # Keep what this worker revoked since the query started
+        token_cache.set_revoked({**revoked, **token_cache.revoked})
+        token_cache.prune()
+
+    async def prune(self):
+        async with async_session() as session:
+            await prune_revoked_tokens(session)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.warning("Failed to refresh revoked tokens: %s", e)
+            if time.monotonic() >= self.next_prune:
+                self.next_prune = time.monotonic() + self.prune_interval
+                try:
+                    await self.prune()
+                except Exception as e:
+                    logger.warning("Failed to prune revoked tokens: %s", e)
+
+
+denylist = TokenDenylist()
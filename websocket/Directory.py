@@ -0,0 +1,75 @@
+import os
+import time
+from dotenv import load_dotenv
+from api.controller.RouteController import upsert_route, delete_route, delete_worker_routes, fetch_route
+from db.db import async_session
+
+load_dotenv()
+
+MESSAGE_BUS = os.getenv("MESSAGE_BUS", "local")
+ROUTE_CACHE_SECONDS = float(os.getenv("ROUTE_CACHE_SECONDS", "2"))
+ROUTE_CACHE_SIZE = 100000
+
+class LocalDirectory:
+    """Directory of a single worker: a user is either connected here or offline."""
+
+    async def register(self, user_id: int, worker_id: str):
+        return None
+
+    async def unregister(self, user_id: int, worker_id: str):
+        pass
+
+    async def clear(self, worker_id: str):
+        pass
+
+    async def locate(self, user_id: int):
+        return None
+
+    def invalidate(self, user_id: int):
+        pass
+
+class SQLiteDirectory:
+    """
+    User -> worker routing table shared by every process through the database.
+
+    Lookups are cached for `ROUTE_CACHE_SECONDS`. A stale entry only costs a
+    misrouted push, and the event is still in the recipient's inbox.
+    """
+
+    def __init__(self, cache_seconds: float = ROUTE_CACHE_SECONDS):
+        self.cache_seconds = cache_seconds
+        self.cache: dict = {}
+
+    async def register(self, user_id: int, worker_id: str):
+        self.cache[user_id] = (worker_id, time.monotonic() + self.cache_seconds)
+        async with async_session() as session:
+            return await upsert_route(user_id, worker_id, session)
+
+    async def unregister(self, user_id: int, worker_id: str):
+        self.cache.pop(user_id, None)
+        async with async_session() as session:
+            await delete_route(user_id, worker_id, session)
+
+    async def clear(self, worker_id: str):
+        # Routes left behind by a previous run of this worker
+        async with async_session() as session:
+            await delete_worker_routes(worker_id, session)
+
+    async def locate(self, user_id: int):
+        cached = self.cache.get(user_id)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        async with async_session() as session:
+            worker_id = await fetch_route(user_id, session)
+        if len(self.cache) >= ROUTE_CACHE_SIZE:
+            self.cache.clear()
+        self.cache[user_id] = (worker_id, time.monotonic() + self.cache_seconds)
+        return worker_id
+
+    def invalidate(self, user_id: int):
+        self.cache.pop(user_id, None)
+
+def create_directory():
+    if MESSAGE_BUS == "unix":
+        return SQLiteDirectory()
+    return LocalDirectory()
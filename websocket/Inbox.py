@@ -0,0 +1,94 @@
+import os
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from dotenv import load_dotenv
+from api.controller.InboxController import fetch_inbox, prune_inbox, expire_inbox
+from db.db import async_session
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+INBOX_BATCH_SIZE = int(os.getenv("INBOX_BATCH_SIZE", "200"))
+INBOX_PRUNE_SECONDS = float(os.getenv("INBOX_PRUNE_SECONDS", "2"))
+INBOX_RETENTION_DAYS = float(os.getenv("INBOX_RETENTION_DAYS", "30"))
+
+class Inbox:
+    """
+    Durable per-user event log.
+
+    Every reliable event is stored with a per-user sequence number before it
+    is pushed, so a client that reconnects with `?since=<seq>` only receives
+    what it missed. Acknowledged events are deleted in the background, in
+    bulk, and anything never acknowledged expires after `INBOX_RETENTION_DAYS`.
+    """
+
+    def __init__(self, batch_size: int = INBOX_BATCH_SIZE, prune_seconds: float = INBOX_PRUNE_SECONDS, retention_days: float = INBOX_RETENTION_DAYS):
+        self.batch_size = batch_size
+        self.prune_interval = prune_seconds
+        self.retention = timedelta(days=retention_days)
+        self.acked: dict = {}
+        self.acked_upto: dict = {}
+        self.task = None
+
+    async def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self.prune()
+
+    def ack(self, user_id: int, seqs):
+        self.acked.setdefault(user_id, set()).update(seqs)
+
+    def ack_upto(self, user_id: int, seq: int):
+        self.acked_upto[user_id] = max(seq, self.acked_upto.get(user_id, 0))
+
+    async def fetch(self, user_id: int, since: int) -> tuple:
+        """Returns the next batch of events after `since` and whether more follow."""
+        async with async_session() as session:
+            events = await fetch_inbox(user_id, since, self.batch_size + 1, session)
+        return events[:self.batch_size], len(events) > self.batch_size
+
+    async def prune(self):
+        if not self.acked and not self.acked_upto:
+            return
+        acked, self.acked = self.acked, {}
+        acked_upto, self.acked_upto = self.acked_upto, {}
+        try:
+            async with async_session() as session:
+                await prune_inbox({user_id: list(seqs) for user_id, seqs in acked.items()}, acked_upto, session)
+        except Exception as e:
+            for user_id, seqs in acked.items():
+                self.ack(user_id, seqs)
+            for user_id, seq in acked_upto.items():
+                self.ack_upto(user_id, seq)
+            logger.warning("Failed to prune inbox: %s", e)
+
+    async def expire(self):
+        older_than = datetime.now(timezone.utc).replace(tzinfo=None) - self.retention
+        try:
+            async with async_session() as session:
+                await expire_inbox(older_than, session)
+        except Exception as e:
+            logger.warning("Failed to expire inbox: %s", e)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        next_expiry = loop.time()
+        while True:
+            await asyncio.sleep(self.prune_interval)
+            await self.prune()
+            if loop.time() >= next_expiry:
+                next_expiry = loop.time() + 3600
+                await self.expire()
+
+
+inbox = Inbox()
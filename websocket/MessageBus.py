@@ -0,0 +1,154 @@
+import os
+import glob
+import orjson
+import socket
+import asyncio
+import logging
+from dotenv import load_dotenv
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+MESSAGE_BUS = os.getenv("MESSAGE_BUS", "local")
+BUS_DIR = os.getenv("BUS_DIR", "/tmp/vetra-bus")
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+class MessageBus:
+    """
+    Carries events between the processes that hold websocket connections.
+
+    Events are plain dicts. `send` targets one worker and returns False when
+    that worker cannot be reached, `broadcast` reaches every other worker.
+    Incoming events are passed to the handler given to `start`.
+    """
+
+    def __init__(self, worker_id: str = None):
+        self.worker_id = worker_id or default_worker_id()
+        self.handler = None
+
+    async def start(self, handler):
+        self.handler = handler
+
+    async def stop(self):
+        self.handler = None
+
+    async def send(self, worker_id: str, event: dict) -> bool:
+        raise NotImplementedError
+
+    async def broadcast(self, event: dict):
+        raise NotImplementedError
+
+class InProcessBus(MessageBus):
+    """
+    Bus between workers living in the same process. With a single worker it
+    never has anyone to talk to, with several it lets them be tested together.
+    """
+
+    workers: dict = {}
+
+    async def start(self, handler):
+        await super().start(handler)
+        InProcessBus.workers[self.worker_id] = self
+
+    async def stop(self):
+        InProcessBus.workers.pop(self.worker_id, None)
+        await super().stop()
+
+    async def send(self, worker_id: str, event: dict) -> bool:
+        worker = InProcessBus.workers.get(worker_id)
+        if worker is None or worker.handler is None:
+            return False
+        await worker.handler(event)
+        return True
+
+    async def broadcast(self, event: dict):
+        for worker_id in list(InProcessBus.workers):
+            if worker_id != self.worker_id:
+                await self.send(worker_id, event)
+
+class UnixSocketBus(MessageBus):
+    """
+    Bus between the processes of one machine. Every worker listens on
+    `<BUS_DIR>/<worker_id>.sock` and events are newline-delimited JSON over a
+    persistent stream per peer.
+    """
+
+    def __init__(self, worker_id: str = None, bus_dir: str = BUS_DIR):
+        super().__init__(worker_id)
+        self.bus_dir = bus_dir
+        self.path = os.path.join(bus_dir, f"{self.worker_id}.sock")
+        self.server = None
+        self.peers: dict = {}
+        self.locks: dict = {}
+
+    async def start(self, handler):
+        await super().start(handler)
+        os.makedirs(self.bus_dir, exist_ok=True)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.server = await asyncio.start_unix_server(self._serve, path=self.path)
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+        for writer in self.peers.values():
+            writer.close()
+        self.peers.clear()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        await super().stop()
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    await self.handler(orjson.loads(line))
+                except Exception:
+                    logger.exception("Failed to handle bus event")
+        finally:
+            writer.close()
+
+    async def _peer(self, worker_id: str) -> asyncio.StreamWriter:
+        writer = self.peers.get(worker_id)
+        if writer is None or writer.is_closing():
+            _, writer = await asyncio.open_unix_connection(os.path.join(self.bus_dir, f"{worker_id}.sock"))
+            self.peers[worker_id] = writer
+        return writer
+
+    async def send(self, worker_id: str, event: dict) -> bool:
+        lock = self.locks.setdefault(worker_id, asyncio.Lock())
+        async with lock:
+            try:
+                writer = await self._peer(worker_id)
+                writer.write(orjson.dumps(event, option=orjson.OPT_NON_STR_KEYS) + b"\n")
+                await writer.drain()
+                return True
+            except ConnectionRefusedError:
+                # Socket file left behind by a worker that died
+                self.peers.pop(worker_id, None)
+                try:
+                    os.unlink(os.path.join(self.bus_dir, f"{worker_id}.sock"))
+                except OSError:
+                    pass
+                return False
+            except (ConnectionError, OSError):
+                self.peers.pop(worker_id, None)
+                return False
+
+    async def broadcast(self, event: dict):
+        for path in glob.glob(os.path.join(self.bus_dir, "*.sock")):
+            worker_id = os.path.basename(path)[:-len(".sock")]
+            if worker_id != self.worker_id:
+                await self.send(worker_id, event)
+
+def create_bus() -> MessageBus:
+    if MESSAGE_BUS == "unix":
+        return UnixSocketBus()
+    return InProcessBus()
@@ -0,0 +1,193 @@
+import os
+import asyncio
+import logging
+from dotenv import load_dotenv
+from api.controller.UserController import update_statuses, fetch_contacts
+from db.db import async_session
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+PRESENCE_FLUSH_MS = float(os.getenv("PRESENCE_FLUSH_MS", "250"))
+PRESENCE_DB_FLUSH_SECONDS = float(os.getenv("PRESENCE_DB_FLUSH_SECONDS", "5"))
+
+class PresenceTracker:
+    """
+    In-memory presence of every user, connected to this process or another.
+
+    Status transitions are only recorded here. Every `PRESENCE_FLUSH_MS` the
+    changes since the last flush are coalesced (a reconnect inside one window
+    nets out to nothing), the local ones are broadcast once to the other
+    workers, and each user connected here receives a single diff that only
+    mentions the users they share a conversation with. A user whose
+    connection is congested gets nothing until it catches up, then a single
+    diff with the latest status of everyone who changed (unless
+    `SEND_OVERFLOW_POLICY` keeps presence). The `status` column is
+    written in bulk every `PRESENCE_DB_FLUSH_SECONDS` by the worker that owns
+    the connection.
+    """
+
+    def __init__(self, flush_ms: float = PRESENCE_FLUSH_MS, db_flush_seconds: float = PRESENCE_DB_FLUSH_SECONDS):
+        self.flush_interval = flush_ms / 1000
+        self.db_flush_interval = db_flush_seconds
+        self.statuses: dict = {}
+        self.local: set = set()
+        # Contacts of the users connected here, and the reverse index used for fan-out
+        self.contacts: dict = {}
+        self.watchers: dict = {}
+        self.published: dict = {}
+        self.changed: dict = {}
+        self.remote_changed: dict = {}
+        self.dirty: dict = {}
+        # Recipient -> {user_id: status} held back while the recipient's connection is congested
+        self.deferred: dict = {}
+        self.manager = None
+        self.task = None
+
+    async def start(self, manager):
+        self.manager = manager
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        for user_id in list(self.local):
+            self.disconnect(user_id)
+        await self.flush()
+        await self.flush_db()
+
+    async def connect(self, user_id: int):
+        if user_id not in self.contacts:
+            async with async_session() as session:
+                contacts = await fetch_contacts(user_id, session)
+            self.contacts[user_id] = set()
+            for contact_id in contacts:
+                self.add_contact(user_id, contact_id)
+        self.local.add(user_id)
+        self.set_status(user_id, "Online")
+
+    def disconnect(self, user_id: int):
+        self.local.discard(user_id)
+        self.set_status(user_id, "Offline")
+
+    def forget(self, user_id: int):
+        """The user moved to another worker, which now owns their presence."""
+        self.local.discard(user_id)
+        self.changed.pop(user_id, None)
+        self._drop_contacts(user_id)
+
+    def set_status(self, user_id: int, status: str):
+        self._apply(user_id, status)
+        self.changed[user_id] = status
+        self.dirty[user_id] = status
+
+    def apply_remote(self, changes: dict):
+        for user_id, status in changes.items():
+            user_id = int(user_id)
+            if user_id in self.local:
+                continue
+            self._apply(user_id, status)
+            self.remote_changed[user_id] = status
+
+    def status_of(self, user_id: int, default: str) -> str:
+        if user_id in self.statuses:
+            return self.statuses[user_id]
+        return self.dirty.get(user_id, default)
+
+    def add_contact(self, user_id: int, peer_id: int):
+        if user_id == peer_id:
+            return
+        if user_id in self.contacts:
+            self.contacts[user_id].add(peer_id)
+            self.watchers.setdefault(peer_id, set()).add(user_id)
+        if peer_id in self.contacts:
+            self.contacts[peer_id].add(user_id)
+            self.watchers.setdefault(user_id, set()).add(peer_id)
+
+    def _apply(self, user_id: int, status: str):
+        if status == "Offline":
+            self.statuses.pop(user_id, None)
+        else:
+            self.statuses[user_id] = status
+
+    def _drop_contacts(self, user_id: int):
+        for contact_id in self.contacts.pop(user_id, ()):
+            watchers = self.watchers.get(contact_id)
+            if watchers is not None:
+                watchers.discard(user_id)
+                if not watchers:
+                    del self.watchers[contact_id]
+
+    async def flush(self):
+        changed, self.changed = self.changed, {}
+        remote_changed, self.remote_changed = self.remote_changed, {}
+
+        if changed and self.manager is not None:
+            await self.manager.bus.broadcast({'op': 'presence', 'changes': changed})
+
+        batches = {}
+        for user_id, status in {**remote_changed, **changed}.items():
+            if self.published.get(user_id, "Offline") == status:
+                continue
+            if status == "Offline":
+                self.published.pop(user_id, None)
+            else:
+                self.published[user_id] = status
+
+            change = {'user_id': user_id, 'status': status}
+            for watcher_id in self.watchers.get(user_id, ()):
+                if watcher_id in self.local:
+                    batches.setdefault(watcher_id, []).append(change)
+
+        for user_id in changed:
+            if user_id not in self.local:
+                self._drop_contacts(user_id)
+
+        for recipient_id, changes in batches.items():
+            merged = self.deferred.setdefault(recipient_id, {})
+            for change in changes:
+                merged[change['user_id']] = change['status']
+
+        for recipient_id in list(self.deferred):
+            if recipient_id not in self.local:
+                del self.deferred[recipient_id]
+                continue
+            if self.manager.defers(recipient_id, "presence"):
+                continue
+            merged = self.deferred.pop(recipient_id)
+            changes = [{'user_id': user_id, 'status': status} for user_id, status in merged.items()]
+            await self.manager.send_presence(recipient_id, changes)
+
+    async def flush_db(self):
+        if not self.dirty:
+            return
+        dirty, self.dirty = self.dirty, {}
+        try:
+            async with async_session() as session:
+                await update_statuses(dirty, session)
+        except Exception as e:
+            # Keep the newest state for the next attempt
+            self.dirty = {**dirty, **self.dirty}
+            logger.warning("Failed to persist user statuses: %s", e)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        next_db_flush = loop.time() + self.db_flush_interval
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                if loop.time() >= next_db_flush:
+                    next_db_flush = loop.time() + self.db_flush_interval
+                    await self.flush_db()
+            except Exception:
+                logger.exception("Failed to flush presence")
+
+
+presence = PresenceTracker()
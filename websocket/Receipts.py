@@ -0,0 +1,105 @@
+import os
+import asyncio
+import logging
+from dotenv import load_dotenv
+from api.controller.ChatController import RECEIPT_STATUSES, apply_receipts
+from api.controller.RoomController import apply_room_reads
+from db.db import async_session
+from models.Chat import conversation_key
+from utils.history_cache import history_cache
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+RECEIPT_FLUSH_MS = float(os.getenv("RECEIPT_FLUSH_MS", "200"))
+
+class ReceiptBatcher:
+    """
+    Delivered and read receipts, applied in bulk.
+
+    A client acknowledges a range ("read everything from this user up to id
+    X"). Ranges are only merged in memory, the highest `upto` per conversation
+    and status wins, and every `RECEIPT_FLUSH_MS` they are written in one
+    transaction. The sender then receives a single `receipt` event per
+    conversation instead of one frame per message.
+
+    Read cursors of rooms are merged and written the same way.
+    """
+
+    def __init__(self, flush_ms: float = RECEIPT_FLUSH_MS):
+        self.flush_interval = flush_ms / 1000
+        self.pending: dict = {}
+        self.room_reads: dict = {}
+        self.manager = None
+        self.task = None
+
+    async def start(self, manager):
+        self.manager = manager
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self.flush()
+
+    def submit(self, reader_id: int, sender_id: int, status: str, upto: int):
+        if status not in RECEIPT_STATUSES:
+            raise ValueError(f"Unknown receipt status {status}")
+        self._merge(self.pending, (reader_id, sender_id), {status: upto})
+
+    def submit_room_read(self, user_id: int, room_id: int, upto: int):
+        key = (user_id, room_id)
+        self.room_reads[key] = max(upto, self.room_reads.get(key, 0))
+
+    def _merge(self, pending: dict, key: tuple, statuses: dict):
+        merged = pending.setdefault(key, {})
+        for status, upto in statuses.items():
+            merged[status] = max(upto, merged.get(status, 0))
+
+    async def flush(self):
+        await self.flush_room_reads()
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        try:
+            async with async_session() as session:
+                deliveries = await apply_receipts(pending, session)
+        except Exception as e:
+            # Keep the ranges for the next attempt, merged with the newer ones
+            for key, statuses in pending.items():
+                self._merge(self.pending, key, statuses)
+            logger.warning("Failed to apply receipts: %s", e)
+            return
+
+        await history_cache.publish({conversation_key(*key) for key in pending})
+        for delivery in deliveries:
+            await self.manager.deliver(*delivery)
+
+    async def flush_room_reads(self):
+        if not self.room_reads:
+            return
+        room_reads, self.room_reads = self.room_reads, {}
+        try:
+            async with async_session() as session:
+                await apply_room_reads(room_reads, session)
+        except Exception as e:
+            for (user_id, room_id), upto in room_reads.items():
+                self.submit_room_read(user_id, room_id, upto)
+            logger.warning("Failed to apply room read cursors: %s", e)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Failed to flush receipts")
+
+
+receipts = ReceiptBatcher()
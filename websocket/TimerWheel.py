@@ -0,0 +1,80 @@
+import math
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+class TimerWheel:
+    """
+    Hashed timing wheel driven by a single task.
+
+    Deadlines are rounded up to `tick` seconds and dropped into one of `slots`
+    buckets, so scheduling and cancelling are O(1) and thousands of timers cost
+    one sleeping task. Every tick the current bucket is emptied and its expired
+    keys are handed to `on_expire` in one call.
+    """
+
+    def __init__(self, on_expire, tick: float = 0.5, slots: int = 128):
+        self.on_expire = on_expire
+        self.tick = tick
+        self.slots = [dict() for _ in range(slots)]
+        self.position = 0
+        self.locations: dict = {}
+        self.task = None
+
+    def __len__(self):
+        return len(self.locations)
+
+    async def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def schedule(self, key, delay: float):
+        self.cancel(key)
+        ticks = max(1, math.ceil(delay / self.tick))
+        rounds, offset = divmod(ticks, len(self.slots))
+        if offset == 0:
+            rounds, offset = rounds - 1, len(self.slots)
+        slot = (self.position + offset) % len(self.slots)
+        self.slots[slot][key] = rounds
+        self.locations[key] = slot
+
+    def cancel(self, key):
+        slot = self.locations.pop(key, None)
+        if slot is not None:
+            self.slots[slot].pop(key, None)
+
+    def advance(self) -> list:
+        self.position = (self.position + 1) % len(self.slots)
+        bucket = self.slots[self.position]
+        expired = []
+        for key, rounds in list(bucket.items()):
+            if rounds > 0:
+                bucket[key] = rounds - 1
+            else:
+                del bucket[key]
+                del self.locations[key]
+                expired.append(key)
+        return expired
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time() + self.tick
+        while True:
+            await asyncio.sleep(max(0, next_tick - loop.time()))
+            next_tick += self.tick
+            expired = self.advance()
+            if expired:
+                try:
+                    await self.on_expire(expired)
+                except Exception:
+                    logger.exception("Timer wheel callback failed")